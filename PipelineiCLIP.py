@@ -9,6 +9,7 @@ import pandas
 import os
 import re
 import pysam
+import iCLIP
 
 # The PARAMS dictionary must be provided by the importing
 # code
@@ -25,8 +26,13 @@ def checkParams():
 
 def removeFirstAndLastExon(infile, outfile):
 
-    transcripts = GTF.transcript_iterator(
-        GTF.iterator(IOTools.openFile(infile)))
+    store = iCLIP.findGenesetStore(infile)
+    if store is None:
+        transcripts = GTF.transcript_iterator(
+            GTF.iterator(IOTools.openFile(infile)))
+    else:
+        transcripts = store.iterTranscripts()
+
     outfile = IOTools.openFile(outfile, "w")
 
     for transcript in transcripts:
@@ -69,7 +75,7 @@ def callClusters(bamfile, gtffile, outfiles,
 
     checkParams()
 
-    bedGraph, bed12 = outfiles
+    bedGraph, bed12 = outfiles[:2]
     logfile = P.snip(bed12, ".bed.gz")
 
     if window_size:
@@ -87,19 +93,48 @@ def callClusters(bamfile, gtffile, outfiles,
     else:
         options += " -t %s" % PARAMS["clusters_pthresh"]
 
-    
+
+    options += " --threads=%s" % PARAMS["clusters_threads"]
+
+    # -log10(p) bigWigs are requested by passing their names after
+    # the bedGraph and bed12
+    if len(outfiles) > 2:
+        options += " --output-bigwig=%s" % P.snip(outfiles[2], "_plus.bw")
+
     job_options = "-l mem_free=10G"
-    statement = '''python %(scriptsdir)s/gtf2gtf.py -L %(logfile)s.log
-                           -I %(gtffile)s
-                          --method=sort --sort-order=gene+transcript
-                 | python %(scriptsdir)s/gtf2gtf.py -L %(logfile)s.log 
-                          --method=set-transcript-to-gene
-                 | python %(project_src)s/find_significant_bases.py
-                   %(bamfile)s
-                   %(options)s
-                   --output-both=%(bed12)s
-                  -L %(logfile)s.log
-                | gzip -c > %(bedGraph)s '''
+
+    if PARAMS["clusters_spill"]:
+        options += " --spill"
+        job_options = "-l mem_free=4G"
+
+    job_threads = PARAMS["clusters_threads"]
+    # use the compiled geneset if there is one, otherwise sort the
+    # GTF as find_significant_bases needs it
+    store = iCLIP.findGenesetStore(gtffile)
+
+    if store is not None:
+        store = store.filename
+        statement = '''python %(project_src)s/find_significant_bases.py
+                       %(bamfile)s
+                       %(options)s
+                       --geneset-store=%(store)s
+                       --set-transcript-to-gene
+                       --output-both=%(bed12)s
+                      -L %(logfile)s.log
+                    < /dev/null
+                    | gzip -c > %(bedGraph)s '''
+    else:
+        statement = '''python %(scriptsdir)s/gtf2gtf.py -L %(logfile)s.log
+                               -I %(gtffile)s
+                              --method=sort --sort-order=gene+transcript
+                     | python %(scriptsdir)s/gtf2gtf.py -L %(logfile)s.log 
+                              --method=set-transcript-to-gene
+                     | python %(project_src)s/find_significant_bases.py
+                       %(bamfile)s
+                       %(options)s
+                       --output-both=%(bed12)s
+                      -L %(logfile)s.log
+                    | gzip -c > %(bedGraph)s '''
 
     P.run()
 
@@ -244,10 +279,17 @@ def calculateSplicingIndex(bamfile, gtffile, outfile):
 
     counts = E.Counter()
 
-    for transcript in GTF.transcript_iterator(
-            GTF.iterator(IOTools.openFile(gtffile))):
+    # introns are precomputed in a geneset store
+    store = iCLIP.findGenesetStore(gtffile)
+    if store is None:
+        transcripts = ((transcript, GTF.toIntronIntervals(transcript))
+                       for transcript in GTF.transcript_iterator(
+                           GTF.iterator(IOTools.openFile(gtffile))))
+    else:
+        transcripts = store.iterTranscripts(introns=True)
+
+    for transcript, introns in transcripts:
 
-        introns = GTF.toIntronIntervals(transcript)
         E.debug("Gene %s (%s), Transcript: %s, %i introns" %
                 (transcript[0].gene_id,
                  transcript[0].contig,
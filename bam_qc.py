@@ -0,0 +1,133 @@
+'''
+bam_qc.py - QC statistics for a BAM file in one pass
+=====================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Reads a BAM file once and collects:
+
+* the histogram of aligned (or fragment) lengths, as length_stats.py
+* the histogram of UMIs, as umi_hist.py
+* the number of spliced alignments (those with an N in the CIGAR string)
+* flag and mapping statistics, in the format of bam2stats.py
+
+Each is written to its own file, in the same format as the scripts it
+replaces, so that the statistics can be loaded in the same way. Only
+statistics with an output file given are collected, all of them in the
+single pass over the file.
+
+Lengths and UMIs are only taken from reads placed on a reference, as
+by length_stats.py and umi_hist.py. Flag
+statistics cover all alignments, and reads are counted from their
+primary alignments. Only the flag categories are reported, not
+the categories bam2stats.py takes from a FASTQ file or NH tags.
+
+Options
+-------
+
+--length-stats, --umi-stats, --nspliced, --bam-stats
+        Files to write each set of statistics to. Files ending .gz are
+        compressed.
+
+-p, --paired
+        Data is paired. Use the fragment length where the aligned
+        length is greater than or equal to this length.
+
+--threads
+        Number of threads to decompress the BAM file with.
+
+Usage
+-----
+
+python bam_qc.py -I BAMFILE --length-stats=LENGTHS --umi-stats=UMIS
+                 --nspliced=NSPLICED --bam-stats=STATS
+
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import CGAT.Experiment as E
+import CGAT.IOTools as IOTools
+import iCLIP
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-p", "--paired", dest="paired", type="int",
+                      help="Data is paired. Use fragment length where aligned"
+                           "length is greater than or equal to this length",
+                      default=None)
+    parser.add_option("--length-stats", dest="length_stats", type="string",
+                      default=None,
+                      help="Write length histogram to this file")
+    parser.add_option("--umi-stats", dest="umi_stats", type="string",
+                      default=None,
+                      help="Write UMI histogram to this file")
+    parser.add_option("--nspliced", dest="nspliced", type="string",
+                      default=None,
+                      help="Write number of spliced alignments to this file")
+    parser.add_option("--bam-stats", dest="bam_stats", type="string",
+                      default=None,
+                      help="Write flag statistics to this file")
+
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of threads to decompress the BAM file "
+                           "with [%default]")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.stdin == sys.stdin:
+        in_bam = iCLIP.openBam("-", options.threads)
+    else:
+        fn = options.stdin.name
+        options.stdin.close()
+        in_bam = iCLIP.openBam(fn, options.threads)
+
+    # only the statistics with an output file are collected
+    outputs = [(filename, accumulator) for filename, accumulator in
+               [(options.length_stats,
+                 iCLIP.LengthHistogram(paired=options.paired)),
+                (options.umi_stats, iCLIP.UMIHistogram()),
+                (options.nspliced, iCLIP.SplicedCount()),
+                (options.bam_stats, iCLIP.FlagStats())]
+               if filename is not None]
+
+    adders = [accumulator.add for filename, accumulator in outputs]
+
+    nalignments = 0
+    for read in in_bam.fetch(until_eof=True):
+        nalignments += 1
+        for add in adders:
+            add(read)
+
+    for filename, accumulator in outputs:
+        with IOTools.openFile(filename, "w") as outf:
+            accumulator.write(outf)
+
+    # write footer and output benchmark information.
+    E.info("%i alignments processed" % nalignments)
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
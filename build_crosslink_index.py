@@ -0,0 +1,104 @@
+'''
+build_crosslink_index.py - count crosslinks in a BAM file once
+==============================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Parses every read in an indexed BAM file into its crosslinked base and
+saves the per contig, per strand crosslink counts to a binary crosslink
+index. 
+
+The index is memory mapped by the other iCLIP scripts
+(find_significant_bases.py, count_clip_sites.py, iCLIP2bigWig.py and
+calculateiCLIPReproducibility.py) when it is found next to the BAM file
+they are given, so that the BAM file need only be parsed once, however
+many times it is analysed. The index records the size and modification
+time of the BAM file, and is ignored if the BAM file changes. It also
+records the counts of each type of site (truncation or deletion) on
+each contig. Indexes written by older versions are ignored, and must be
+rebuilt.
+
+By default the index is written to BAMFILE.xlinks, which is where the
+other scripts will look for it.
+
+Options
+-------
+
+--dtype, the smallest integer type used to store counts. Counts that
+        overflow this type are automatically stored in a larger type.
+
+--threads, the number of threads to decompress the BAM file with. A
+        coordinate sorted BAM file is read from start to end in one
+        pass.
+
+Usage
+-----
+
+python build_crosslink_index.py BAMFILE [OUTFILE]
+
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import CGAT.Experiment as E
+import iCLIP
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--dtype", dest="dtype", type="string",
+                      default="uint16",
+                      help="Smallest numpy dtype for storing counts "
+                           "[%default]")
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of threads to decompress the BAM file "
+                           "with [%default]")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if len(args) == 0:
+        raise ValueError("Please specify a BAM file")
+
+    bamfile = args[0]
+
+    if len(args) > 1:
+        outfile = args[1]
+    else:
+        outfile = bamfile + iCLIP.XLINK_INDEX_SUFFIX
+
+    crosslinks = iCLIP.buildCrosslinkIndex(bamfile, outfile, options.dtype,
+                                          options.threads)
+
+    E.info("Counted %i truncated on positive strand, %i on negative"
+           % (crosslinks.counter.truncated_pos,
+              crosslinks.counter.truncated_neg))
+    E.info("and %i deletion reads on positive strand, %i on negative"
+           % (crosslinks.counter.deletion_pos,
+              crosslinks.counter.deletion_neg))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,83 @@
+'''
+build_geneset_store.py - compile a GTF file into a geneset store
+================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Parses a GTF file once and saves its genes, transcripts and entries
+(exons, CDS etc.) as coordinate arrays with string tables, and the
+intron intervals of each transcript, to a binary geneset store.
+
+The store is used by find_significant_bases.py and count_clip_sites.py
+(with --geneset-store) and by the pipeline in place of parsing the GTF
+file, so that the geneset need only be parsed once per genome build
+rather than once per sample per script. The store records the size and
+modification time of the GTF file, and is ignored if the GTF file
+changes.
+
+Genes, transcripts and entries are stored in the order they first
+appear in the GTF file, and all the attributes of each entry are kept.
+find_significant_bases.py can also read genes from the store sorted as
+gtf2gtf.py --method=sort --sort-order=gene+transcript would sort them.
+Stores written by older versions are ignored, and must be rebuilt.
+
+By default the store is written to GTFFILE.gstore, which is where the
+pipeline will look for it.
+
+Usage
+-----
+
+python build_geneset_store.py GTFFILE [OUTFILE]
+
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import CGAT.Experiment as E
+import iCLIP
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if len(args) == 0:
+        raise ValueError("Please specify a GTF file")
+
+    gtffile = args[0]
+
+    if len(args) > 1:
+        outfile = args[1]
+    else:
+        outfile = gtffile + iCLIP.GENESET_STORE_SUFFIX
+
+    ngenes = iCLIP.buildGenesetStore(gtffile, outfile)
+
+    E.info("Stored %i genes" % ngenes)
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -18,6 +18,14 @@ Memory and CPU usage should be reasonably small and grow in proportion to a) The
 number of samples and b) The number of unique bases with reads mapped (
 and not the number of reads in the input file).
 
+For each contig, the crosslinked bases of all the samples are merged once to
+find the number of other samples each base is crosslinked in. The counts for
+every level are then taken from cumulative histograms of depth, rather than by
+retesting every base at each level.
+
+Crosslink indexes (see build_crosslink_index.py) are used in place of
+the BAM files where they exist.
+
 Options
 -------
 
@@ -32,10 +40,29 @@ Options
         not of a great amount of use, and so the max depth can be limited to
         save time.
 
+-p, --pairwise, Calculate the reproducibility of each sample against every
+        other sample seperately, rather than against all the others
+        together. Each sample is read once, and a row output for each
+        ordered pair of samples, with the names of the two samples in the
+        File1 and File2 columns. This is used to compute distances between
+        samples.
+
 -c, --contig, This allows the restricting of the calculation to a single 
         chromosome. This could be useful if it was neccesary to parrellise the
         excution for any reason, or for quick testing perpuses. 
 
+--threads, Number of processes to use. Contigs are divided between the
+        processes, and the counts for each contig summed.
+
+--decompression-threads, Number of threads each process uses to
+        decompress each BAM file.
+
+--merge, Hits and totals are sums over contigs, so the output of runs on
+        different contigs (for example with --contig on different cluster
+        nodes) can be added together. With --merge, the arguments are the
+        outputs of such runs (which may be gzipped), and the output is their
+        sum, as if all the contigs had been run together.
+
 Usage
 -----
 <Example use case>
@@ -56,13 +83,229 @@ Command line options
 '''
 
 import sys
-import pysam
 import iCLIP
 import CGAT.Experiment as E
 import numpy as np
 import collections
-import pandas as pd
+import multiprocessing
 import os.path
+import CGAT.IOTools as IOTools
+
+
+def contigSites(pos_depth, neg_depth, length):
+    ''' Combine the profiles for the two strands of a contig into
+    sorted arrays of sites and their depths, offsetting positions on the
+    negative strand by the length of the contig '''
+
+    positions = np.concatenate([pos_depth.positions,
+                                neg_depth.positions + length])
+    depths = np.concatenate([pos_depth.counts.astype("int64"),
+                             neg_depth.counts.astype("int64")])
+
+    return positions, depths
+
+
+def replicatingSamples(sites):
+    ''' sites is a list of (positions, depths) tuples, one for each
+    sample. Returns a list with, for each sample, an array giving the
+    number of other samples crosslinked at each of its sites '''
+
+    positions = np.concatenate([x[0] for x in sites])
+    union, inverse = np.unique(positions, return_inverse=True)
+    nsamples = np.bincount(inverse, minlength=len(union))
+
+    offsets = np.cumsum([0] + [len(x[0]) for x in sites])
+    return [nsamples[inverse[start:end]] - 1
+            for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def countAbove(depths, n_max):
+    ''' Number of depths greater than n for each n in range(n_max),
+    from a cumulative histogram of depths '''
+
+    histogram = np.bincount(np.minimum(depths, n_max),
+                            minlength=n_max + 1)
+    return histogram[::-1].cumsum()[::-1][1:n_max + 1]
+
+
+def levelCounts(depths, replicating, n_max, nfolds):
+    ''' For each level n in range(n_max) count the sites with depth
+    greater than n (totals) and, for each fold i in range(nfolds), those
+    of them crosslinked in more than i other samples (hits) '''
+
+    totals = countAbove(depths, n_max)
+    hits = [countAbove(depths[replicating > i], n_max)
+            for i in range(nfolds)]
+
+    return totals, hits
+
+
+def pairwiseHits(sites, use_index, n_maxes):
+    ''' For each sample a in use_index, and every other sample b, count
+    the sites in a with depth greater than n, for each n in
+    range(n_maxes[a]), that are also crosslinked in b. sites is as for
+    replicatingSamples. Returns a dictionary of arrays keyed on (a, b) '''
+
+    positions = np.concatenate([x[0] for x in sites])
+    union, inverse = np.unique(positions, return_inverse=True)
+
+    offsets = np.cumsum([0] + [len(x[0]) for x in sites])
+    indexes = [inverse[start:end]
+               for start, end in zip(offsets[:-1], offsets[1:])]
+
+    hits = {}
+    present = np.zeros(len(union), dtype=bool)
+
+    for b in range(len(sites)):
+
+        present[:] = False
+        present[indexes[b]] = True
+
+        for a in use_index:
+            if a == b:
+                continue
+
+            found = present[indexes[a]]
+            hits[(a, b)] = countAbove(sites[a][1][found], n_maxes[a])
+
+    return hits
+
+
+def trackName(filename):
+    ''' Name of the track for a BAM file, as used in file names
+    elsewhere in the pipeline '''
+
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def countContig(samfiles, crosslinks, contig, use_index, max_level=0,
+                pairwise=False, dtype="uint16"):
+    ''' Calculate reproducibility for one contig, a (name, length) tuple.
+    Returns a list of (sample, key, totals, hits) tuples, where totals and
+    hits are arrays with an entry for each level. key is the fold, or the
+    other sample if pairwise is True '''
+
+    ref, length = contig
+    E.debug("Starting %s, length %i" % (ref, length))
+
+    sites = []
+
+    for sf in range(len(samfiles)):
+        E.debug("Reading File %s" % samfiles[sf].filename)
+        pos_depth, neg_depth, counter = iCLIP.contigProfiles(
+            samfiles[sf], ref, length, crosslinks[sf], dtype)
+
+        sites.append(contigSites(pos_depth, neg_depth, length))
+
+    if sum(len(positions) for positions, depths in sites) == 0:
+        E.warn("Zero max depth for all samples")
+        return []
+
+    n_maxes = {}
+    for sf in use_index:
+
+        depths = sites[sf][1]
+        max_depth = int(depths.max()) if len(depths) > 0 else 0
+        E.debug("Max depth for %s is %i" % (samfiles[sf].filename, max_depth))
+
+        if int(max_level) == 0:
+            n_maxes[sf] = max_depth
+        else:
+            n_maxes[sf] = int(max_level)
+
+    results = []
+
+    if pairwise:
+
+        E.debug("Calculating pairwise reproducibility")
+        pair_hits = pairwiseHits(sites, use_index, n_maxes)
+
+        for sf in use_index:
+            totals = countAbove(sites[sf][1], n_maxes[sf])
+            for other in range(len(samfiles)):
+                if other != sf:
+                    results.append((sf, other, totals,
+                                    pair_hits[(sf, other)]))
+
+        return results
+
+    replicating = replicatingSamples(sites)
+
+    for sf in use_index:
+
+        E.debug("Calculating reproducibility for levels up to %i for "
+                "file %s" % (n_maxes[sf], samfiles[sf].filename))
+
+        totals, hits = levelCounts(sites[sf][1], replicating[sf],
+                                   n_maxes[sf], len(samfiles) - 1)
+
+        for i in range(len(samfiles) - 1):
+            results.append((sf, i, totals, hits[i]))
+
+    return results
+
+
+def mergeOutputs(filenames):
+    ''' Sum the hits and totals of the outputs of several runs, for
+    example on different contigs. Returns the header and the summed
+    rows, with the levels of each track and fold (or second file) in
+    order '''
+
+    header = None
+    sums = collections.OrderedDict()
+
+    for filename in filenames:
+        with IOTools.openFile(filename) as inf:
+            file_header = inf.readline().rstrip("\n").split("\t")
+            if header is None:
+                header = file_header
+            elif file_header != header:
+                raise ValueError("%s has columns %s, expected %s"
+                                 % (filename, file_header, header))
+
+            for line in inf:
+                fields = line.rstrip("\n").split("\t")
+                key = tuple(fields[:-2])
+                if key not in sums:
+                    sums[key] = [0, 0]
+                sums[key][0] += int(fields[-2])
+                sums[key][1] += int(fields[-1])
+
+    if header is None:
+        raise ValueError("No outputs to merge")
+
+    # levels found in later files are sorted in with those from earlier
+    # files, as if all contigs had been counted together
+    order = {}
+    for key in sums:
+        order.setdefault(key[:-1], len(order))
+
+    def _sortKey(key):
+        return (order[key[:-1]], int(key[-1]))
+
+    rows = [list(key) + sums[key] for key in sorted(sums, key=_sortKey)]
+
+    return header, rows
+
+
+# Per process state for worker processes. Each worker holds its own handles
+# on the BAM files and crosslink indexes.
+_worker = {}
+
+
+def _initWorker(filenames, decompression_threads, use_index, max_level,
+                pairwise, dtype):
+
+    _worker["samfiles"] = [iCLIP.openBam(fn, decompression_threads)
+                           for fn in filenames]
+    _worker["crosslinks"] = [iCLIP.findCrosslinkIndex(fn) for fn in filenames]
+    _worker["args"] = (use_index, max_level, pairwise, dtype)
+
+
+def _countContig(contig):
+
+    return countContig(_worker["samfiles"], _worker["crosslinks"], contig,
+                       *_worker["args"])
 
 
 def main(argv=None):
@@ -92,17 +335,44 @@ def main(argv=None):
                        help="Restrict analysis to one of the input samples vs."
                             "all the others",
                        default=None)
+    parser.add_option("-p", "--pairwise", dest="pairwise",
+                      action="store_true", default=False,
+                      help="Calculate reproducibility between every pair "
+                           "of input samples, rather than against all the "
+                           "others")
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of processes to divide contigs between "
+                           "[%default]")
+    parser.add_option("--decompression-threads",
+                      dest="decompression_threads", type="int", default=1,
+                      help="Number of threads to decompress each BAM file "
+                           "with, in each process [%default]")
+    parser.add_option("--merge", dest="merge", action="store_true",
+                      default=False,
+                      help="Sum the outputs of previous runs, given as "
+                           "arguments, rather than calculating from BAM files")
         
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
-    samfiles = [pysam.Samfile(fn, 'rb') for fn in args]
-    total_counter = [E.Counter() for samfile in samfiles]
-    running_totals = {sf: [collections.defaultdict(int)
-                           for x in range(len(args) - 1)]
+    if options.merge:
+        header, outlines = mergeOutputs(args)
+        outlines = "\n".join(["\t".join(map(str, line)) for line in outlines])
+        options.stdout.write("\t".join(header) + "\n" + outlines + "\n")
+        E.Stop()
+        return
+
+    samfiles = [iCLIP.openBam(fn, options.decompression_threads)
+                for fn in args]
+    crosslinks = [iCLIP.findCrosslinkIndex(fn) for fn in args]
+
+    # totals and hits for each sample, by fold, or by other sample if
+    # pairwise, and level
+    running_totals = {sf: collections.defaultdict(
+                          lambda: collections.defaultdict(int))
                       for sf in args}
-    running_hits = {sf: [collections.defaultdict(int)
-                         for x in range(len(args) - 1)]
+    running_hits = {sf: collections.defaultdict(
+                        lambda: collections.defaultdict(int))
                     for sf in args}
 
     contigs = zip(samfiles[0].references, samfiles[0].lengths)
@@ -118,74 +388,59 @@ def main(argv=None):
 
     E.debug("Reporting on input(s) %s: %s" %(",".join(map(str,use_index)),",".join(use_names)))
 
-    for ref, length in contigs:
-
-        E.debug("Starting %s, length %i" % (ref, length))
-
-        depths = pd.DataFrame(dtype=options.dtype)
-
-        for sf in range(len(samfiles)):
-            E.debug("Reading File %s" % args[sf])
-            pos_depth, neg_depth, counter = \
-                iCLIP.countChr(samfiles[sf].fetch(ref), length, options.dtype)
-            #(depths[:length, sf], depths[length:, sf], counter) = \
-            #    iCLIP.countChr(samfiles[sf].fetch(ref), length, options.dtype)
-            
-            neg_depth.index = neg_depth.index + length
-            depth = pd.concat([pos_depth, neg_depth])
-            depth.name = args[sf]
-            
-            depths = depths.join(depth, how="outer")
-            total_counter[sf] += counter
-        
-        depths = depths.fillna(0)
-
-        for sf in use_index:
-        
-            try:
-                E.debug("Max depth for %s is %i" % 
-                        (args[sf], int(depths.iloc[:, sf].max())))
-            except ValueError:
-                E.warn("Zero max depth for both")
-                continue
-
-
-
-            if int(options.max_level) == 0:
-                n_max = int(depths.iloc[:, sf].max())
-            else:
-                n_max = int(options.max_level)
-
-            for n in range(n_max):
-
-                E.debug("Calculating %i level reproducibility for file %s"
-                        % (n, args[sf]))
-
-                sites = depths.iloc[:, sf] > n
-                for i in range(len(args) - 1):
-                    running_totals[args[sf]][i][n] += sites.sum()
-                
-                replicating_sites = \
-                    depths.ix[sites, np.arange(len(samfiles)) != sf] > 0
-                n_replicating_samples = replicating_sites.sum(axis=1)
-
-                for i in range(len(args) - 1):
-                    running_hits[args[sf]][i][n] += \
-                        (n_replicating_samples > i).sum()
-                del sites
-                del replicating_sites
-                del n_replicating_samples
-
-        del depths
+    count_args = (use_index, options.max_level, options.pairwise,
+                  options.dtype)
+
+    if options.threads > 1:
+        E.info("Counting contigs using %i processes" % options.threads)
+        pool = multiprocessing.Pool(options.threads,
+                                    initializer=_initWorker,
+                                    initargs=(args,
+                                              options.decompression_threads)
+                                    + count_args)
+        results = pool.imap_unordered(_countContig, contigs)
+    else:
+        pool = None
+        results = (countContig(samfiles, crosslinks, contig, *count_args)
+                   for contig in contigs)
+
+    # reduce the counts for each contig
+    for contig_results in results:
+        for sf, key, totals, hits in contig_results:
+            if options.pairwise:
+                key = args[key]
+            for n in range(len(totals)):
+                running_totals[args[sf]][key][n] += totals[n]
+                running_hits[args[sf]][key][n] += hits[n]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     outlines = []
-    for sf in use_names:
-        for i in range(len(running_totals[sf])):
-            for n in running_totals[sf][i]:
-                outlines.append([os.path.basename(sf), i+1, n+1, running_hits[sf][i][n],
-                                 running_totals[sf][i][n]])
+    if options.pairwise:
+        # one row for each ordered pair of samples, in the same format
+        # as when each pair is run separately
+        for sf in use_names:
+            for other in args:
+                if other == sf:
+                    continue
+                for n in sorted(running_totals[sf][other]):
+                    outlines.append([trackName(sf), trackName(other),
+                                     os.path.basename(sf), 1, n+1,
+                                     running_hits[sf][other][n],
+                                     running_totals[sf][other][n]])
+
+        header = ["File1", "File2", "Track", "fold", "level", "hits",
+                  "totals"]
+    else:
+        for sf in use_names:
+            for i in range(len(args) - 1):
+                for n in sorted(running_totals[sf][i]):
+                    outlines.append([os.path.basename(sf), i+1, n+1, running_hits[sf][i][n],
+                                     running_totals[sf][i][n]])
 
-    header = ["Track", "fold", "level", "hits", "totals"]
+        header = ["Track", "fold", "level", "hits", "totals"]
 
     outlines = "\n".join(["\t".join(map(str, line)) for line in outlines])
     outlines = "\t".join(header) + "\n" + outlines + "\n"
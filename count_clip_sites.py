@@ -17,6 +17,28 @@ Usage
 
 python count_clip_sites.py BAMFILE [OPTIONS]
 
+If a crosslink index (see build_crosslink_index.py) exists for BAMFILE,
+counts are read from it rather than from the BAM file.
+
+Features are read from a GTF file on stdin, or from a geneset store
+(see build_geneset_store.py) given with --geneset-store.
+
+By default features of one type (--feature) are counted, each fetched
+from the BAM file seperately. --features counts several levels, for
+example --features=gene,transcript,exon, in a single pass: the features are
+indexed by contig, and each contig's crosslinks counted once and summed
+over every feature interval using prefix sums. Rows, with a leading
+feature column, are written as each contig is finished, so are in contig
+order rather than input order. GTF input must be sorted by gene. Extra
+columns can be added with:
+
+--antisense        Counts of crosslinks on the opposite strand to each
+                   feature.
+
+--split-sites      Counts of crosslinks from truncated reads and from
+                   reads with deletions (see iCLIP.getCrosslink). The type
+                   of site is not stored in crosslink indexes, so the BAM
+                   file is always read.
 
 .. Example use case
 
@@ -36,6 +58,9 @@ Command line options
 '''
 
 import sys
+import itertools
+import collections
+import numpy as np
 import CGAT.Experiment as E
 import CGAT.GTF as GTF
 import CGAT.Intervals as Intervals
@@ -43,62 +68,259 @@ import iCLIP
 import pysam
 
 
-def main(argv=None):
-    """script main.
-    parses command line options in sys.argv, unless *argv* is given.
-    """
+def contigCrosslinks(bamfile, contig, split_sites=False):
+    ''' Sorted crosslink positions and counts for contig, from either
+    an open BAM file, which is read once for the whole contig, or a
+    CrosslinkCounts object. Returns a dictionary of (positions, counts)
+    tuples keyed on (strand, category), where category is "all" or, with
+    split_sites, "truncated" or "deletion" '''
+
+    if isinstance(bamfile, iCLIP.CrosslinkCounts):
+        if contig not in bamfile:
+            return {}
+
+        return {(strand, "all"): (bamfile[(contig, strand)].positions,
+                                  bamfile[(contig, strand)].counts)
+                for strand in ("+", "-")}
+
+    try:
+        reads = bamfile.fetch(contig)
+    except ValueError as e:
+        E.debug(e)
+        return {}
+
+    arrays = collections.defaultdict(list)
+    for positions, is_reverse, is_deletion in \
+            iCLIP.iterCrosslinkBatches(reads):
 
-    if argv is None:
-        argv = sys.argv
+        for strand, on_strand in (("+", ~is_reverse), ("-", is_reverse)):
+            arrays[(strand, "all")].append(
+                iCLIP.countPositions(positions[on_strand]))
 
-    # setup command line parser
-    parser = E.OptionParser(version="%prog version: $Id$",
-                            usage=globals()["__doc__"])
+            if split_sites:
+                arrays[(strand, "truncated")].append(
+                    iCLIP.countPositions(positions[on_strand & ~is_deletion]))
+                arrays[(strand, "deletion")].append(
+                    iCLIP.countPositions(positions[on_strand & is_deletion]))
 
-    parser.add_option("-f", "--feature", dest="feature", type="choice",
-                      choices=["gene", "transcript", "exon"],
-                      default="transcript",
-                      help="supply help")
+    return {key: iCLIP.mergePositionCounts(value)
+            for key, value in arrays.items()}
+
+
+def sumIntervals(positions, counts, starts, ends):
+    ''' Sum the counts at sorted positions in each of the half open
+    intervals [starts, ends), using a prefix sum of the counts, so that each
+    interval takes two binary searches '''
+
+    cumulative = np.zeros(len(counts) + 1, dtype="int64")
+    np.cumsum(counts, out=cumulative[1:])
+
+    return (cumulative[np.searchsorted(positions, ends)] -
+            cumulative[np.searchsorted(positions, starts)])
+
+
+class FeatureIndex:
+    ''' The exon and intron intervals of the features on one contig,
+    as arrays, so that the crosslinks in all of them can be counted at
+    once '''
+
+    def __init__(self):
+
+        self.rows = []
+        self.strands = []
+        self.has_introns = []
+        self.intervals = {"exon": ([], [], []), "intron": ([], [], [])}
+
+    def add(self, row, strand, exons, introns=None):
+        ''' Add a feature, with the fields to output for it in row.
+        Features without introns, such as exons, have intron counts of
+        NA '''
+
+        index = len(self.rows)
+        self.rows.append(row)
+        self.strands.append(strand)
+        self.has_introns.append(introns is not None)
+
+        for region, intervals in (("exon", exons), ("intron", introns)):
+            if intervals is None:
+                continue
+            starts, ends, indexes = self.intervals[region]
+            for start, end in intervals:
+                starts.append(start)
+                ends.append(end)
+                indexes.append(index)
+
+    def count(self, crosslinks, category="all", antisense=False):
+        ''' Count the crosslinks of category in the exons and introns of
+        each feature, on the same strand as the feature, or the opposite
+        strand if antisense is True. Features with no strand count both
+        strands, or nothing if antisense is True. Returns arrays of the
+        exon and intron counts of each feature '''
+
+        empty = (np.array([], dtype="int64"), np.array([], dtype="int64"))
+        strands = np.array(self.strands)
+        results = []
 
-    # add common options (-h/--help, ...) and parse command line
-    (options, args) = E.Start(parser, argv=argv)
+        for region in ("exon", "intron"):
+            starts, ends, indexes = [np.array(x, dtype="int64")
+                                     for x in self.intervals[region]]
+            totals = np.zeros(len(self.rows), dtype="int64")
+
+            for xlink_strand in ("+", "-"):
+                if antisense:
+                    selected = strands[indexes] == \
+                        {"+": "-", "-": "+"}[xlink_strand]
+                else:
+                    selected = strands[indexes] != \
+                        {"+": "-", "-": "+"}[xlink_strand]
+
+                positions, counts = crosslinks.get(
+                    (xlink_strand, category), empty)
+
+                if len(positions) == 0 or not selected.any():
+                    continue
+
+                totals += np.bincount(
+                    indexes[selected],
+                    weights=sumIntervals(positions, counts,
+                                         starts[selected], ends[selected]),
+                    minlength=len(self.rows)).astype("int64")
+
+            results.append(totals)
+
+        return results
+
+
+def indexFeatures(genes, levels):
+    ''' Build a FeatureIndex for each contig from an iterator over
+    genes, adding a row for each feature at the requested levels '''
+
+    index = collections.defaultdict(FeatureIndex)
+
+    for gene in genes:
+        entries = list(itertools.chain.from_iterable(gene))
+        contig = entries[0].contig
+        strand = entries[0].strand
+        gene_id = entries[0].gene_id
 
-    iterator = GTF.iterator(options.stdin)
+        if "gene" in levels:
+            exons = GTF.asRanges(entries, "exon")
+            index[contig].add(["gene", gene_id, "NA", "NA"], strand,
+                              exons, Intervals.complement(exons))
+
+        if "transcript" in levels:
+            for transcript in gene:
+                exons = GTF.asRanges(transcript, "exon")
+                index[contig].add(
+                    ["transcript", gene_id, transcript[0].transcript_id,
+                     "NA"],
+                    strand, exons, Intervals.complement(exons))
+
+        if "exon" in levels:
+            for exon in entries:
+                if exon.feature != "exon":
+                    continue
+                index[contig].add(
+                    ["exon", gene_id, exon.transcript_id,
+                     iCLIP.entryAttributes(exon).get("exon_id", "NA")],
+                    strand, [(exon.start, exon.end)])
+
+    return index
+
+
+def countFeatureLevels(bamfile, contigs, genes, levels, outfile,
+                       antisense=False, split_sites=False):
+    ''' Count crosslinks in the features at each level in levels, reading
+    the crosslinks of each contig once, and write a row for each feature
+    to outfile as each contig is finished '''
+
+    index = indexFeatures(genes, levels)
+
+    header = ["feature", "gene_id", "transcript_id", "exon_id",
+              "exon_count", "intron_count"]
+    columns = [("all", False)]
+
+    if antisense:
+        header.extend(["exon_antisense_count", "intron_antisense_count"])
+        columns.append(("all", True))
+
+    if split_sites:
+        header.extend(["exon_truncated_count", "intron_truncated_count",
+                       "exon_deletion_count", "intron_deletion_count"])
+        columns.extend([("truncated", False), ("deletion", False)])
+
+    outfile.write("\t".join(header) + "\n")
+
+    # contigs in the order of the BAM file, then any only in the features
+    contigs = [contig for contig in contigs if contig in index] + \
+        sorted(set(index) - set(contigs))
 
-    if options.feature == "gene":
-        iterator = GTF.flat_gene_iterator(iterator)
-    elif options.feature == "transcript":
-        iterator = GTF.transcript_iterator(iterator)
-    elif options.feature == "exon":
-        def _exon_iterator(gff_iterator):
-            for exon in gff_iterator:
-                yield [exon]
-        iterator = _exon_iterator(iterator)
+    for contig in contigs:
+        E.debug("Counting features on %s" % contig)
+
+        crosslinks = contigCrosslinks(bamfile, contig, split_sites)
+        features = index.pop(contig)
+
+        counts = [features.count(crosslinks, category, on_antisense)
+                  for category, on_antisense in columns]
+
+        for i, row in enumerate(features.rows):
+            for exon_counts, intron_counts in counts:
+                row.append(str(exon_counts[i]))
+                if features.has_introns[i]:
+                    row.append(str(intron_counts[i]))
+                else:
+                    row.append("NA")
+
+            outfile.write("\t".join(row) + "\n")
+
+
+def countFeatures(bamfile, features, feature_type):
+    ''' Count the crosslinks in the exons and introns of each feature,
+    a list of GTF entries, from bamfile, an open BAM file or a
+    CrosslinkCounts object. Returns a list of gene_id, transcript_id,
+    exon_id, exon count and intron count fields for each feature.
+    Features of feature_type "exon" have intron counts of NA. Features
+    without exon entries, such as CDS rows when counting exons, have
+    counts of 0 '''
 
-    bamfile = pysam.AlignmentFile(args[0])
     outlines = []
-    for feature in iterator:
+    for feature in features:
         exons = GTF.asRanges(feature, "exon")
 
-        exon_counts = iCLIP.count_intervals(bamfile,
+        if len(exons) > 0:
+            # fetch the crosslinks in the feature once for both the exon
+            # and intron counts
+            profile = iCLIP.regionProfile(bamfile,
+                                          feature[0].contig,
+                                          exons[0][0],
+                                          exons[-1][1],
+                                          feature[0].strand,
+                                          dtype="uint32")
+        else:
+            profile = iCLIP.StrandProfile([], [], dtype="uint32",
+                                          sparse=True)
+
+        exon_counts = iCLIP.count_intervals(profile,
                                             exons,
                                             feature[0].contig,
                                             feature[0].strand,
                                             dtype="uint32")
 
-        exon_counts = exon_counts.sum()
+        exon_counts = int(exon_counts.sum())
 
         introns = Intervals.complement(exons)
-        intron_counts = iCLIP.count_intervals(bamfile,
+        intron_counts = iCLIP.count_intervals(profile,
                                               introns,
                                               feature[0].contig,
                                               feature[0].strand,
                                               dtype="uint32")
 
-        intron_counts = intron_counts.sum()
+        intron_counts = int(intron_counts.sum())
 
-        if options.feature == "exon":
-            exon_id = feature[0].exon_id
+        if feature_type == "exon":
+            exon_id = iCLIP.entryAttributes(feature[0]).get("exon_id",
+                                                          "NA")
             gene_id = feature[0].gene_id
             transcript_id = feature[0].transcript_id
             intron_counts = "NA"
@@ -113,6 +335,103 @@ def main(argv=None):
                          str(exon_counts),
                          str(intron_counts)])
 
+    return outlines
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-f", "--feature", dest="feature", type="choice",
+                      choices=["gene", "transcript", "exon"],
+                      default="transcript",
+                      help="supply help")
+
+    parser.add_option("--geneset-store", dest="geneset_store",
+                      type="string", default=None,
+                      help="Read features from this geneset store (see "
+                           "build_geneset_store.py) rather than a GTF on "
+                           "stdin")
+
+    parser.add_option("--features", dest="features", type="string",
+                      default=None,
+                      help="Comma seperated list of levels (gene, "
+                           "transcript, exon) to count in a single pass "
+                           "over the BAM file")
+
+    parser.add_option("--antisense", dest="antisense", action="store_true",
+                      default=False,
+                      help="With --features, also count crosslinks on the "
+                           "opposite strand")
+
+    parser.add_option("--split-sites", dest="split_sites",
+                      action="store_true", default=False,
+                      help="With --features, also count truncation and "
+                           "deletion sites seperately")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.features:
+        levels = options.features.split(",")
+        for level in levels:
+            if level not in ("gene", "transcript", "exon"):
+                raise ValueError("Unknown feature level %s" % level)
+
+        if options.geneset_store:
+            genes = iCLIP.GenesetStore(options.geneset_store).iterGenes()
+        else:
+            genes = GTF.gene_iterator(GTF.iterator(options.stdin))
+
+        bamfile = None
+        if not options.split_sites:
+            bamfile = iCLIP.findCrosslinkIndex(args[0])
+
+        if bamfile is None:
+            bamfile = pysam.AlignmentFile(args[0])
+            contigs = list(bamfile.references)
+        else:
+            contigs = bamfile.contigs
+
+        countFeatureLevels(bamfile, contigs, genes, levels, options.stdout,
+                           antisense=options.antisense,
+                           split_sites=options.split_sites)
+
+        E.Stop()
+        return
+
+    # entries from a store are in the order of the GTF file
+    if options.geneset_store:
+        store = iCLIP.GenesetStore(options.geneset_store)
+        iterator = itertools.chain.from_iterable(store.iterTranscripts())
+    else:
+        iterator = GTF.iterator(options.stdin)
+
+    if options.feature == "gene":
+        iterator = GTF.flat_gene_iterator(iterator)
+    elif options.feature == "transcript":
+        iterator = GTF.transcript_iterator(iterator)
+    elif options.feature == "exon":
+        def _exon_iterator(gff_iterator):
+            for exon in gff_iterator:
+                yield [exon]
+        iterator = _exon_iterator(iterator)
+
+    # use the crosslink index for the bamfile if one has been built
+    bamfile = iCLIP.findCrosslinkIndex(args[0])
+    if bamfile is None:
+        bamfile = pysam.AlignmentFile(args[0])
+
+    outlines = countFeatures(bamfile, iterator, options.feature)
+
     options.stdout.write("\t".join(["gene_id",
                                     "transcript_id",
                                     "exon_id",
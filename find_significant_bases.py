@@ -84,10 +84,45 @@ Options
 -f, --fdr:     Compute an BH FDR correction on the results.
                Implies not --pipeout.
 
+--average:     How p-values are averaged accross the transcripts of a
+               gene. "stream" (the default) adds each transcript to a running
+               mean as it is calculated. "table" builds a table with a column
+               for every transcript first, which uses much more memory for
+               genes with many isoforms. Results are the same.
+
+--spill:       With --fdr (or when not --pipeout), spill p-values to
+               temporary files as they are calculated, rather than holding
+               them all in memory. The BH correction is then calculated by an
+               external sort of the spilled p-values, and genes re-read one
+               at a time for output, so memory use is proportional to one
+               gene rather than the genome. Bases are output in gene order
+               rather than sorted on position. Temporary files are written
+               to --tmpdir.
+
+--output-bigwig: Also write the (corrected) p-values of bases as -log10(p)
+               to a bigWig file for each strand, OUTPUT_BIGWIG_plus.bw and
+               OUTPUT_BIGWIG_minus.bw, for viewing in a genome browser.
+               Where bases are in more than one gene, the smallest p-value
+               is used. As for iCLIP2bigWig.py, minus strand values are
+               negative. With --spill or --pipeout, the values for the tracks
+               are also spilled to --tmpdir, and read back a contig at a time
+               to write the bigWig files.
+
 -t, --dtype:   The numpy dtype to use for storing counts. The default is
                uint32. Smaller types will use less memory, but run the risk of
                integer overflow (detected).
 
+--threads:     Number of processes to use. Genes are divided into chunks,
+               either of --chunk-size genes or by contig (--chunk-by=contig),
+               and p-values calculated for each chunk in a separate process
+               with its own handle on the BAM file. Results are merged in
+               input order, so output, including the FDR correction, is the
+               same as with a single process. At most two chunks per process
+               are in flight at once, so genes are read, and results output,
+               as processing proceeds. --chunk-by=contig requires genes
+               sorted by contig (for example with gtf2gtf.py
+               --method=sort --sort-order=contig+gene).
+
 -
 Usage
 -----
@@ -102,6 +137,16 @@ Usage::
 
    python find_significant_bases.py [OPTIONS] BAMFILE < GTFFILE
 
+If a crosslink index (see build_crosslink_index.py) exists for BAMFILE,
+counts are read from it rather than from the BAM file.
+
+Genes can be read from a geneset store (see build_geneset_store.py),
+rather than from a GTF file on stdin, with --geneset-store=STOREFILE.
+Genes from a store are sorted as gtf2gtf.py --method=sort
+--sort-order=gene+transcript would sort them.
+--set-transcript-to-gene merges the transcripts of each gene, as
+gtf2gtf.py --method=set-transcript-to-gene.
+
 
 Command line options
 --------------------
@@ -117,21 +162,40 @@ import iCLIP
 import CGAT.GTF as GTF
 import CGAT.IOTools as IOTools
 import pysam
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+import cPickle as pickle
 from statsmodels.stats.multitest import multipletests
-import CGAT.Intervals as Intervals
 import CGAT.Bed as Bed
 
 
-def get_windows(pvalues, window_size, threshold):
+def get_windows(positions, pvalues, window_size):
+    '''Merge windows of window_size either side of each position and
+    find the minimum p-value in each merged window. positions must be
+    a sorted numpy array, and pvalues the matching array of p-values.
+
+    Because all windows are the same size, a window can only overlap
+    the previous one, so merged windows are found in a single pass.
+    Returns a list of ((start, end), min_p) tuples, where intervals are
+    half open '''
+
+    if len(positions) == 0:
+        return []
+
+    starts = positions - window_size
+    ends = positions + window_size + 1
 
-    # intervals are close closed
-    windows = [(pos-window_size, pos+window_size+1)
-               for pos in pvalues.index.values]
+    # windows that touch or overlap are merged
+    breaks = np.flatnonzero(starts[1:] > ends[:-1]) + 1
+    first = np.concatenate([[0], breaks]).astype("int64")
+    last = np.concatenate([breaks, [len(positions)]]).astype("int64") - 1
 
-    merged_windows = Intervals.combine(windows)
-    windows_min_p = [pvalues.ix[float(start):float(end-1)].min()
-                    for start, end in merged_windows]
-    return zip(merged_windows, windows_min_p)
+    windows_min_p = np.minimum.reduceat(pvalues, first)
+
+    return zip(zip(starts[first], ends[last]), windows_min_p)
 
 
 def windows2bed12(windows, contig, strand, name, score):
@@ -186,33 +250,32 @@ def bases_to_windows(pvalues, gene, window_size, threshold):
         return []
 
     gene_pvals = gene_pvals.sort_index()
+    positions = gene_pvals.index.values.astype("int64")
+    gene_pvals = gene_pvals.values
     outlist = []
 
     for transcript in gene:
 
-        coords_converter = iCLIP.TranscriptCoordInterconverter(transcript)
-
-        # first exons
-        exons = GTF.asRanges(transcript, "exon")
-       
-        # pandas indexing is inclusive, but our exon intervals are
-        # half closed
-        exons_pvals_list = [gene_pvals.ix[float(start):float(end-1)]
-                            for start, end in exons]
-
-        exons_pvals = pd.concat(exons_pvals_list)
-
-        exons_pvals.index = coords_converter.genome2transcript(
-            exons_pvals.index.values)
-
-        windows = get_windows(exons_pvals, window_size, threshold)
+        # first exons. Convert all the gene's bases to transcript
+        # coordinates at once, keeping those that fall in an exon
+        coords_converter = iCLIP.getTranscriptConverter(transcript)
+        exon_positions, in_exons = coords_converter.genome2transcript(
+            positions, return_mask=True)
+        exon_positions = exon_positions[in_exons]
+        ordering = np.argsort(exon_positions)
+
+        windows = get_windows(exon_positions[ordering],
+                              gene_pvals[in_exons][ordering],
+                              window_size)
         windows = [(coords_converter.transcript_interval2genome_intervals(
-            window),p) for window,p in windows]
+            window), p) for window, p in windows]
 
         # now for introns
         for intron in GTF.toIntronIntervals(transcript):
-            intron_pvals = gene_pvals.ix[float(intron[0]):float(intron[1]-1)]
-            intron_windows = get_windows(intron_pvals, window_size, threshold)
+            first, last = np.searchsorted(positions, intron)
+            intron_windows = get_windows(positions[first:last],
+                                         gene_pvals[first:last],
+                                         window_size)
             intron_windows = [((max(intron[0], start), min(intron[1], end)),p)
                               for (start, end), p in intron_windows]
             windows.extend([([window],p) for window,p in intron_windows])
@@ -230,17 +293,171 @@ def bases_to_windows(pvalues, gene, window_size, threshold):
 
     return sorted(outlist, key=lambda x: x.start)
 
-        
+
+def minPerBase(positions, pvalues):
+    ''' Sort bases on position, keeping the smallest p-value where a
+    base appears more than once, for example in overlapping genes.
+    Returns arrays of positions and p-values '''
+
+    positions = np.asarray(positions, dtype="int64")
+    pvalues = np.asarray(pvalues, dtype="float64")
+
+    # NaNs sort last, so are only kept if a base has no other p-value
+    order = np.lexsort((pvalues, positions))
+    positions = positions[order]
+    pvalues = pvalues[order]
+
+    first = np.ones(len(positions), dtype=bool)
+    first[1:] = positions[1:] != positions[:-1]
+
+    return positions[first], pvalues[first]
+
+
+class BaseTracks:
+    ''' Collects the p-values of bases by contig and strand, so that
+    they can be output sorted on position, either as a bedGraph or
+    as a -log10(p) bigWig for each strand, from arrays rather than from
+    a table indexed on strings '''
+
+    def __init__(self):
+
+        self.arrays = collections.defaultdict(list)
+
+    def add(self, contig, strand, positions, pvalues):
+
+        self.arrays[(contig, strand)].append(
+            (np.asarray(positions, dtype="int64"),
+             np.asarray(pvalues, dtype="float64")))
+
+    def addSeries(self, pvalues):
+        ''' Add a Series of p-values indexed on gene_id, contig, strand
+        and position '''
+
+        for (contig, strand), group in pvalues.groupby(
+                level=["contig", "strand"]):
+            self.add(contig, strand,
+                     group.index.get_level_values("position"),
+                     group.values)
+
+    @property
+    def contigs(self):
+        return sorted(set(contig for contig, strand in self.arrays))
+
+    def _arrays(self, contig, strand):
+
+        return self.arrays.get((contig, strand), [])
+
+    def get(self, contig, strands=("+", "-")):
+        ''' Sorted positions and the minimum p-value at each for
+        contig, over the given strands '''
+
+        arrays = [array for strand in strands
+                  for array in self._arrays(contig, strand)]
+
+        if len(arrays) == 0:
+            return np.array([], dtype="int64"), np.array([], dtype="float64")
+
+        positions, pvalues = zip(*arrays)
+        return minPerBase(np.concatenate(positions),
+                          np.concatenate(pvalues))
+
+    def writeBedGraph(self, outfile):
+        ''' Write bases, on either strand, sorted on contig and
+        position '''
+
+        for contig in self.contigs:
+            positions, pvalues = self.get(contig)
+            output = pd.DataFrame({"contig": contig,
+                                   "position": positions,
+                                   "end": positions + 1,
+                                   0: pvalues})
+            output = output[["contig", "position", "end", 0]]
+            output.to_csv(outfile,
+                          sep="\t",
+                          header=False,
+                          index=False)
+
+    def writeBigWigs(self, template, chrom_sizes):
+        ''' Write -log10(p) for each strand to TEMPLATE_plus.bw and
+        TEMPLATE_minus.bw. As for iCLIP2bigWig.py, values on the minus
+        strand are negative. chrom_sizes is a list of (contig, length)
+        tuples giving the order of contigs '''
+
+        for strand, suffix, sign in (("+", "_plus.bw", 1),
+                                     ("-", "_minus.bw", -1)):
+
+            writer = iCLIP.BigWigWriter(template + suffix, chrom_sizes)
+
+            for contig, length in chrom_sizes:
+                positions, pvalues = self.get(contig, (strand,))
+                tested = ~np.isnan(pvalues)
+                # p-values of 0 would be infinite
+                pvalues = np.maximum(pvalues[tested],
+                                     np.finfo("float64").tiny)
+                writer.addContig(contig, positions[tested],
+                                 sign * -np.log10(pvalues))
+
+            writer.close()
+
+    def close(self):
+        pass
+
+
+class SpilledTracks(BaseTracks):
+    ''' Like BaseTracks, but appends the positions and p-values of each
+    contig and strand to temporary files as they are added, rather than
+    holding them in memory. Only one contig is read back at a time, so
+    peak memory is proportional to the largest contig rather than to the
+    genome. close removes the temporary files. '''
+
+    def __init__(self, tmpdir=None):
+
+        self.tmpdir = tempfile.mkdtemp(dir=tmpdir)
+        self.files = {}
+
+    def add(self, contig, strand, positions, pvalues):
+
+        key = (contig, strand)
+        if key not in self.files:
+            self.files[key] = os.path.join(self.tmpdir,
+                                           "track%i" % len(self.files))
+
+        filename = self.files[key]
+        with open(filename + ".positions", "ab") as outf:
+            np.asarray(positions, dtype="int64").tofile(outf)
+        with open(filename + ".pvalues", "ab") as outf:
+            np.asarray(pvalues, dtype="float64").tofile(outf)
+
+    @property
+    def contigs(self):
+        return sorted(set(contig for contig, strand in self.files))
+
+    def _arrays(self, contig, strand):
+
+        if (contig, strand) not in self.files:
+            return []
+
+        filename = self.files[(contig, strand)]
+        return [(np.fromfile(filename + ".positions", dtype="int64"),
+                 np.fromfile(filename + ".pvalues", dtype="float64"))]
+
+    def close(self):
+
+        shutil.rmtree(self.tmpdir)
+
+
 class DeferredOutput:
     ''' This class looks like a file like object, but stores up all
      the objects passed for output, and outputs them all when close
     is called. Optionally performs multiple testing correction '''
 
     def __init__(self, outfile_bases=None, outfile_windows=None,
-                 correct=False, window_size=0, threshold=0.05):
+                 correct=False, window_size=0, threshold=0.05,
+                 tracks=None):
 
         self.outfile_bases = outfile_bases
         self.outfile_windows = outfile_windows
+        self.tracks = tracks
         self.output = []
  
         self.correct = correct
@@ -278,37 +495,38 @@ class DeferredOutput:
                 for bed in windows:
                     self.outfile_windows.write(str(bed) + "\n")
 
+        if self.tracks is not None:
+            self.tracks.addSeries(output)
+
         if self.outfile_bases:
             E.info("Writing bases")
-           
-            output = output.reset_index()
-            output.drop("strand", axis=1, inplace=True)
-            output.drop("gene_id", axis=1, inplace=True)
-            output = output.groupby(["contig", "position"], as_index=False).min()
-            output.position = output.position.astype("int64")
-            output["end"] = output["position"] + 1
-            output = output[["contig", "position", "end", 0]]
 
-            output.to_csv(self.outfile_bases,
-                          sep="\t",
-                          header=False,
-                          index=False)
+            if self.tracks is not None:
+                tracks = self.tracks
+            else:
+                tracks = BaseTracks()
+                tracks.addSeries(output)
 
+            tracks.writeBedGraph(self.outfile_bases)
 
 class InstantOutput:
     ''' This class looks file a file like object but takes pandas Series
     objects and outputs them to a file handle it keeps open '''
 
     def __init__(self, outfile_windows=None, outfile_bases=None,
-                 window_size=0, threshold=0.05, **kwargs):
+                 window_size=0, threshold=0.05, tracks=None, **kwargs):
 
         self.window_size = window_size
         self.threshold = threshold
         self.outfile_windows = outfile_windows
         self.outfile_bases = outfile_bases
+        self.tracks = tracks
 
     def write(self, gene_results, gene):
 
+        if self.tracks is not None:
+            self.tracks.addSeries(gene_results)
+
         if self.outfile_bases:
             gene_results = gene_results.sort_index()
             pvalues = gene_results[gene_results < self.threshold]
@@ -339,7 +557,360 @@ class InstantOutput:
             pass
 
 
-def calculateProbabilities(counts, window_size, length, start=0):
+def _mergeRuns(runs, outp, outidx, block_size):
+    ''' Merge the sorted runs of (p-value, index) pairs, writing the
+    merged p-values and indices to the open files outp and outidx.
+
+    Runs are read block_size entries at a time. No value still to be
+    read from a run can be smaller than the last value loaded from it,
+    so each round every loaded value up to the smallest such value is
+    sorted and written as one block, and emptied runs are refilled.
+    Returns the number of values merged '''
+
+    sources = [(np.memmap(run + ".p", dtype="float64", mode="r"),
+                np.memmap(run + ".idx", dtype="int64", mode="r"))
+               for run in runs if os.path.getsize(run + ".p") > 0]
+    read = [0] * len(sources)
+    loaded = [(np.array([], dtype="float64"), np.array([], dtype="int64"))
+              for source in sources]
+
+    nmerged = 0
+    while True:
+        for i, (pvalues, idx) in enumerate(sources):
+            if len(loaded[i][0]) == 0 and read[i] < len(pvalues):
+                loaded[i] = (np.array(pvalues[read[i]:read[i] + block_size]),
+                             np.array(idx[read[i]:read[i] + block_size]))
+                read[i] += len(loaded[i][0])
+
+        unread = [loaded[i][0][-1] for i, (pvalues, idx) in enumerate(sources)
+                  if read[i] < len(pvalues)]
+        bound = min(unread) if unread else np.inf
+
+        block_p, block_idx = [], []
+        for i, (pvalues, idx) in enumerate(loaded):
+            n = np.searchsorted(pvalues, bound, side="right")
+            block_p.append(pvalues[:n])
+            block_idx.append(idx[:n])
+            loaded[i] = (pvalues[n:], idx[n:])
+
+        block_p = np.concatenate(block_p)
+        block_idx = np.concatenate(block_idx)
+        if len(block_p) == 0:
+            break
+
+        order = np.lexsort((block_idx, block_p))
+        block_p[order].tofile(outp)
+        block_idx[order].tofile(outidx)
+        nmerged += len(block_p)
+
+    return nmerged
+
+
+def externalFDR(pfile, qfile, tmpdir, run_size=1000000):
+    ''' Benjamini-Hochberg correct the float64 p-values in pfile,
+    writing the corrected values, in the same order, to qfile.
+
+    This is an external sort: the p-values are sorted in runs of
+    run_size, the runs merged and BH calculated in a reverse pass over
+    the merged file, so that no more than a run is held in memory at
+    once. NaN p-values are not counted as tests and stay NaN. Gives
+    the same result as multipletests(method="fdr_bh") '''
+
+    pvalues = np.memmap(pfile, dtype="float64", mode="r")
+    qvalues = np.memmap(qfile, dtype="float64", mode="w+",
+                        shape=pvalues.shape)
+    qvalues[:] = np.nan
+
+    runs = []
+    for first in range(0, len(pvalues), run_size):
+        block = np.array(pvalues[first:first + run_size])
+        block_idx = np.arange(first, first + len(block), dtype="int64")
+        keep = ~np.isnan(block)
+        block, block_idx = block[keep], block_idx[keep]
+        order = np.argsort(block, kind="mergesort")
+
+        run = os.path.join(tmpdir, "run%i" % len(runs))
+        block[order].tofile(run + ".p")
+        block_idx[order].tofile(run + ".idx")
+        runs.append(run)
+
+    E.debug("Sorted p-values in %i runs" % len(runs))
+
+    # merge the runs into a single sorted file
+    sorted_p = os.path.join(tmpdir, "sorted.p")
+    sorted_idx = os.path.join(tmpdir, "sorted.idx")
+    # each run is read in a share of run_size, so that the merge as a
+    # whole holds about one run in memory
+    read_size = max(1, run_size // max(1, len(runs)))
+    with open(sorted_p, "wb") as outp, open(sorted_idx, "wb") as outidx:
+        ntests = _mergeRuns(runs, outp, outidx, read_size)
+
+    for run in runs:
+        os.unlink(run + ".p")
+        os.unlink(run + ".idx")
+
+    if ntests > 0:
+        sorted_pvalues = np.memmap(sorted_p, dtype="float64", mode="r")
+        sorted_idx_values = np.memmap(sorted_idx, dtype="int64", mode="r")
+
+        # q_i = min over j >= i of p_j * ntests / j, so walk backwards
+        # through the sorted values carrying the running minimum
+        running_min = 1.0
+        for last in range(ntests, 0, -run_size):
+            first = max(0, last - run_size)
+            ranks = np.arange(first + 1, last + 1, dtype="float64")
+            raw = sorted_pvalues[first:last] * ntests / ranks
+            block_q = np.minimum.accumulate(
+                np.append(raw, running_min)[::-1])[::-1][:-1]
+            running_min = block_q[0]
+            qvalues[sorted_idx_values[first:last]] = block_q
+
+        del sorted_pvalues, sorted_idx_values
+
+    os.unlink(sorted_p)
+    os.unlink(sorted_idx)
+
+    qvalues.flush()
+    del qvalues
+
+    return ntests
+
+
+class SpilledOutput:
+    ''' Like DeferredOutput, but rather than keeping every gene's
+    p-values, and every gene, in memory until close is called, spills
+    them to temporary files as they are written. On close, the optional
+    BH correction is computed by an external sort of the spilled
+    p-values (see externalFDR), and the genes are re-read one at a time
+    to output windows and bases. Peak memory is thus proportional to
+    one gene (or one sort run) rather than to the genome.
+
+    Bases are output gene by gene, in the order genes were written,
+    rather than sorted on position, and bases in overlapping genes are
+    not merged. '''
+
+    def __init__(self, outfile_bases=None, outfile_windows=None,
+                 correct=False, window_size=0, threshold=0.05,
+                 tmpdir=None, run_size=1000000, tracks=None):
+
+        self.outfile_bases = outfile_bases
+        self.outfile_windows = outfile_windows
+        self.tracks = tracks
+        self.correct = correct
+        self.window_size = window_size
+        self.threshold = threshold
+        self.run_size = run_size
+
+        self.tmpdir = tempfile.mkdtemp(dir=tmpdir)
+        self.positions_file = os.path.join(self.tmpdir, "positions")
+        self.pvalues_file = os.path.join(self.tmpdir, "pvalues")
+        self.genes_file = os.path.join(self.tmpdir, "genes")
+
+        self.positions = open(self.positions_file, "wb")
+        self.pvalues = open(self.pvalues_file, "wb")
+        self.genes = open(self.genes_file, "wb")
+        self.nbases = 0
+
+    def write(self, gene_results, gene):
+
+        positions = gene_results.index.get_level_values("position")
+        np.asarray(positions, dtype="int64").tofile(self.positions)
+        np.asarray(gene_results.values, dtype="float64").tofile(self.pvalues)
+        pickle.dump((gene, len(gene_results)), self.genes,
+                    pickle.HIGHEST_PROTOCOL)
+        self.nbases += len(gene_results)
+
+    def _iterGenes(self, positions, pvalues):
+        ''' Re-read the spilled genes, yielding each with its positions
+        and p-values '''
+
+        offset = 0
+        with open(self.genes_file, "rb") as genes:
+            while True:
+                try:
+                    gene, nbases = pickle.load(genes)
+                except EOFError:
+                    break
+
+                yield (gene,
+                       positions[offset:offset + nbases],
+                       pvalues[offset:offset + nbases])
+                offset += nbases
+
+    def close(self):
+
+        self.positions.close()
+        self.pvalues.close()
+        self.genes.close()
+
+        E.debug("spilled %i entries to %s" % (self.nbases, self.tmpdir))
+
+        if self.nbases == 0:
+            E.warning("No p-values to output")
+            shutil.rmtree(self.tmpdir)
+            return
+
+        pvalues_file = self.pvalues_file
+        if self.correct:
+            E.info("Correcting p-values using BH ...")
+            pvalues_file = os.path.join(self.tmpdir, "qvalues")
+            ntests = externalFDR(self.pvalues_file, pvalues_file,
+                                 self.tmpdir, self.run_size)
+            E.debug("corrected %i p-values" % ntests)
+
+        positions = np.memmap(self.positions_file, dtype="int64", mode="r")
+        pvalues = np.memmap(pvalues_file, dtype="float64", mode="r")
+
+        E.info("Writing output")
+
+        for gene, gene_positions, gene_pvalues in self._iterGenes(positions,
+                                                                  pvalues):
+            contig = gene[0][0].contig
+            strand = gene[0][0].strand
+            gene_id = gene[0][0].gene_id
+
+            if self.tracks is not None:
+                self.tracks.add(contig, strand, np.array(gene_positions),
+                                np.array(gene_pvalues))
+
+            if self.outfile_windows:
+                index = pd.MultiIndex.from_arrays(
+                    [[gene_id] * len(gene_positions),
+                     [contig] * len(gene_positions),
+                     [strand] * len(gene_positions),
+                     np.array(gene_positions)],
+                    names=["gene_id", "contig", "strand", "position"])
+                gene_ps = pd.Series(np.array(gene_pvalues), index=index)
+                sig_windows = gene_ps[gene_ps < self.threshold]
+                windows = bases_to_windows(sig_windows, gene,
+                                           self.window_size,
+                                           self.threshold)
+                for bed in windows:
+                    self.outfile_windows.write(str(bed) + "\n")
+
+            if self.outfile_bases:
+                output = pd.DataFrame({"contig": contig,
+                                       "position": np.array(gene_positions),
+                                       0: np.array(gene_pvalues)})
+                output = output.groupby("position", as_index=False).min()
+                output["end"] = output["position"] + 1
+                output = output[["contig", "position", "end", 0]]
+                output.to_csv(self.outfile_bases,
+                              sep="\t",
+                              header=False,
+                              index=False)
+
+        del positions, pvalues
+        shutil.rmtree(self.tmpdir)
+
+class BinomialTailCache:
+    ''' Memoised binomial upper tail probabilities, P(X > k) where
+    X ~ Bin(n, p).
+
+    The same combinations of n (total counts in a region) and p (from
+    the region length) recur for every position in a region and accross
+    regions, and most k are small. The first time an (n, p) pair is seen,
+    a table of P(X > k) is computed for k < table_size, and later
+    lookups for small k are taken from the table. Larger k fall back to
+    scipy's binom.sf. At most max_tables tables are kept, least recently
+    used tables being discarded first.
+
+    Using the survival function, rather than 1 - cdf, is also more
+    accurate for very small p-values. '''
+
+    def __init__(self, max_tables=10000, table_size=128):
+
+        self.max_tables = max_tables
+        self.table_size = table_size
+        self.tables = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.tail_lookups = 0
+
+    def _table(self, n, p):
+
+        key = (n, p)
+        try:
+            table = self.tables.pop(key)
+            self.hits += 1
+        except KeyError:
+            table = binom.sf(np.arange(min(self.table_size, n + 1)), n, p)
+            self.misses += 1
+            if len(self.tables) >= self.max_tables:
+                self.tables.popitem(last=False)
+
+        # reinsert to mark as most recently used
+        self.tables[key] = table
+        return table
+
+    def sf(self, k, n, p):
+        ''' P(X > k) for each k in the array k. p may be a scalar or an
+        array the same length as k '''
+
+        k = np.asarray(k, dtype="int64")
+        p = np.broadcast_to(np.asarray(p, dtype="float64"), k.shape)
+        n = int(n)
+
+        # P(X > k) is 1 for k < 0 and 0 for k >= n
+        result = np.where(k < 0, 1.0, 0.0)
+
+        for this_p in np.unique(p):
+            table = self._table(n, this_p)
+            use = (p == this_p) & (k >= 0) & (k < n)
+
+            in_table = use & (k < len(table))
+            result[in_table] = table[k[in_table]]
+
+            in_tail = use & (k >= len(table))
+            if in_tail.any():
+                self.tail_lookups += 1
+                result[in_tail] = binom.sf(k[in_tail], n, this_p)
+
+        # as scipy, return nan where p is not a probability (such as
+        # when a window is longer than its region)
+        result[~((p >= 0) & (p <= 1))] = np.nan
+
+        return result
+
+    def takeCounters(self):
+        ''' Return the (hits, misses, tail_lookups) counted since the last
+        call, and reset them, so that worker processes can pass their
+        counts back to the parent '''
+
+        counters = (self.hits, self.misses, self.tail_lookups)
+        self.hits = self.misses = self.tail_lookups = 0
+        return counters
+
+    def addCounters(self, hits, misses, tail_lookups):
+        ''' Add counters returned by takeCounters in another process '''
+
+        self.hits += hits
+        self.misses += misses
+        self.tail_lookups += tail_lookups
+
+    def report(self, tables_held=None):
+        ''' Log the cache hit rate. tables_held defaults to the number of
+        tables held by this cache '''
+
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return
+
+        if tables_held is None:
+            tables_held = len(self.tables)
+
+        E.info("Binomial tail cache: %i lookups, %.1f%% hits, "
+               "%i tables held, %i tail fallbacks to binom.sf"
+               % (lookups, 100.0 * self.hits / lookups, tables_held,
+                  self.tail_lookups))
+
+
+# shared by all calls to calculateProbabilities in this process
+binomial_tails = BinomialTailCache()
+
+
+def calculateProbabilities(counts, window_size, length, start=0,
+                           tails=binomial_tails):
     '''Calculates the probablity of observing the counted
     number of reads in windows of "window_size" around each
     cross-linked size.
@@ -351,11 +922,16 @@ def calculateProbabilities(counts, window_size, length, start=0):
     provided coordinates.
 
     Start allows, together with length, for only using part of
-    counts.'''
+    counts. counts must be sorted on position.
 
-    # limit to subset
-    counts = counts[(counts.index.values >= start) &
-                    (counts.index.values < (start + length))]
+    Binomial tail probabilities are looked up in tails, a
+    BinomialTailCache.'''
+
+    # limit to subset. counts are sorted on position, so the subset
+    # can be found by binary search rather than a scan
+    first, last = np.searchsorted(counts.index.values,
+                                  (start, start + length))
+    counts = counts.iloc[first:last]
     total_counts = counts.sum()
    
     # probability is counts-2 because we want P(X>=x) which is
@@ -363,34 +939,286 @@ def calculateProbabilities(counts, window_size, length, start=0):
     # that we want the p that any base in the transcript has
     # X>=x, not just this specific one.
 
-    single_base_ps = 1 - binom.cdf(counts-2, total_counts, 1.0/length)
-
-    heights = np.zeros(len(counts))
+    single_base_ps = tails.sf(counts.values.astype("int64") - 2,
+                              total_counts, 1.0/length)
 
-    window_start = np.maximum(0, counts.index.values-window_size)
-    window_end = np.minimum(start+length, counts.index.values + window_size)
+    positions = counts.index.values
+    window_start = np.maximum(0, positions-window_size)
+    window_end = np.minimum(start+length, positions + window_size)
 
     ps = (window_end - window_start + 0.0) / length
     ps = ps.astype("float64")
 
-    for i, base in enumerate(counts.index.values):
+    # The height of each window is the number of counts at positions
+    # between window_start and window_end (inclusive). Find the bounds
+    # of every window in the sorted positions and take the difference of
+    # cumulative sums, rather than summing each window seperately.
+    cumulative_counts = np.zeros(len(counts) + 1, dtype="int64")
+    np.cumsum(counts.values, out=cumulative_counts[1:])
+
+    first = np.searchsorted(positions, window_start, side="left")
+    last = np.searchsorted(positions, window_end, side="right")
+
+    heights = (cumulative_counts[last] -
+               cumulative_counts[first]).astype("float64")
 
-        try:
-            window = counts[window_start[i]:window_end[i]]
-        except KeyError:
-            print (window_start, window_end)
-            print counts
-  
-        heights[i] = window.sum()
-       
     heights = heights - counts.values
-    window_ps = pd.Series(1 - binom.cdf(heights - 1, total_counts, ps),
+    window_ps = pd.Series(tails.sf(heights - 1, total_counts, ps),
                           index=counts.index)
 
     # correct for number of independent windows.
     return window_ps*single_base_ps
 
 
+def openCrosslinks(bamfile):
+    ''' Open the crosslink index for bamfile if one has been built,
+    otherwise open the BAM file itself '''
+
+    crosslinks = iCLIP.findCrosslinkIndex(bamfile)
+    if crosslinks is None:
+        return pysam.Samfile(bamfile)
+
+    return crosslinks
+
+
+class TranscriptMean:
+    ''' Accumulates the mean, over transcripts, of the p-value at each
+    crosslinked base of a gene, one transcript at a time. Equivalent to
+    building a table with a column of p-values for each transcript and
+    taking the row means, but only holds one row per base.
+
+    positions must be the sorted genome coordinates of every base that
+    may be added. As DataFrame.mean, NaN values are skipped. '''
+
+    def __init__(self, positions):
+
+        self.positions = np.asarray(positions)
+        self.sums = np.zeros(len(self.positions), dtype="float64")
+        self.n = np.zeros(len(self.positions), dtype="int64")
+        self.seen = np.zeros(len(self.positions), dtype=bool)
+
+    def add(self, pvalues):
+        ''' Add a Series of p-values indexed on genome position '''
+
+        found = np.searchsorted(self.positions, pvalues.index.values)
+        values = pvalues.values.astype("float64")
+        valid = ~np.isnan(values)
+
+        self.seen[found] = True
+        np.add.at(self.sums, found[valid], values[valid])
+        np.add.at(self.n, found[valid], 1)
+
+    def mean(self):
+        ''' Returns the positions added and the mean at each '''
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums[self.seen] / self.n[self.seen]
+
+        return self.positions[self.seen], means
+
+
+def calculateGenePValues(gene, bamfile, grouping, window_size, dtype,
+                         average="stream"):
+    ''' Calculate p-values for each crosslinked base in each transcript
+    of gene, and average them accross the transcripts.
+
+    Crosslinks are counted once for the whole gene, and the counts for
+    each transcript taken from those. With average="stream" transcripts
+    are averaged as they are calculated (see TranscriptMean), with
+    average="table" a table of every transcript's p-values is built
+    first.
+
+    Returns a Series indexed on gene_id, contig, strand and position, and
+    the gene (which will have been merged if grouping is "all") '''
+
+    if grouping == "all":
+        gene = list(GTF.merged_gene_iterator(gene))
+
+    gene_profile = iCLIP.GeneProfile(bamfile, gene, dtype)
+
+    if average == "table":
+        transcript_ps = {}
+    else:
+        transcript_mean = TranscriptMean(gene_profile.positions)
+
+    for transcript in gene:
+        
+        # E.debug("Transcript is %s" % transcript[0].transcript_id)
+        coords_converter = iCLIP.getTranscriptConverter(transcript)
+        counts = gene_profile.transcriptCounts(transcript)
+        cds = GTF.asRanges(transcript, "CDS")
+
+        if grouping == "utrs" and len(cds) > 0:
+            
+            cds_interval = (cds[0][0], cds[-1][1])
+            cds_interval = coords_converter.genome2transcript(cds_interval)
+            cds_interval.sort()
+            cds_length = cds_interval[1] - cds_interval[0]
+
+            p_intervals = [(0, cds_interval[0]),
+                           (cds_interval[0], cds_length),
+                           (cds_interval[1], coords_converter.length - cds_interval[1])]
+
+        else:  # do not group by cds or there is no cds
+            p_intervals = [(0, coords_converter.length)]
+
+        p_values = [calculateProbabilities(counts, window_size,
+                                           length=length, start=start)
+                    for start, length in p_intervals
+                    if length > 0]
+  
+        if len(p_values) > 1:
+            p_values = pd.concat(p_values)
+        else:
+            p_values = p_values[0]
+
+        p_values.index = coords_converter.transcript2genome(p_values.index.values)
+ 
+ 
+        intron_intervals = GTF.toIntronIntervals(transcript)
+        
+        if len(intron_intervals) > 0:
+            intron_coords = iCLIP.getTranscriptConverter(transcript,
+                                                         introns=True)
+            intron_counts = gene_profile.transcriptCounts(transcript,
+                                                          introns=True)
+            intron_pvalues = calculateProbabilities(intron_counts,
+                                                    window_size,
+                                                    intron_coords.length)
+                                                    
+            intron_pvalues.index = intron_coords.transcript2genome(
+                intron_pvalues.index.values)
+            p_values = p_values.append(intron_pvalues)
+
+        if average == "table":
+            transcript_ps[transcript[0].transcript_id] = p_values
+        else:
+            transcript_mean.add(p_values)
+
+    if average == "table":
+        transcript_df = pd.DataFrame(transcript_ps)
+        positions = transcript_df.index.values
+        means = transcript_df.mean(1).values
+    else:
+        positions, means = transcript_mean.mean()
+
+    index = pd.MultiIndex.from_arrays(
+        [[gene[0][0].gene_id] * len(positions),
+         [gene[0][0].contig] * len(positions),
+         [gene[0][0].strand] * len(positions),
+         positions],
+        names=["gene_id", "contig", "strand", "position"])
+    gene_ps = pd.Series(means, index=index)
+
+    return gene_ps, gene
+
+
+def chunkGenes(genes, chunk_by="genes", chunk_size=100):
+    ''' Partition genes into chunks for processing in parallel. Chunks
+    contain either chunk_size consecutive genes, or (chunk_by="contig")
+    all the genes on a contig. Yields lists of (i, gene) tuples, where i
+    is the position of the gene in the input.
+
+    Chunking by contig requires genes sorted by contig, so that each
+    contig can be yielded as soon as it ends. ValueError is raised if a
+    contig is seen again after another. '''
+
+    if chunk_by == "contig":
+        finished = set()
+        chunk = []
+        for i, gene in enumerate(genes):
+            contig = gene[0][0].contig
+
+            if len(chunk) > 0 and contig != chunk[0][1][0][0].contig:
+                finished.add(chunk[0][1][0][0].contig)
+                yield chunk
+                chunk = []
+
+            if contig in finished:
+                raise ValueError(
+                    "Genes must be sorted by contig to chunk by contig, "
+                    "but contig %s is seen again after other contigs"
+                    % contig)
+
+            chunk.append((i, gene))
+
+        if len(chunk) > 0:
+            yield chunk
+
+    else:
+        chunk = []
+        for i, gene in enumerate(genes):
+            chunk.append((i, gene))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if len(chunk) > 0:
+            yield chunk
+
+
+def imapBounded(pool, func, iterable, window):
+    ''' As pool.imap, yielding the results of func on each item of
+    iterable in order, but with no more than window items submitted
+    ahead of the result being yielded. Unlike imap, which reads the
+    whole of iterable as fast as it can, the input is read no faster
+    than results are consumed, and no more than window results are
+    waiting at once. '''
+
+    pending = collections.deque()
+
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+# Per process state for worker processes. Each worker holds its own handle
+# on the BAM file or crosslink index.
+_worker = {}
+
+
+def _initWorker(bamfile, grouping, window_size, dtype, average):
+
+    _worker["bamfile"] = openCrosslinks(bamfile)
+    _worker["grouping"] = grouping
+    _worker["window_size"] = window_size
+    _worker["dtype"] = dtype
+    _worker["average"] = average
+
+
+def _processChunk(chunk):
+    ''' Returns the results for the genes of chunk, with this worker's
+    binomial tail cache counters for the chunk, its process id and the
+    number of tables its cache holds '''
+
+    results = [(i,) + calculateGenePValues(gene,
+                                           _worker["bamfile"],
+                                           _worker["grouping"],
+                                           _worker["window_size"],
+                                           _worker["dtype"],
+                                           _worker["average"])
+               for i, gene in chunk]
+
+    return (results, binomial_tails.takeCounters(), os.getpid(),
+            len(binomial_tails.tables))
+
+
+def _mergeChunks(chunks, tails, tables_held):
+    ''' Yields the results of each chunk returned by _processChunk,
+    adding the workers' cache counters to tails and recording the
+    tables each worker holds in tables_held '''
+
+    for results, counters, pid, n_tables in chunks:
+        tails.addCounters(*counters)
+        tables_held[pid] = n_tables
+        for result in results:
+            yield result[1:]
+
+
 def main(argv=None):
     """script main.
 
@@ -436,17 +1264,62 @@ parses command line options in sys.argv, unless *argv* is given.
     parser.add_option("-t", "--threshold", dest="threshold", type="float",
                       default=0.05,
                       help="p-value threshold under which to merge windows")
+    parser.add_option("--threads", "--jobs", dest="threads", type="int",
+                      default=1,
+                      help="Number of processes to use for calculating "
+                           "p-values [%default]")
+    parser.add_option("--chunk-by", dest="chunk_by", type="choice",
+                      choices=["genes", "contig"], default="genes",
+                      help="How to divide genes between processes: in "
+                           "chunks of --chunk-size genes or by contig. "
+                           "Chunking by contig requires genes sorted by "
+                           "contig [%default]")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      default=100,
+                      help="Number of genes in each chunk when dividing "
+                           "by genes [%default]")
+    parser.add_option("--average", dest="average", type="choice",
+                      choices=["stream", "table"], default="stream",
+                      help="How to average p-values accross transcripts: "
+                           "as each transcript is calculated, or from a "
+                           "table of all transcripts [%default]")
+    parser.add_option("--geneset-store", dest="geneset_store",
+                      type="string", default=None,
+                      help="Read genes from this geneset store rather "
+                           "than a GTF on stdin")
+    parser.add_option("--set-transcript-to-gene",
+                      dest="set_transcript_to_gene", action="store_true",
+                      default=False,
+                      help="Treat all the transcripts of each gene as a "
+                           "single transcript")
+    parser.add_option("--spill", dest="spill", action="store_true",
+                      default=False,
+                      help="Spill p-values to disk rather than holding them "
+                           "in memory until output")
+    parser.add_option("--tmpdir", dest="tmpdir", type="string",
+                      default=None,
+                      help="Directory for temporary files when using "
+                           "--spill")
+    parser.add_option("--output-bigwig", dest="output_bigwig",
+                      type="string", default=None,
+                      help="Also write -log10(p) for each strand to "
+                           "bigWig files OUTPUT_BIGWIG_plus.bw and "
+                           "OUTPUT_BIGWIG_minus.bw")
 
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
-    # Standard in contains the transcripts
-    
-    gffs = GTF.gene_iterator(GTF.iterator(options.stdin))
+    # Standard in contains the transcripts, unless a geneset store
+    # is given
+    if options.geneset_store:
+        gffs = iCLIP.GenesetStore(options.geneset_store).iterGenes(
+            sort=True)
+    else:
+        gffs = GTF.gene_iterator(GTF.iterator(options.stdin))
 
-    # bam file is the first positional arguement
-    bamfile = pysam.Samfile(args[0])
+    if options.set_transcript_to_gene:
+        gffs = iCLIP.setTranscriptToGene(gffs)
 
     if options.output_both:
         outfile_bases = options.stdout
@@ -462,112 +1335,83 @@ parses command line options in sys.argv, unless *argv* is given.
         E.warning("--fdr implies not --pipeout, instant output disabled")
         options.pipeout = False
 
+    # tracks are spilled to disk where the output is not held in memory
+    if options.output_bigwig and (options.spill or options.pipeout):
+        tracks = SpilledTracks(tmpdir=options.tmpdir)
+    elif options.output_bigwig:
+        tracks = BaseTracks()
+    else:
+        tracks = None
+
     if options.pipeout:
         output = InstantOutput(outfile_bases=outfile_bases,
                                outfile_windows=outfile_windows,
                                window_size=options.window_size,
-                               threshold=options.threshold)
+                               threshold=options.threshold,
+                               tracks=tracks)
+    elif options.spill:
+        output = SpilledOutput(outfile_bases=outfile_bases,
+                               outfile_windows=outfile_windows,
+                               correct=options.fdr,
+                               window_size=options.window_size,
+                               threshold=options.threshold,
+                               tmpdir=options.tmpdir,
+                               tracks=tracks)
     else:
         output = DeferredOutput(outfile_bases=outfile_bases,
                                 outfile_windows=outfile_windows,
                                 correct=options.fdr,
                                 window_size=options.window_size,
-                                threshold=options.threshold)
+                                threshold=options.threshold,
+                                tracks=tracks)
 
     E.info("Counting accross transcripts ...")
-    max_end = 0
-    for gene in gffs:
-
-        if options.grouping == "all":
-            gene = GTF.merged_gene_iterator(gene)
-
-        transcript_ps = {}
-
-        for transcript in gene:
-            
-            # E.debug("Transcript is %s" % transcript[0].transcript_id)
-            coords_converter = iCLIP.TranscriptCoordInterconverter(transcript)
-            exons = GTF.asRanges(transcript, "exon")
-            counts = iCLIP.count_intervals(bamfile,
-                                           exons,
-                                           strand=transcript[0].strand,
-                                           contig=transcript[0].contig,
-                                           dtype=options.dtype)
-
- 
-            counts.index = coords_converter.genome2transcript(counts.index.values)
-            counts = counts.sort_index()
-            cds = GTF.asRanges(transcript, "CDS")
-
-            if options.grouping == "utrs" and len(cds) > 0:
-                
-                cds_interval = (cds[0][0], cds[-1][1])
-                cds_interval = coords_converter.genome2transcript(cds_interval)
-                cds_interval.sort()
-                cds_length = cds_interval[1] - cds_interval[0]
-
-                p_intervals = [(0, cds_interval[0]),
-                               (cds_interval[0], cds_length),
-                               (cds_interval[1], coords_converter.length - cds_interval[1])]
-
-            else:  # do not group by cds or there is no cds
-                p_intervals = [(0, coords_converter.length)]
-
-            p_values = [calculateProbabilities(counts, options.window_size,
-                                              length=length, start=start)
-                        for start, length in p_intervals
-                        if length > 0]
-  
-            if len(p_values) > 1:
-                p_values = pd.concat(p_values)
-            else:
-                p_values = p_values[0]
-
-            p_values.index = coords_converter.transcript2genome(p_values.index.values)
- 
- 
-            intron_intervals = GTF.toIntronIntervals(transcript)
-            
-            if len(intron_intervals) > 0:
-                intron_coords = iCLIP.TranscriptCoordInterconverter(transcript,
-                                                                    introns=True)
-                intron_counts = iCLIP.count_intervals(bamfile,
-                                                      intron_intervals,
-                                                      strand=transcript[0].strand,
-                                                      contig=transcript[0].contig,
-                                                      dtype=options.dtype)
-             
-                intron_counts.index = intron_coords.genome2transcript(
-                    intron_counts.index.values)
-                intron_counts = intron_counts.sort_index()
-                intron_pvalues = calculateProbabilities(intron_counts,
-                                                        options.window_size,
-                                                        intron_coords.length)
-                                                        
-                intron_pvalues.index = intron_coords.transcript2genome(
-                    intron_pvalues.index.values)
-                p_values = p_values.append(intron_pvalues)
-                
-            transcript_ps[transcript[0].transcript_id] = p_values
-
-        transcript_df = pd.DataFrame(transcript_ps)
-
-        transcript_df.index.rename("position", inplace=True)
-        transcript_df["contig"] = gene[0][0].contig
-        transcript_df["strand"] = gene[0][0].strand
-        transcript_df["gene_id"] = gene[0][0].gene_id
-        transcript_df.set_index("contig", append=True, inplace=True)
-        transcript_df.set_index("strand", append=True, inplace=True)
-        transcript_df.set_index("gene_id", append=True, inplace=True)
- 
-        gene_ps = transcript_df.mean(1)
-        gene_ps = gene_ps.reorder_levels(["gene_id", "contig",
-                                          "strand", "position"])
 
+    if options.threads > 1:
+        E.info("Calculating p-values using %i processes" % options.threads)
+        pool = multiprocessing.Pool(options.threads,
+                                    initializer=_initWorker,
+                                    initargs=(args[0],
+                                              options.grouping,
+                                              options.window_size,
+                                              options.dtype,
+                                              options.average))
+        # chunks are returned in input order, so that output does not
+        # depend on how genes were scheduled
+        chunks = chunkGenes(gffs, options.chunk_by, options.chunk_size)
+        # cache statistics are merged from the workers and reported once
+        tables_held = {}
+        results = _mergeChunks(imapBounded(pool, _processChunk, chunks,
+                                           2 * options.threads),
+                               binomial_tails, tables_held)
+    else:
+        pool = None
+        tables_held = None
+        bamfile = openCrosslinks(args[0])
+        results = (calculateGenePValues(gene, bamfile, options.grouping,
+                                        options.window_size, options.dtype,
+                                        options.average)
+                   for gene in gffs)
+
+    for gene_ps, gene in results:
         output.write(gene_ps, gene)
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+        binomial_tails.report(sum(tables_held.values()))
+    else:
+        binomial_tails.report()
+
     output.close()
 
+    if tracks is not None:
+        E.info("Writing bigWig tracks")
+        bam = pysam.Samfile(args[0])
+        tracks.writeBigWigs(options.output_bigwig,
+                            zip(bam.references, bam.lengths))
+        tracks.close()
+
     # write footer and output benchmark information.
     E.Stop()
 
@@ -4,7 +4,18 @@ import CGAT.Experiment as E
 import numpy as np
 import pandas as pd
 import CGAT.GTF as GTF
+import CGAT.IOTools as IOTools
 import collections
+import itertools
+import json
+import os
+import struct
+import zlib
+import pysam
+
+# number of reads to hold in the column buffers of the batch crosslink
+# counting engine
+BATCH_SIZE = 100000
 
 def find_first_deletion(cigar):
     '''Find the position of the the first deletion in a 
@@ -41,9 +52,13 @@ class TranscriptCoordInterconverter:
     
     and
 
-    myConverter.transcript2genome(myConverter.genome2transcript(x)) == x'''
+    myConverter.transcript2genome(myConverter.genome2transcript(x)) == x
 
-    
+    The exon starts and ends in both coordinate systems are held as
+    numpy arrays, and positions are assigned to exons by binary search,
+    so arrays of positions can be converted in any order.
+
+    Use getTranscriptConverter to share converters between calls.'''
 
     def __init__(self, transcript, introns=False):
         ''' Pre compute the conversions for each exon '''
@@ -67,157 +82,149 @@ class TranscriptCoordInterconverter:
             intervals.sort(reverse=False)
 
         self.offset = intervals[0][0]
-        self.genome_intervals = [map(abs, (x-self.offset, y-self.offset))
-                                 for x, y in intervals]
 
-        interval_sizes = [abs(y-x) for x, y in intervals]
+        # exon starts and ends relative to offset, in transcript order.
+        # These are increasing on either strand.
+        self.genome_starts = np.array([abs(x - self.offset)
+                                       for x, y in intervals],
+                                      dtype="int64")
+        self.genome_ends = np.array([abs(y - self.offset)
+                                     for x, y in intervals],
+                                    dtype="int64")
 
-        total = 0
-        transcript_intervals = [None]*len(interval_sizes)
+        interval_sizes = self.genome_ends - self.genome_starts
+        self.transcript_ends = np.cumsum(interval_sizes)
+        self.transcript_starts = self.transcript_ends - interval_sizes
 
-        for i in range(len(interval_sizes)):
-            transcript_intervals[i] = (total,
-                                       interval_sizes[i] + total)
-            total += interval_sizes[i]
-        
-        self.transcript_intervals = transcript_intervals
-        self.length = transcript_intervals[-1][1]
+        self.length = int(self.transcript_ends[-1])
 
-    def genome2transcript(self, pos):
-        ''' Convert genome coordinate into transcript coordinates.
-        pos can be a single value or a nunpy array like object.
-        Passing an array ensures that the transcript is only
-        searched once, ensuring O(n) performance rather than
-        O(nlogn)'''
+    def genome2transcript(self, pos, return_mask=False):
+        ''' Convert genome coordinates into transcript coordinates.
+        pos can be a single value or a numpy array like object.
 
-        if len(pos) == 0:
-            return np.array([])
+        Raises ValueError if any position is not in the transcript,
+        unless return_mask is True, in which case a boolean array
+        marking the positions that are in the transcript is also
+        returned, and the coordinates of other positions are
+        undefined '''
+
+        pos = np.atleast_1d(np.asarray(pos, dtype="int64"))
+        relative_pos = pos - self.offset
 
-        try:
-            relative_pos = pos - self.offset
-        except TypeError:
-            relative_pos = np.array(pos) - self.offset
-        
         if self.strand == "-":
             relative_pos = relative_pos * -1
 
-        ordering = np.argsort(relative_pos)
-        relative_pos = np.sort(relative_pos)
+        exon = np.searchsorted(self.genome_starts, relative_pos,
+                               side="right") - 1
+        mask = exon >= 0
+        exon[~mask] = 0
+        mask &= relative_pos < self.genome_ends[exon]
 
-        # pre allocate results list for speed
-        try:
-            results = np.zeros(len(relative_pos))
-        except TypeError:
-            relative_pos = np.array([relative_pos])
-            results = np.zeros(1)
-
-        i = 0
-        i_max = len(relative_pos)
-
-        # do linear search for correct exon
-        for exon, interval in enumerate(self.genome_intervals):
-
-            if relative_pos[i] < interval[0]:
-              
-                
-                raise ValueError("Position %i is not in transcript %s" %
-                                 (pos[i], self.transcript_id) )
-            
-            while relative_pos[i] < interval[1]:
-                
-                pos_within_exon = relative_pos[i]-interval[0]
-                transcript_exon = self.transcript_intervals[exon]
-                transcript_position = transcript_exon[0] + pos_within_exon
-                
-                results[i] = transcript_position
-                i += 1
-                if i == i_max:
-                    return results[ordering]
-
-        # exon has not been found
-       
-        raise ValueError("Position %i (%i relative) is not in transcript %s\n exons are %s" %
-                         (pos[i], relative_pos[i], self.transcript_id, self.genome_intervals))
-
-    def transcript2genome(self, pos):
-        ''' Convert transcript coodinate into genome coordinate,
-        pos can be a single value or a nunpy array like object.
-        Passing an array ensures that the transcript is only
-        searched once, ensuring O(n) performance rather than
-        O(nlogn)'''
-    
-        try:
-            if len(pos) == 0:
-                return np.array([])
-        except TypeError:
-            pos = np.array([pos])
-
-        # Converting a list is only efficient if the list is ordered
-        # however want to be able to return list in the same order it
-        # arrived, so remember the order and then sort.
-        ordering = np.argsort(pos)
-        pos = np.sort(pos)
-
-        # pre allocate results list for speed
-       
-        results = np.zeros(len(pos))
-        
-        i = 0
-        i_max = len(pos)
+        results = (self.transcript_starts[exon] +
+                   relative_pos - self.genome_starts[exon])
 
-        # do linear search for correct exon
-        for exon, interval in enumerate(self.transcript_intervals):
+        if return_mask:
+            return results, mask
 
-            while pos[i] < interval[1]:
-                pos_within_exon = pos[i] - interval[0]
-                genome_exon = self.genome_intervals[exon]
-                relative_genome_position = genome_exon[0] + pos_within_exon
+        if not mask.all():
+            raise ValueError("Position %i is not in transcript %s" %
+                             (pos[~mask][0], self.transcript_id))
 
-                if self.strand == "-":
-                    results[i] = (self.offset - relative_genome_position)
-                    i += 1
-                else:
-                    results[i] = (self.offset + relative_genome_position)
-                    i += 1
+        return results
 
-                if i == i_max:
-                    return results[ordering]
-  
-        # beyond the end of the transcript
-        ValueError("Transcript postion %i outside of transcript %s" %
-                   (pos[i], self.transcript_id))
+    def transcript2genome(self, pos, return_mask=False):
+        ''' Convert transcript coodinates into genome coordinates,
+        pos can be a single value or a numpy array like object.
+
+        Raises ValueError for positions outside the transcript, or
+        returns a mask of positions inside it, as genome2transcript '''
+
+        pos = np.atleast_1d(np.asarray(pos, dtype="int64"))
+
+        exon = np.searchsorted(self.transcript_starts, pos,
+                               side="right") - 1
+        mask = (exon >= 0) & (pos < self.length)
+        exon[~mask] = 0
+
+        relative_genome_position = (self.genome_starts[exon] +
+                                    pos - self.transcript_starts[exon])
+
+        if self.strand == "-":
+            results = self.offset - relative_genome_position
+        else:
+            results = self.offset + relative_genome_position
+
+        if return_mask:
+            return results, mask
+
+        if not mask.all():
+            raise ValueError("Transcript postion %i outside of transcript %s" %
+                             (pos[~mask][0], self.transcript_id))
+
+        return results
 
     def transcript_interval2genome_intervals(self, interval):
         '''Take an interval in transcript coordinates and returns
         a list of intervals in genome coordinates representing the
-        interval on the genome '''
-
-        outlist = []
-        for exon in self.transcript_intervals:
-            if interval[0] < exon[1]:
-                start = interval[0]
-                if interval[1] <= exon[1]:
-                    outlist.append((start, interval[1]))
-                    break
-                else:
-                    outlist.append((start, exon[1]))
-                    interval = (exon[1], interval[1])
-       
-        genome_list = [tuple(self.transcript2genome((x, y-1))) for
-                       x, y in outlist]
-        
+        interval on the genome. Any part of the interval outside of the
+        transcript is dropped '''
+
+        start = max(interval[0], 0)
+        end = min(interval[1], self.length)
+
+        if start >= end:
+            return []
+
+        first = np.searchsorted(self.transcript_ends, start, side="right")
+        last = np.searchsorted(self.transcript_starts, end, side="left")
+
+        starts = np.maximum(self.transcript_starts[first:last], start)
+        ends = np.minimum(self.transcript_ends[first:last], end)
+
         # these intervals are zero based-closed. Need to make half open
+        genome_starts = self.transcript2genome(starts)
+        genome_ends = self.transcript2genome(ends - 1)
 
         if self.strand == "+":
-            genome_list = [(x, y+1) for x, y in genome_list]
+            genome_list = zip(genome_starts, genome_ends + 1)
         else:
-            genome_list = [(y, x+1) for x, y in genome_list]
+            genome_list = zip(genome_ends, genome_starts + 1)
 
-        return sorted(genome_list)
+        return sorted((int(x), int(y)) for x, y in genome_list)
 
 
+# converters shared by every caller in this process, keyed on the
+# structure of the transcript. See getTranscriptConverter.
+_converters = collections.OrderedDict()
+MAX_CONVERTERS = 10000
+
+
+def getTranscriptConverter(transcript, introns=False):
+    ''' Return a TranscriptCoordInterconverter for transcript, building
+    it only if it is not already cached. Converters are cached on the
+    contig, strand and exons of the transcript, rather than on
+    transcript_id, which need not be unique (for example transcripts in
+    the pseudoautosomal regions, or the merged models of each gene given
+    by --set-transcript-to-gene). The least recently used converter is
+    discarded once more than MAX_CONVERTERS are held. '''
+
+    key = (transcript[0].contig, transcript[0].strand,
+           tuple(sorted((exon.start, exon.end) for exon in transcript
+                        if exon.feature == "exon")),
+           introns)
+
+    try:
+        converter = _converters.pop(key)
+    except KeyError:
+        converter = TranscriptCoordInterconverter(transcript, introns=introns)
+        if len(_converters) >= MAX_CONVERTERS:
+            _converters.popitem(last=False)
+
+    # reinsert to mark as most recently used
+    _converters[key] = converter
+    return converter
+
 
-    
 def getCrosslink(read):
     ''' Finds the crosslinked base from a pysam read.
 
@@ -268,6 +275,162 @@ def getCrosslink(read):
     return (pos,cat)
     
 
+def _deletion_offset(cigar):
+    '''As find_first_deletion, but returns -1 rather than the
+    length of the alignment when the read contains no deletion '''
+
+    position = 0
+    for operation, length in cigar:
+        if operation == 2:
+            return position
+        position += length
+
+    return -1
+
+
+def iterCrosslinkBatches(reads, batch_size=BATCH_SIZE):
+    ''' Pulls reads from the pysam iterator reads into fixed size column
+    buffers (reference_start, reference_end, is_reverse and first deletion
+    offset) and computes the crosslinked base for a whole batch of reads
+    at a time with numpy.
+
+    Cross link sites are defined as in getCrosslink.
+
+    yields a tuple of numpy arrays (positions, is_reverse, is_deletion) for
+    each batch of at most batch_size reads. '''
+
+    starts = np.empty(batch_size, dtype="int64")
+    ends = np.empty(batch_size, dtype="int64")
+    reverse = np.empty(batch_size, dtype="bool")
+    deletions = np.empty(batch_size, dtype="int64")
+
+    i = 0
+    for read in reads:
+
+        if read.is_unmapped:
+            continue
+
+        starts[i] = read.reference_start
+        ends[i] = read.reference_end
+        reverse[i] = read.is_reverse
+
+        cigar = read.cigartuples
+        offset = _deletion_offset(cigar)
+        if offset >= 0 and reverse[i]:
+            offset = _deletion_offset(reversed(cigar))
+        deletions[i] = offset
+
+        i += 1
+        if i == batch_size:
+            yield _batchCrosslinks(starts, ends, reverse, deletions)
+            i = 0
+
+    if i > 0:
+        yield _batchCrosslinks(starts[:i], ends[:i], reverse[:i],
+                               deletions[:i])
+
+
+def _batchCrosslinks(starts, ends, reverse, deletions):
+    ''' Vectorised version of getCrosslink over column buffers. Returns
+    new arrays so that the buffers can be reused '''
+
+    is_deletion = deletions >= 0
+    positions = np.where(reverse, ends, starts - 1)
+
+    pos_del = is_deletion & ~reverse
+    positions[pos_del] = starts[pos_del] + deletions[pos_del]
+
+    neg_del = is_deletion & reverse
+    positions[neg_del] = ends[neg_del] - deletions[neg_del] - 1
+
+    return (positions, reverse.copy(), is_deletion)
+
+
+def countPositions(positions):
+    ''' Count the number of times each position occurs in an integer
+    array. Dense blocks of positions (such as one batch of reads from a
+    sorted BAM) are counted with np.bincount, otherwise np.unique
+    is used.
+
+    returns a tuple of sorted unique positions and their counts '''
+
+    if len(positions) == 0:
+        return (np.array([], dtype="int64"), np.array([], dtype="int64"))
+
+    first = positions.min()
+    span = positions.max() - first + 1
+
+    if span <= 4 * len(positions) + 1024:
+        counts = np.bincount(positions - first)
+        found = np.flatnonzero(counts)
+        return (found + first, counts[found])
+    else:
+        return np.unique(positions, return_counts=True)
+
+
+def mergePositionCounts(counts):
+    ''' Combine a list of (positions, counts) tuples, as returned by
+    countPositions, summing the counts of positions that appear in more
+    than one tuple '''
+
+    counts = [x for x in counts if len(x[0]) > 0]
+
+    if len(counts) == 0:
+        return (np.array([], dtype="int64"), np.array([], dtype="int64"))
+    elif len(counts) == 1:
+        return counts[0]
+
+    positions = np.concatenate([x[0] for x in counts])
+    values = np.concatenate([x[1] for x in counts])
+    positions, inverse = np.unique(positions, return_inverse=True)
+    values = np.bincount(inverse, weights=values).astype("int64")
+
+    return (positions, values)
+
+
+def countChrArrays(reads, batch_size=BATCH_SIZE):
+    ''' Batch crosslink counting engine behind countChr. Counts the
+    crosslinked bases for the reads in the pysam iterator reads.
+
+    returns a tuple ((positions, counts), (positions, counts), counter)
+    with sorted numpy arrays for the positive and negative strands and a
+    counter object containing the counts for each type of site. '''
+
+    pos_counts = []
+    neg_counts = []
+    counter = E.Counter()
+
+    for positions, is_reverse, is_deletion in iterCrosslinkBatches(
+            reads, batch_size):
+
+        n_neg = int(is_reverse.sum())
+        n_del_neg = int((is_deletion & is_reverse).sum())
+        n_del_pos = int(is_deletion.sum()) - n_del_neg
+
+        counter["truncated_neg"] += n_neg - n_del_neg
+        counter["deletion_neg"] += n_del_neg
+        counter["truncated_pos"] += len(positions) - n_neg - n_del_pos
+        counter["deletion_pos"] += n_del_pos
+
+        pos_counts.append(countPositions(positions[~is_reverse]))
+        neg_counts.append(countPositions(positions[is_reverse]))
+
+    return (mergePositionCounts(pos_counts),
+            mergePositionCounts(neg_counts),
+            counter)
+
+
+def _arraysToSeries(positions, counts, dtype):
+
+    if len(counts) > 0 and counts.max() > np.iinfo(dtype).max:
+        raise ValueError(
+            "Maximum depth %i is too large for dtype %s"
+            % (counts.max(), dtype))
+
+    return pd.Series(counts.astype(dtype),
+                     index=positions.astype("float64"))
+
+
 def countChr(reads, chr_len, dtype = 'uint16'):
     ''' Counts the crosslinked bases for each read in the pysam rowiterator
     reads and saves them in pandas Series: those on the positive strand
@@ -286,59 +449,436 @@ def countChr(reads, chr_len, dtype = 'uint16'):
     
     The dtype to use internally for storage can be specified. Large types
     reduce the chance of overflow, but require more memory. With 'uint16'
-    the largest count that can be handled is 255. Data is stored sparse,
+    the largest count that can be handled is 65535. Data is stored sparse,
     so memory is less of a problem. Overflow will cause a ValueError.
 
+    Reads are processed in batches by countChrArrays.
+
     returns a tuple of pandas Series objects, with the positive and negative
     strand arrays and also a counter object that contains the counts for each
     type of site. '''
 
-    pos_depths = collections.defaultdict(int)
-    neg_depths = collections.defaultdict(int)
+    (pos_positions, pos_counts), (neg_positions, neg_counts), counter = \
+        countChrArrays(reads)
 
-    counter = E.Counter()
+    pos_depths = _arraysToSeries(pos_positions, pos_counts, dtype)
+    neg_depths = _arraysToSeries(neg_positions, neg_counts, dtype)
 
-    for read in reads:
-        
-        (pos, cat) = getCrosslink(read)
-        counter[cat] += 1
+    return (pos_depths, neg_depths, counter)
 
-        if read.is_reverse:
-            neg_depths[float(pos)] += 1
+
+# integer types that crosslink counts are promoted through on overflow
+COUNT_DTYPES = ["uint8", "uint16", "uint32", "uint64"]
+
+
+def promoteCounts(counts, dtype="uint16"):
+    ''' Cast an array of counts to dtype, or, if the largest count would
+    overflow dtype, to the next largest type in COUNT_DTYPES that can
+    hold it. Counts that are already of type dtype are returned as
+    they are, without looking for the largest. '''
+
+    dtype = np.dtype(dtype)
+    if counts.dtype == dtype:
+        return counts
+
+    largest = counts.max() if len(counts) > 0 else 0
+
+    candidates = [dtype] + [np.dtype(candidate) for candidate in COUNT_DTYPES
+                            if np.dtype(candidate).itemsize > dtype.itemsize]
+
+    for candidate in candidates:
+        if largest <= np.iinfo(candidate).max:
+            return counts.astype(candidate, copy=False)
+
+    raise ValueError("Count %i too large to be stored" % largest)
+
+
+class StrandProfile:
+    ''' Crosslink counts for one strand of one contig.
+
+    Counts are stored either sparse, as a sorted array of coordinates
+    and an array of counts, or dense, as an array of counts for every
+    base in the contig, whichever takes less memory. Small contigs with
+    reasonable coverage will be dense, large ones sparse.
+
+    Counts are held in the smallest unsigned integer type, no smaller
+    than dtype, that can store the largest count. The type is promoted
+    (uint16->uint32->uint64) rather than overflowing.
+
+    Passing sparse=True forces sparse storage, which allows positions
+    and counts to be memory mapped arrays (see readCrosslinkIndex).
+    Counts already of type dtype are not scanned or copied.
+
+    All coordinates are zero-based and intervals half-open. '''
+
+    def __init__(self, positions, counts, length=None, dtype="uint16",
+                 sparse=False):
+
+        positions = np.asarray(positions, dtype="int64")
+        counts = promoteCounts(np.asarray(counts), dtype)
+
+        self.length = length
+        self.dtype = counts.dtype
+
+        sparse_size = len(positions) * (positions.itemsize + counts.itemsize)
+
+        if (not sparse and length is not None and len(positions) > 0 and
+                positions[0] >= 0 and positions[-1] < length and
+                length * counts.itemsize <= sparse_size):
+            self.dense = np.zeros(length, dtype=counts.dtype)
+            self.dense[positions] = counts
+            self._positions = None
+            self._counts = None
         else:
-            pos_depths[float(pos)] += 1
+            self.dense = None
+            self._positions = positions
+            self._counts = counts
+
+    @classmethod
+    def fromReads(cls, reads, length=None, dtype="uint16"):
+        ''' Count crosslinks from pysam reads and return profiles for
+        the positive and negative strand and a counter of site types '''
+
+        (pos_positions, pos_counts), (neg_positions, neg_counts), counter = \
+            countChrArrays(reads)
+
+        return (cls(pos_positions, pos_counts, length, dtype),
+                cls(neg_positions, neg_counts, length, dtype),
+                counter)
+
+    @property
+    def positions(self):
+        '''Sorted coordinates of all crosslinked bases'''
+        if self.dense is None:
+            return self._positions
+        return np.flatnonzero(self.dense)
+
+    @property
+    def counts(self):
+        '''Counts for each base in positions'''
+        if self.dense is None:
+            return self._counts
+        return self.dense[self.dense > 0]
+
+    def interval(self, start, end):
+        ''' Return the positions and counts of crosslinked bases in the
+        half open interval [start, end). For sparse profiles the interval
+        is located in O(log n) by binary search '''
+
+        start = max(int(start), 0)
+        end = int(end)
+
+        if self.dense is None:
+            first, last = np.searchsorted(self._positions, (start, end))
+            return (self._positions[first:last], self._counts[first:last])
+
+        window = self.dense[start:end]
+        found = np.flatnonzero(window)
+        return (found + start, window[found])
+
+    def sum(self, start=None, end=None):
+        ''' Total crosslinks, optionally restricted to [start, end).
+        Without start the range starts at 0, and without end it runs to
+        the end of the profile '''
+
+        if start is None and end is None:
+            return int(self.counts.sum(dtype="uint64"))
+
+        if start is None:
+            start = 0
+
+        if end is None:
+            if self.dense is not None:
+                end = len(self.dense)
+            elif len(self._positions) > 0:
+                end = int(self._positions[-1]) + 1
+            else:
+                end = 0
+
+        return int(self.interval(start, end)[1].sum(dtype="uint64"))
+
+    def max(self):
+        counts = self.counts
+        return int(counts.max()) if len(counts) > 0 else 0
+
+    def __len__(self):
+        ''' Number of crosslinked bases '''
+        if self.dense is None:
+            return len(self._positions)
+        return int(np.count_nonzero(self.dense))
+
+    def __add__(self, other):
+        ''' Sum of two profiles '''
+
+        positions, counts = mergePositionCounts(
+            [(self.positions, self.counts), (other.positions, other.counts)])
+
+        return StrandProfile(positions, counts, self.length,
+                             np.promote_types(self.dtype, other.dtype))
+
+    def asSeries(self):
+        ''' Convert to a sparse pandas Series indexed on position '''
+        return pd.Series(self.counts, index=self.positions)
+
+
+def openBam(filename, threads=1):
+    ''' Open a BAM file, or stdin if filename is "-", for reading. BGZF
+    blocks are decompressed in a pool of threads threads '''
+
+    return pysam.AlignmentFile(filename, "rb", threads=threads)
+
+
+def _isCoordinateSorted(bam):
+
+    return bam.header.get("HD", {}).get("SO") == "coordinate"
+
+
+class CrosslinkCounts:
+    ''' Container for crosslink counts across the genome: one
+    StrandProfile for each strand of each contig, plus counters of the
+    type of each site (truncation or deletion), for each contig and in
+    total '''
+
+    def __init__(self):
+
+        self.profiles = collections.OrderedDict()
+        self.lengths = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.counter = E.Counter()
+
+    def addContig(self, contig, plus, minus, length=None, counter=None):
+
+        self.profiles[contig] = {"+": plus, "-": minus}
+        self.lengths[contig] = length
+        self.counters[contig] = E.Counter()
+        if counter is not None:
+            for key, value in counter.iteritems():
+                self.counters[contig][key] += value
+                self.counter[key] += value
+
+    def contigCounter(self, contig):
+        ''' A copy of the counter of site types on contig '''
+
+        counter = E.Counter()
+        for key, value in self.counters.get(contig, {}).iteritems():
+            counter[key] += value
+        return counter
+
+    @property
+    def contigs(self):
+        return list(self.profiles.keys())
+
+    def __contains__(self, contig):
+        return contig in self.profiles
+
+    def __getitem__(self, key):
+        ''' Get the profile for key, a (contig, strand) tuple '''
+        contig, strand = key
+        return self.profiles[contig][strand]
+
+    def interval(self, contig, start, end, strand="."):
+        ''' Positions and counts in [start, end) on contig. Strand "."
+        sums the positive and negative strands '''
+
+        if strand == ".":
+            return mergePositionCounts(
+                [self.profiles[contig]["+"].interval(start, end),
+                 self.profiles[contig]["-"].interval(start, end)])
+
+        return self.profiles[contig][strand].interval(start, end)
+
+    @classmethod
+    def fromBAM(cls, bam, contigs=None, dtype="uint16"):
+        ''' Count crosslinks accross all (or the specified) contigs of
+        an open pysam BAM file. All the contigs of a coordinate sorted
+        file are counted in one linear read of the file, rather than
+        with an index lookup for each contig '''
+
+        result = cls()
+
+        if contigs is None and _isCoordinateSorted(bam):
+            groups = itertools.groupby(bam.fetch(until_eof=True),
+                                       lambda read: read.reference_id)
+            tid, reads = next(groups, (None, None))
+            for i, (contig, length) in enumerate(zip(bam.references,
+                                                     bam.lengths)):
+                # a group must be read before moving on to the next
+                plus, minus, counter = StrandProfile.fromReads(
+                    reads if tid == i else [], length, dtype)
+                result.addContig(contig, plus, minus, length, counter)
+
+                if tid == i:
+                    tid, reads = next(groups, (None, None))
+
+            return result
+
+        for contig, length in zip(bam.references, bam.lengths):
+            if contigs is not None and contig not in contigs:
+                continue
+
+            plus, minus, counter = StrandProfile.fromReads(
+                bam.fetch(contig), length, dtype)
+            result.addContig(contig, plus, minus, length, counter)
+
+        return result
+
+
+def count_intervals(bam, intervals, contig, strand=".", dtype='uint16',
+                    single_fetch=False):
+    ''' Count the crosslinked bases accross a transcript. bam is either
+    an open pysam BAM file, a CrosslinkCounts object, such as one
+    loaded from a crosslink index, or a StrandProfile for the
+    contig and strand, such as one from regionProfile. Returns a pandas
+    Series indexed on genome position, sorted if intervals are.
+
+    By default the reads for each interval are fetched from a BAM file
+    seperately. With single_fetch the span of all the intervals is
+    fetched once and its crosslinks divided between the intervals. '''
+
+    if single_fetch and len(intervals) > 0 and \
+            not isinstance(bam, (StrandProfile, CrosslinkCounts)):
+        bam = regionProfile(bam, contig,
+                            min(start for start, end in intervals),
+                            max(end for start, end in intervals),
+                            strand, dtype)
+
+    if isinstance(bam, StrandProfile):
+
+        interval_counts = [bam.interval(exon[0], exon[1])
+                           for exon in intervals]
+
+    elif isinstance(bam, CrosslinkCounts):
+
+        if contig not in bam:
+            E.warning("Skipping intervals on contig %s as not present in "
+                      "crosslink index" % contig)
+            return pd.Series()
+
+        interval_counts = [bam.interval(contig, exon[0], exon[1], strand)
+                           for exon in intervals]
+
+    else:
+        interval_counts = _count_bam_intervals(bam, intervals, contig,
+                                               strand, dtype)
+        if interval_counts is None:
+            return pd.Series()
+
+    if len(interval_counts) == 0:
+        return pd.Series()
+
+    positions, counts = zip(*interval_counts)
+    counts = np.concatenate(counts)
+
+    return pd.Series(promoteCounts(counts, dtype),
+                     index=np.concatenate(positions))
+
+
+def regionProfile(bam, contig, start, end, strand=".", dtype="uint16"):
+    ''' Crosslinks in [start, end) of contig on strand ("." for both
+    strands summed) as a sparse StrandProfile. bam is an open pysam BAM
+    file, from which the region is fetched and counted once, or a
+    CrosslinkCounts object, which is sliced.
+
+    Any number of intervals in the region, such as the exons and introns
+    of every transcript of a gene, can then be counted from the profile
+    by binary search with count_intervals, without returning to the
+    BAM file. '''
+
+    if isinstance(bam, CrosslinkCounts):
+
+        if contig not in bam:
+            E.warning("Skipping region on contig %s as not present in "
+                      "crosslink index" % contig)
+            return StrandProfile([], [], dtype=dtype, sparse=True)
+
+        positions, counts = bam.interval(contig, start, end, strand)
+        return StrandProfile(positions, counts, dtype=dtype, sparse=True)
 
     try:
-        pos_depths = pd.Series(pos_depths, dtype=dtype)
+        chr_len = bam.lengths[bam.gettid(contig)]
     except ValueError:
-        pos_depths = pd.Series({}, dtype=dtype)
+        chr_len = None
 
+    # X-linked position is first base before read: need to pull back
+    # reads that might be one base out.
     try:
-        neg_depths = pd.Series(neg_depths, dtype=dtype)
-    except ValueError:
-        neg_depths = pd.Series({}, dtype=dtype)
- 
-    # check for integer overflow: counter sum should add up to array sum
-    counter_sum = sum([y for x, y in counter.iteritems()])
-    array_sum = pos_depths.sum() + neg_depths.sum()
-    if not counter_sum == array_sum:
-        raise (ValueError,
-               "Sum of depths is not equal to number of "
-               "reads counted, possibly dtype %s not large enough" % dtype)
-    
-#    E.debug("Counted %i truncated on positive strand, %i on negative"
-#            % (counter.truncated_pos, counter.truncated_neg))
-#    E.debug("and %i deletion reads on positive strand, %i on negative"
-#            % (counter.deletion_pos, counter.deletion_neg))
-    
-    return (pos_depths, neg_depths, counter)
+        reads = bam.fetch(reference=contig,
+                          start=max(0, start-1),
+                          end=end+1)
+    except ValueError as e:
+        E.debug(e)
+        E.warning("Skipping region on contig %s as not present in bam"
+                  % contig)
+        return StrandProfile([], [], dtype=dtype, sparse=True)
+
+    plus, minus, counter = StrandProfile.fromReads(reads, chr_len, dtype)
+
+    if strand == "+":
+        profile = plus
+    elif strand == "-":
+        profile = minus
+    else:
+        profile = plus + minus
+
+    # fetch pulls back any reads that *overlap* the region, so exclude
+    # Xlinked bases outside it
+    positions, counts = profile.interval(start, end)
+    return StrandProfile(positions, counts, dtype=dtype, sparse=True)
+
+
+class GeneProfile:
+    ''' The crosslinks accross the whole of a gene, counted from a
+    single fetch (see regionProfile), from which the counts for the exons
+    or introns of each of its transcripts are projected. '''
+
+    def __init__(self, bam, gene, dtype="uint16"):
+
+        self.contig = gene[0][0].contig
+        self.strand = gene[0][0].strand
+        self.start = min(entry.start for transcript in gene
+                         for entry in transcript)
+        self.end = max(entry.end for transcript in gene
+                       for entry in transcript)
+
+        self.profile = regionProfile(bam, self.contig, self.start, self.end,
+                                     self.strand, dtype)
+
+    @property
+    def positions(self):
+        ''' Sorted genome coordinates of the crosslinked bases in
+        the gene '''
+        return self.profile.positions
+
+    def transcriptCounts(self, transcript, introns=False):
+        ''' Counts in the exons (or, with introns=True, the introns) of
+        transcript, as a Series indexed on transcript coordinate and
+        sorted. The gene's crosslinks are converted to transcript
+        coordinates in one call, rather than each interval being
+        sliced. '''
 
+        converter = getTranscriptConverter(transcript, introns=introns)
+        positions, in_transcript = converter.genome2transcript(
+            self.profile.positions, return_mask=True)
 
-def count_intervals(bam, intervals, contig, strand=".", dtype='uint16'):
-    ''' Count the crosslinked bases accross a transcript '''
+        positions = positions[in_transcript]
+        counts = self.profile.counts[in_transcript]
+        ordering = np.argsort(positions, kind="mergesort")
+
+        return pd.Series(counts[ordering], index=positions[ordering])
+
+
+def _count_bam_intervals(bam, intervals, contig, strand, dtype):
+    ''' Fetch and count the reads for each interval from bam. Returns
+    a list of (positions, counts) tuples, or None if the contig is not in
+    the BAM file '''
+
+    try:
+        chr_len = bam.lengths[bam.gettid(contig)]
+    except ValueError:
+        chr_len = None
+
+    interval_counts = []
 
-    chr_len = bam.lengths[bam.gettid(contig)]
-    exon_counts = []
     for exon in intervals:
         
         # X-linked position is first base before read: need to pull back
@@ -352,120 +892,1615 @@ def count_intervals(bam, intervals, contig, strand=".", dtype='uint16'):
             E.debug(e)
             E.warning("Skipping intervals on contig %s as not present in bam"
                       % contig)
-            return pd.Series()
+            return None
 
-        count_results = countChr(reads, chr_len, dtype)
+        plus, minus, counter = StrandProfile.fromReads(reads, chr_len, dtype)
 
         # fetch pulls back any reads that *overlap* the specified coordinates
         # exlude Xlinked bases outside the interval (prevents double counting)
 
         if strand == "+":
-            if len(count_results[0]) > 0:
-                exon_counts.append(count_results[0].sort_index().loc[
-                    float(exon[0]):float(exon[1]-1)])
+            interval_counts.append(plus.interval(exon[0], exon[1]))
         elif strand == "-":
-            if len(count_results[1]) > 0:
-                exon_counts.append(count_results[1].sort_index().loc[
-                    float(exon[0]):float(exon[1]-1)])
-            
+            interval_counts.append(minus.interval(exon[0], exon[1]))
         else:
-            sum_counts = count_results[0].loc[(count_results[0].index >= exon[0]) &
-                                              (count_results[0].index < exon[1])] + \
-                count_results[1].loc[(count_results[1].index >= exon[0]) &
-                                     (count_results[1].index < exon[1])]
-            exon_counts.append(sum_counts)
-
-    if len(exon_counts) == 0:
-        transcript_counts = pd.Series()
-    else:
-        transcript_counts = pd.concat(exon_counts)
-    # transcript_counts = transcript_counts.sort_index()
-    return transcript_counts
-        
+            interval_counts.append((plus + minus).interval(exon[0], exon[1]))
+
+    return interval_counts
+
+
+def contigProfiles(bam, contig, length=None, crosslinks=None,
+                   dtype="uint16"):
+    ''' Crosslink profiles for both strands of contig. These are taken
+    from the CrosslinkCounts crosslinks, such as a loaded crosslink index,
+    if it is given, otherwise they are counted from the reads in bam.
+
+    returns a tuple of StrandProfiles for the positive and negative strand
+    and a counter of the types of sites on the contig. '''
+
+    if crosslinks is None:
+        return StrandProfile.fromReads(bam.fetch(contig), length, dtype)
+
+    if contig in crosslinks:
+        return (crosslinks[(contig, "+")],
+                crosslinks[(contig, "-")],
+                crosslinks.contigCounter(contig))
+
+    empty = StrandProfile([], [], length, dtype)
+    return (empty, empty, E.Counter())
+
+
+# Crosslink index files
+#
+# A crosslink index holds the CrosslinkCounts for a whole BAM file so that
+# reads only need to be parsed into crosslinks once per BAM. The layout is:
+#
+#    8 bytes   magic string
+#    8 bytes   length of header (little endian unsigned integer)
+#    header    JSON: format version, source BAM size and mtime, total
+#              site type counter and, for each contig, its site type
+#              counter and, for each strand, the number of sites, the
+#              dtype of the counts and the offsets of the positions and
+#              counts arrays
+#    data      raw little endian arrays, each aligned to 8 bytes, that are
+#              memory mapped when the index is read
+#
+# Counts are stored in the type they were counted in, which is recorded
+# in the header, so that loading an index need not read them.
+#
+# The index for BAMFILE is expected at BAMFILE + XLINK_INDEX_SUFFIX.
+
+XLINK_INDEX_MAGIC = b"ICLIPXL1"
+XLINK_INDEX_SUFFIX = ".xlinks"
+XLINK_INDEX_VERSION = 2
+
+
+def _align(offset, alignment=8):
+    return offset + (-offset % alignment)
+
+
+def _fileSignature(infile):
+    ''' Size and modification time used to check that an index is up to
+    date with the file it was built from '''
+
+    stat = os.stat(infile)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def writeCrosslinkIndex(crosslinks, outfile, bamfile=None):
+    ''' Write CrosslinkCounts crosslinks to the crosslink index outfile.
+    If bamfile is given the index is keyed on its size and mtime '''
+
+    arrays = []
+    contigs = []
+    offset = 0
+
+    for contig in crosslinks.contigs:
+        entry = {"name": contig, "length": crosslinks.lengths[contig],
+                 "counter": dict(crosslinks.counters[contig])}
+
+        for strand in ("+", "-"):
+            profile = crosslinks[(contig, strand)]
+            positions = profile.positions.astype("<i8")
+            counts = profile.counts
+            counts = counts.astype(counts.dtype.newbyteorder("<"))
+
+            entry[strand] = {"sites": len(positions),
+                             "positions": offset,
+                             "counts": _align(offset + positions.nbytes),
+                             "dtype": counts.dtype.str}
+
+            arrays.append((offset, positions))
+            arrays.append((entry[strand]["counts"], counts))
+            offset = _align(entry[strand]["counts"] + counts.nbytes)
+
+        contigs.append(entry)
+
+    header = {"version": XLINK_INDEX_VERSION,
+              "bam": _fileSignature(bamfile) if bamfile else None,
+              "counter": dict(crosslinks.counter),
+              "contigs": contigs}
+    header = json.dumps(header).encode("utf-8")
+
+    data_start = _align(len(XLINK_INDEX_MAGIC) + 8 + len(header))
+
+    with open(outfile, "wb") as outf:
+        outf.write(XLINK_INDEX_MAGIC)
+        outf.write(struct.pack("<Q", len(header)))
+        outf.write(header)
+
+        for array_offset, array in arrays:
+            outf.write(b"\0" * (data_start + array_offset - outf.tell()))
+            outf.write(array.tobytes())
+
+
+def readCrosslinkIndexHeader(infile):
+    ''' Return the header of a crosslink index as a dictionary, with the
+    offset of the data section added as "data_start" '''
+
+    with open(infile, "rb") as inf:
+
+        if inf.read(len(XLINK_INDEX_MAGIC)) != XLINK_INDEX_MAGIC:
+            raise ValueError("%s is not a crosslink index" % infile)
+
+        header_length = struct.unpack("<Q", inf.read(8))[0]
+        header = json.loads(inf.read(header_length).decode("utf-8"))
+
+    if header.get("version") != XLINK_INDEX_VERSION:
+        raise ValueError("%s is an old format crosslink index, and must "
+                         "be rebuilt" % infile)
+
+    header["data_start"] = _align(len(XLINK_INDEX_MAGIC) + 8 + header_length)
+    return header
+
+
+def readCrosslinkIndex(infile):
+    ''' Load a crosslink index as a CrosslinkCounts object. Arrays are
+    memory mapped, and so are only read from disk as they are used:
+    counts are kept in the dtype stored in the header rather than being
+    scanned for the smallest type that holds them '''
+
+    header = readCrosslinkIndexHeader(infile)
+    crosslinks = CrosslinkCounts()
+
+    def _map(offset, dtype, size):
+        if size == 0:
+            return np.array([], dtype=dtype)
+        return np.memmap(infile, dtype=dtype, mode="r", shape=(size,),
+                         offset=header["data_start"] + offset)
+
+    for entry in header["contigs"]:
+        profiles = []
+        for strand in ("+", "-"):
+            strand_entry = entry[strand]
+            positions = _map(strand_entry["positions"], "<i8",
+                             strand_entry["sites"])
+            counts = _map(strand_entry["counts"], strand_entry["dtype"],
+                          strand_entry["sites"])
+            profiles.append(StrandProfile(positions, counts, entry["length"],
+                                          dtype=counts.dtype, sparse=True))
+
+        counter = dict((str(key), value)
+                       for key, value in entry["counter"].items())
+        crosslinks.addContig(entry["name"], profiles[0], profiles[1],
+                             entry["length"], counter)
+
+    return crosslinks
+
+
+def buildCrosslinkIndex(bamfile, outfile=None, dtype="uint16", threads=1):
+    ''' Count the crosslinks in every contig of bamfile and save them to a
+    crosslink index. By default the index is saved next to the BAM
+    file. threads is the number of decompression threads to read the
+    BAM file with. '''
+
+    if outfile is None:
+        outfile = bamfile + XLINK_INDEX_SUFFIX
+
+    bam = openBam(bamfile, threads)
+    crosslinks = CrosslinkCounts.fromBAM(bam, dtype=dtype)
+    writeCrosslinkIndex(crosslinks, outfile, bamfile)
+
+    return crosslinks
+
+
+def findCrosslinkIndex(bamfile):
+    ''' Load the crosslink index for bamfile, if one exists and
+    is up to date with the BAM file. Returns None otherwise, in which case
+    crosslinks should be counted from the BAM file '''
+
+    index_file = bamfile + XLINK_INDEX_SUFFIX
+
+    if not os.path.exists(index_file):
+        return None
+
+    try:
+        header = readCrosslinkIndexHeader(index_file)
+    except ValueError as e:
+        E.warning(str(e))
+        return None
+
+    if header["bam"] != _fileSignature(bamfile):
+        E.warning("Crosslink index %s is out of date, ignoring" % index_file)
+        return None
+
+    E.info("Using crosslink index %s" % index_file)
+    return readCrosslinkIndex(index_file)
+
+
+###################################################################
+# Compiled geneset store
+#
+# A geneset store holds the entries of a GTF file as coordinate arrays
+# so that the geneset need only be parsed once. The layout follows the
+# crosslink index:
+#
+#    8 bytes   magic string
+#    8 bytes   length of header (little endian unsigned integer)
+#    header    JSON: format version, source GTF size and mtime, string
+#              tables (contigs, sources, features, scores, attributes,
+#              gene_ids and transcript_ids) and the size, dtype and offset
+#              of each array
+#    data      raw little endian arrays, each aligned to 8 bytes
+#
+# Genes, transcripts within genes and entries within transcripts are
+# stored in the order they first appear in the GTF file, and each entry
+# keeps its own contig and strand and its attributes (other than gene_id
+# and transcript_id, as a JSON list of name, value pairs). Intron
+# intervals are precomputed for each transcript.
+#
+# The store for GTFFILE is expected at GTFFILE + GENESET_STORE_SUFFIX.
+
+GENESET_STORE_MAGIC = b"ICLIPGS1"
+GENESET_STORE_SUFFIX = ".gstore"
+GENESET_STORE_VERSION = 2
+
+_STRANDS = ["+", "-", "."]
+
+
+def _stringTable(values):
+    ''' Returns a list of the distinct values and a dictionary mapping
+    each to its index in the list '''
+
+    table = sorted(set(values))
+    return table, dict((value, i) for i, value in enumerate(table))
+
+
+def _dotField(value):
+    ''' A GTF score or frame field as a string. pysam proxies give
+    empty (".") fields as None '''
+
+    return "." if value is None else str(value)
+
+
+def entryAttributes(entry):
+    ''' The attributes of a GTF entry, other than gene_id and
+    transcript_id, as an ordered dictionary. Entries from GTF.iterator
+    are pysam proxies, whose attributes are the unparsed attribute
+    field. Entries from a geneset store are GTF.Entry objects, whose
+    attributes are already a dictionary '''
+
+    if not isinstance(entry.attributes, basestring):
+        return entry.attributes
+
+    return collections.OrderedDict(
+        (key, entry[key]) for key in entry.keys()
+        if key not in ("gene_id", "transcript_id"))
+
+
+def writeGenesetStore(gtf_iterator, outfile, gtffile=None):
+    ''' Compile the GTF entries from gtf_iterator into a geneset store
+    saved to outfile. If gtffile is given the store is keyed on its size
+    and mtime. Returns the number of genes '''
+
+    genes = collections.OrderedDict()
+    for entry in gtf_iterator:
+        genes.setdefault(entry.gene_id, collections.OrderedDict()).setdefault(
+            entry.transcript_id, []).append(entry)
+
+    gene_ids = list(genes)
+    transcripts = [transcript for gene in genes.values()
+                   for transcript in gene.values()]
+    entries = [entry for transcript in transcripts for entry in transcript]
+
+    entry_attributes = []
+    for entry in entries:
+        attributes = list(entryAttributes(entry).items())
+        entry_attributes.append(json.dumps(attributes) if attributes
+                                else None)
+
+    contigs, contig_index = _stringTable(x.contig for x in entries)
+    sources, source_index = _stringTable(x.source for x in entries)
+    features, feature_index = _stringTable(x.feature for x in entries)
+    scores, score_index = _stringTable(_dotField(x.score) for x in entries)
+    attributes, attributes_index = _stringTable(
+        x for x in entry_attributes if x is not None)
+
+    introns = [GTF.toIntronIntervals(transcript)
+               for transcript in transcripts]
+
+    arrays = collections.OrderedDict()
+
+    arrays["gene_transcripts"] = np.cumsum(
+        [0] + [len(gene) for gene in genes.values()]).astype("<i8")
+
+    arrays["transcript_entries"] = np.cumsum(
+        [0] + [len(transcript) for transcript in transcripts]).astype("<i8")
+    arrays["transcript_introns"] = np.cumsum(
+        [0] + [len(x) for x in introns]).astype("<i8")
+
+    arrays["entry_contig"] = np.array(
+        [contig_index[x.contig] for x in entries], dtype="<i4")
+    arrays["entry_strand"] = np.array(
+        [_STRANDS.index(x.strand) for x in entries], dtype="<i1")
+    arrays["entry_feature"] = np.array(
+        [feature_index[x.feature] for x in entries], dtype="<i4")
+    arrays["entry_source"] = np.array(
+        [source_index[x.source] for x in entries], dtype="<i4")
+    arrays["entry_score"] = np.array(
+        [score_index[_dotField(x.score)] for x in entries], dtype="<i4")
+    arrays["entry_start"] = np.array([x.start for x in entries], dtype="<i8")
+    arrays["entry_end"] = np.array([x.end for x in entries], dtype="<i8")
+    arrays["entry_frame"] = np.array(
+        [-1 if _dotField(x.frame) == "." else int(x.frame)
+         for x in entries],
+        dtype="<i1")
+    arrays["entry_attributes"] = np.array(
+        [-1 if x is None else attributes_index[x] for x in entry_attributes],
+        dtype="<i4")
+
+    arrays["intron_start"] = np.array(
+        [start for x in introns for start, end in x], dtype="<i8")
+    arrays["intron_end"] = np.array(
+        [end for x in introns for start, end in x], dtype="<i8")
+
+    layout = collections.OrderedDict()
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"offset": offset,
+                        "size": len(array),
+                        "dtype": array.dtype.str}
+        offset = _align(offset + array.nbytes)
+
+    header = {"version": GENESET_STORE_VERSION,
+              "gtf": _fileSignature(gtffile) if gtffile else None,
+              "contigs": contigs,
+              "sources": sources,
+              "features": features,
+              "scores": scores,
+              "attributes": attributes,
+              "gene_ids": gene_ids,
+              "transcript_ids": [transcript[0].transcript_id
+                                 for transcript in transcripts],
+              "arrays": layout}
+    header = json.dumps(header).encode("utf-8")
+
+    data_start = _align(len(GENESET_STORE_MAGIC) + 8 + len(header))
+
+    with open(outfile, "wb") as outf:
+        outf.write(GENESET_STORE_MAGIC)
+        outf.write(struct.pack("<Q", len(header)))
+        outf.write(header)
+
+        for name, array in arrays.items():
+            outf.write(b"\0" * (data_start + layout[name]["offset"] -
+                                outf.tell()))
+            outf.write(array.tobytes())
+
+    return len(gene_ids)
+
+
+def setTranscriptToGene(genes):
+    ''' Takes an iterator of genes, as from GTF.gene_iterator, and yields
+    each gene as a single transcript with the gene_id as its
+    transcript_id, as gtf2gtf.py --method=set-transcript-to-gene '''
+
+    for gene in genes:
+        transcript = []
+        for entry in itertools.chain.from_iterable(gene):
+            entry.transcript_id = entry.gene_id
+            transcript.append(entry)
+
+        yield [transcript]
+
+
+def _fromJSON(value):
+    ''' Strings from json are unicode, but GTF entries hold str '''
+
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    return value
+
+
+class GenesetStore:
+    ''' Read access to a geneset store. Genes are returned in the same
+    form as GTF.gene_iterator, a list of transcripts, each a list of
+    GTF.Entry objects, and can be iterated over in order or looked up
+    by gene_id. Arrays are memory mapped.
+
+    Stores written in an older format raise ValueError, so that
+    findGenesetStore ignores them. '''
+
+    def __init__(self, infile):
+
+        with open(infile, "rb") as inf:
+
+            if inf.read(len(GENESET_STORE_MAGIC)) != GENESET_STORE_MAGIC:
+                raise ValueError("%s is not a geneset store" % infile)
+
+            header_length = struct.unpack("<Q", inf.read(8))[0]
+            header = json.loads(inf.read(header_length).decode("utf-8"))
+
+        if header.get("version") != GENESET_STORE_VERSION:
+            raise ValueError("%s is an old format geneset store, and must "
+                             "be rebuilt" % infile)
+
+        self.filename = infile
+        self.header = header
+        data_start = _align(len(GENESET_STORE_MAGIC) + 8 + header_length)
+
+        for table in ("contigs", "sources", "features", "scores",
+                      "attributes", "gene_ids", "transcript_ids"):
+            setattr(self, table, [_fromJSON(x) for x in header[table]])
+
+        for name, layout in header["arrays"].items():
+            if layout["size"] == 0:
+                array = np.array([], dtype=layout["dtype"])
+            else:
+                array = np.memmap(infile, dtype=layout["dtype"], mode="r",
+                                  shape=(layout["size"],),
+                                  offset=data_start + layout["offset"])
+            setattr(self, str(name), array)
+
+        self._gene_index = None
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def _entry(self, i, gene, transcript):
+
+        entry = GTF.Entry()
+        entry.contig = self.contigs[self.entry_contig[i]]
+        entry.strand = _STRANDS[self.entry_strand[i]]
+        entry.gene_id = self.gene_ids[gene]
+        entry.transcript_id = self.transcript_ids[transcript]
+        entry.source = self.sources[self.entry_source[i]]
+        entry.feature = self.features[self.entry_feature[i]]
+        entry.score = self.scores[self.entry_score[i]]
+        entry.start = int(self.entry_start[i])
+        entry.end = int(self.entry_end[i])
+        frame = self.entry_frame[i]
+        entry.frame = "." if frame < 0 else str(frame)
+
+        attributes = self.entry_attributes[i]
+        if attributes >= 0:
+            for name, value in json.loads(self.attributes[attributes]):
+                entry.attributes[_fromJSON(name)] = _fromJSON(value)
+
+        return entry
+
+    def _transcript(self, transcript, gene, sort=False):
+
+        entries = range(self.transcript_entries[transcript],
+                        self.transcript_entries[transcript + 1])
+
+        if sort:
+            entries = sorted(entries,
+                             key=lambda i: (self.contigs[self.entry_contig[i]],
+                                            self.entry_start[i]))
+
+        return [self._entry(i, gene, transcript) for i in entries]
+
+    def getGene(self, gene_id):
+        ''' Return the transcripts of gene gene_id '''
+
+        if self._gene_index is None:
+            self._gene_index = dict((gene_id, i) for i, gene_id
+                                    in enumerate(self.gene_ids))
+
+        return self._gene(self._gene_index[gene_id])
+
+    __getitem__ = getGene
+
+    def _gene(self, gene, sort=False):
+
+        transcripts = range(self.gene_transcripts[gene],
+                            self.gene_transcripts[gene + 1])
+
+        if sort:
+            transcripts = sorted(transcripts,
+                                 key=lambda t: self.transcript_ids[t])
+
+        return [self._transcript(transcript, gene, sort)
+                for transcript in transcripts]
+
+    def iterGenes(self, sort=False):
+        ''' Iterate over the genes in the store, in the order of the GTF
+        file. If sort is True, genes are sorted on gene_id, transcripts
+        on transcript_id and entries on position, as gtf2gtf.py
+        --method=sort --sort-order=gene+transcript would sort them '''
+
+        genes = range(len(self))
+
+        if sort:
+            genes = sorted(genes, key=lambda g: self.gene_ids[g])
+
+        return (self._gene(gene, sort) for gene in genes)
+
+    __iter__ = iterGenes
+
+    def getIntrons(self, transcript):
+        ''' Return the precomputed intron intervals of the transcript with
+        index transcript '''
+
+        first = self.transcript_introns[transcript]
+        last = self.transcript_introns[transcript + 1]
+
+        return zip(self.intron_start[first:last].tolist(),
+                   self.intron_end[first:last].tolist())
+
+    def iterTranscripts(self, introns=False):
+        ''' Iterate over the transcripts in the store. If introns is
+        True, yield (transcript, introns) tuples, the introns being
+        precomputed as GTF.toIntronIntervals '''
+
+        for gene in range(len(self)):
+            for transcript in range(self.gene_transcripts[gene],
+                                    self.gene_transcripts[gene + 1]):
+                if introns:
+                    yield (self._transcript(transcript, gene),
+                           self.getIntrons(transcript))
+                else:
+                    yield self._transcript(transcript, gene)
+
+
+def buildGenesetStore(gtffile, outfile=None):
+    ''' Parse gtffile and compile it into a geneset store. By default the
+    store is saved next to the GTF file. Returns the number of genes '''
+
+    if outfile is None:
+        outfile = gtffile + GENESET_STORE_SUFFIX
+
+    return writeGenesetStore(GTF.iterator(IOTools.openFile(gtffile)),
+                             outfile, gtffile)
+
+
+def findGenesetStore(gtffile):
+    ''' Open the geneset store for gtffile, if one exists and is up to
+    date with the GTF file. Returns None otherwise, in which case the
+    GTF file should be parsed '''
+
+    store_file = gtffile + GENESET_STORE_SUFFIX
+
+    if not os.path.exists(store_file):
+        return None
+
+    try:
+        store = GenesetStore(store_file)
+    except ValueError as e:
+        E.warning(str(e))
+        return None
+
+    if store.header["gtf"] != _fileSignature(gtffile):
+        E.warning("Geneset store %s is out of date, ignoring" % store_file)
+        return None
+
+    E.info("Using geneset store %s" % store_file)
+    return store
+
+
+###################################################################
+# BigWig output
+#
+# A minimal writer for the UCSC bigWig format (version 4), so that
+# crosslink counts can be written straight from their arrays without
+# going via wig text and wigToBigWig. Data are written as variableStep
+# sections with a span of one base, compressed with zlib, indexed with
+# an R tree and summarised at several zoom levels.
+
+BIGWIG_MAGIC = 0x888FFC26
+_BPT_MAGIC = 0x78CA8C91
+_CIRTREE_MAGIC = 0x2468ACE0
+_BIGWIG_HEADER = struct.Struct("<IHHQQQHHQQIQ")
+_ZOOM_HEADER = struct.Struct("<IIQQ")
+_SUMMARY = struct.Struct("<Qdddd")
+_SECTION_HEADER = struct.Struct("<IIIIIBBH")
+_VARSTEP_ITEM = np.dtype([("start", "<u4"), ("value", "<f4")])
+_ZOOM_RECORD = np.dtype([("chrom", "<u4"), ("start", "<u4"), ("end", "<u4"),
+                         ("valid", "<u4"), ("min", "<f4"), ("max", "<f4"),
+                         ("sum", "<f4"), ("sum_squares", "<f4")])
+
+# resolutions of the zoom levels that may be written. A level is only
+# kept if it is less than half the size of the last level kept (or of
+# the data).
+ZOOM_REDUCTIONS = [32 * 4 ** level for level in range(10)]
+
+
+def _writeChromTree(outf, chroms, block_size=256):
+    ''' Write the B+ tree mapping chromosome names to ids and sizes.
+    chroms is a list of (name, id, size) tuples '''
+
+    chroms = sorted(chroms)
+    n = len(chroms)
+    key_size = max([len(name) for name, chrom_id, size in chroms] + [1])
+    block_size = max(1, min(block_size, n))
+
+    outf.write(struct.pack("<IIIIQQ", _BPT_MAGIC, block_size, key_size, 8,
+                           n, 0))
+
+    def _key(i):
+        name = chroms[i][0]
+        if not isinstance(name, bytes):
+            name = name.encode("ascii")
+        return name + b"\0" * (key_size - len(name))
+
+    levels = 1
+    while block_size ** levels < n:
+        levels += 1
+
+    # keys and values (chrom_id, size) or child offsets are both 8
+    # bytes, so leaves and other nodes are the same size
+    node_block = 4 + block_size * (key_size + 8)
+    offset = outf.tell()
+
+    # non-leaf levels, from the root down
+    for level in range(levels - 1, 0, -1):
+        slot_size = block_size ** level
+        node_size = slot_size * block_size
+        node_count = (n + node_size - 1) // node_size
+        next_child = offset + node_count * node_block
+
+        for first in range(0, n, node_size):
+            count = min(block_size, (n - first + slot_size - 1) // slot_size)
+            outf.write(struct.pack("<BBH", 0, 0, count))
+            for j in range(count):
+                outf.write(_key(first + j * slot_size))
+                outf.write(struct.pack("<Q", next_child))
+                next_child += node_block
+            outf.write(b"\0" * ((block_size - count) * (key_size + 8)))
+
+        offset = outf.tell()
+
+    for first in range(0, n, block_size):
+        count = min(block_size, n - first)
+        outf.write(struct.pack("<BBH", 1, 0, count))
+        for i in range(first, first + count):
+            outf.write(_key(i))
+            outf.write(struct.pack("<II", chroms[i][1], chroms[i][2]))
+        outf.write(b"\0" * ((block_size - count) * (key_size + 8)))
+
+
+def _writeRTree(outf, blocks, end_offset, items_per_slot, block_size=256):
+    ''' Write the R tree indexing the data blocks. blocks is a list of
+    (chrom_id, start, end, offset, size) tuples, sorted on chrom_id and
+    start '''
+
+    node_header = struct.Struct("<BBH")
+    leaf_item = struct.Struct("<IIIIQQ")
+    index_item = struct.Struct("<IIIIQ")
+
+    extents = [(chrom_id, start, chrom_id, end)
+               for chrom_id, start, end, offset, size in blocks]
+
+    def _group(children):
+        return [children[i:i + block_size]
+                for i in range(0, len(children), block_size)] or [[]]
+
+    def _extent(node):
+        return (node[0][0], node[0][1], node[-1][2], node[-1][3])
+
+    # group blocks into leaves, and then nodes into parents, until there
+    # is a single root. levels[0] are the leaves.
+    levels = [_group(extents)]
+    while len(levels[-1]) > 1:
+        levels.append(_group([_extent(node) for node in levels[-1]]))
+
+    outf.write(struct.pack("<IIQIIIIQII", _CIRTREE_MAGIC, block_size,
+                           len(blocks),
+                           *(_extent(extents) if extents else (0, 0, 0, 0)) +
+                           (end_offset, items_per_slot, 0)))
+
+    leaf_size = node_header.size + block_size * leaf_item.size
+    index_size = node_header.size + block_size * index_item.size
+
+    # nodes are written from the root down
+    level_offsets = {}
+    offset = outf.tell()
+    for level in reversed(range(len(levels))):
+        level_offsets[level] = offset
+        offset += len(levels[level]) * (leaf_size if level == 0
+                                        else index_size)
+
+    for level in reversed(range(1, len(levels))):
+        child_size = leaf_size if level == 1 else index_size
+        child = 0
+        for node in levels[level]:
+            outf.write(node_header.pack(0, 0, len(node)))
+            for extent in node:
+                outf.write(index_item.pack(
+                    *extent + (level_offsets[level - 1] +
+                               child * child_size,)))
+                child += 1
+            outf.write(b"\0" * ((block_size - len(node)) * index_item.size))
+
+    for first in range(0, max(1, len(blocks)), block_size):
+        leaf = blocks[first:first + block_size]
+        outf.write(node_header.pack(1, 0, len(leaf)))
+        for chrom_id, start, end, block_offset, size in leaf:
+            outf.write(leaf_item.pack(chrom_id, start, chrom_id, end,
+                                      block_offset, size))
+        outf.write(b"\0" * ((block_size - len(leaf)) * leaf_item.size))
+
+
+class BigWigWriter:
+    ''' Writes a bigWig file from arrays of positions and values, one
+    contig at a time, in a single pass.
+
+    chrom_sizes is a list of (contig, length) tuples, and contigs must be
+    added, with addContig, in that order. Data for each contig are
+    compressed and written as they are added; only the block index and
+    the zoom level summaries, which are much smaller, are held until
+    close is called.
+
+    All coordinates are zero-based. Positions outside of their contig
+    cannot be stored, and are dropped with a warning. The number dropped
+    is kept in dropped. '''
+
+    def __init__(self, outfile, chrom_sizes, items_per_slot=1024,
+                 block_size=256, compress=True):
+
+        self.outfile = outfile
+        self.chrom_sizes = list(chrom_sizes)
+        self.chrom_ids = dict((chrom, i) for i, (chrom, size)
+                              in enumerate(self.chrom_sizes))
+        self.items_per_slot = items_per_slot
+        self.block_size = block_size
+        self.compress = compress
+
+        self.outf = open(outfile, "wb")
+        self.next_chrom = 0
+
+        self.blocks = []
+        self.max_block = 0
+        self.zooms = [[] for reduction in ZOOM_REDUCTIONS]
+
+        self.bases = 0
+        self.dropped = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+        self.sum_squares = 0.0
+
+        # space for the header, zoom headers and summary, which are
+        # written when the file is closed
+        self.outf.write(b"\0" * (_BIGWIG_HEADER.size +
+                                 len(ZOOM_REDUCTIONS) * _ZOOM_HEADER.size +
+                                 _SUMMARY.size))
+        self.chrom_tree_offset = self.outf.tell()
+        _writeChromTree(self.outf,
+                        [(chrom, i, size) for i, (chrom, size)
+                         in enumerate(self.chrom_sizes)])
+
+        self.data_offset = self.outf.tell()
+        self.outf.write(struct.pack("<Q", 0))
+
+    def _writeBlock(self, data):
+        ''' Write a (compressed) block, returning its offset and size '''
+
+        self.max_block = max(self.max_block, len(data))
+        if self.compress:
+            data = zlib.compress(data)
+
+        offset = self.outf.tell()
+        self.outf.write(data)
+        return offset, len(data)
+
+    def addContig(self, chrom, positions, values):
+        ''' Write the values at the sorted positions on chrom '''
+
+        chrom_id = self.chrom_ids[chrom]
+        if chrom_id < self.next_chrom:
+            raise ValueError("Contig %s added out of order" % chrom)
+        self.next_chrom = chrom_id + 1
+
+        positions = np.asarray(positions, dtype="int64")
+        values = np.asarray(values, dtype="float64")
+        chrom_size = self.chrom_sizes[chrom_id][1]
+
+        # crosslinks can fall off the end of a contig, for example at
+        # base -1 for a read on the positive strand starting at base 0
+        inside = (positions >= 0) & (positions < chrom_size)
+        if not inside.all():
+            dropped = len(positions) - int(inside.sum())
+            E.warning("Dropping %i positions outside of contig %s (length "
+                      "%i)" % (dropped, chrom, chrom_size))
+            self.dropped += dropped
+            positions = positions[inside]
+            values = values[inside]
+
+        if len(positions) == 0:
+            return
+
+        self.bases += len(positions)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sum += values.sum()
+        self.sum_squares += (values ** 2).sum()
+
+        items = np.zeros(len(positions), dtype=_VARSTEP_ITEM)
+        items["start"] = positions
+        items["value"] = values
+
+        for first in range(0, len(items), self.items_per_slot):
+            section = items[first:first + self.items_per_slot]
+            start = int(section["start"][0])
+            end = int(section["start"][-1]) + 1
+            header = _SECTION_HEADER.pack(chrom_id, start, end, 0, 1, 2, 0,
+                                          len(section))
+            offset, size = self._writeBlock(header + section.tobytes())
+            self.blocks.append((chrom_id, start, end, offset, size))
+
+        for zoom, reduction in zip(self.zooms, ZOOM_REDUCTIONS):
+            bins, first = np.unique(positions // reduction, return_index=True)
+            records = np.zeros(len(bins), dtype=_ZOOM_RECORD)
+            records["chrom"] = chrom_id
+            records["start"] = bins * reduction
+            records["end"] = np.minimum((bins + 1) * reduction, chrom_size)
+            records["valid"] = np.diff(np.append(first, len(positions)))
+            records["min"] = np.minimum.reduceat(values, first)
+            records["max"] = np.maximum.reduceat(values, first)
+            records["sum"] = np.add.reduceat(values, first)
+            records["sum_squares"] = np.add.reduceat(values ** 2, first)
+            zoom.append(records)
+
+    def _writeZoom(self, records):
+        ''' Write one zoom level, returning the offsets of its data and
+        index '''
+
+        data_offset = self.outf.tell()
+        self.outf.write(struct.pack("<I", len(records)))
+
+        # blocks do not span contigs
+        blocks = []
+        chrom_starts = np.flatnonzero(np.diff(records["chrom"])) + 1
+        for chrom_records in np.split(records, chrom_starts):
+            for first in range(0, len(chrom_records), self.items_per_slot):
+                section = chrom_records[first:first + self.items_per_slot]
+                offset, size = self._writeBlock(section.tobytes())
+                blocks.append((int(section["chrom"][0]),
+                               int(section["start"][0]),
+                               int(section["end"][-1]),
+                               offset, size))
+
+        index_offset = self.outf.tell()
+        _writeRTree(self.outf, blocks, index_offset, self.items_per_slot,
+                    self.block_size)
+
+        return data_offset, index_offset
+
+    def close(self):
+
+        index_offset = self.outf.tell()
+        _writeRTree(self.outf, self.blocks, index_offset,
+                    self.items_per_slot, self.block_size)
+
+        zoom_headers = []
+        previous = self.bases
+        for reduction, zoom in zip(ZOOM_REDUCTIONS, self.zooms):
+            if len(zoom) == 0:
+                break
+
+            records = np.concatenate(zoom)
+            if len(records) * 2 > previous:
+                continue
+
+            data_offset, zoom_index = self._writeZoom(records)
+            zoom_headers.append((reduction, data_offset, zoom_index))
+            previous = len(records)
+
+        # fill in the number of data blocks, the header and summary
+        self.outf.seek(self.data_offset)
+        self.outf.write(struct.pack("<Q", len(self.blocks)))
+
+        self.outf.seek(0)
+        self.outf.write(_BIGWIG_HEADER.pack(
+            BIGWIG_MAGIC, 4, len(zoom_headers), self.chrom_tree_offset,
+            self.data_offset, index_offset, 0, 0, 0,
+            _BIGWIG_HEADER.size + len(ZOOM_REDUCTIONS) * _ZOOM_HEADER.size,
+            self.max_block if self.compress else 0, 0))
+
+        for reduction, data_offset, zoom_index in zoom_headers:
+            self.outf.write(_ZOOM_HEADER.pack(reduction, 0, data_offset,
+                                              zoom_index))
+
+        self.outf.seek(_BIGWIG_HEADER.size +
+                       len(ZOOM_REDUCTIONS) * _ZOOM_HEADER.size)
+
+        if self.bases > 0:
+            self.outf.write(_SUMMARY.pack(self.bases, self.min, self.max,
+                                          self.sum, self.sum_squares))
+        else:
+            self.outf.write(_SUMMARY.pack(0, 0, 0, 0, 0))
+
+        self.outf.close()
+
+
+
+###################################################################
+# BAM QC
+#
+# The QC statistics collected on each deduplicated BAM (alignment length
+# histogram, UMI histogram, number of spliced alignments and flag
+# statistics) each have an accumulator, with add(read) and write(outfile)
+# methods, so that any combination can be gathered in one pass over the
+# file. See bam_qc.py.
+
+# flag statistics reported, with the flag (or property) that defines them,
+# named as by bam2stats.py
+BAM_FLAG_CATEGORIES = [
+    ("alignments_paired", 0x1),
+    ("alignments_proper_pair", 0x2),
+    ("alignments_unmapped", 0x4),
+    ("alignments_mate_unmapped", 0x8),
+    ("alignments_reverse", 0x10),
+    ("alignments_mate_reverse", 0x20),
+    ("alignments_read1", 0x40),
+    ("alignments_read2", 0x80),
+    ("alignments_secondary", 0x100),
+    ("alignments_qc_fail", 0x200),
+    ("alignments_duplicate", 0x400),
+    ("alignments_supplementary", 0x800)]
+
+
+class LengthHistogram:
+    ''' Histogram of aligned lengths, or with paired, fragment lengths
+    for reads with an aligned length of at least paired, as
+    length_stats.py. Only reads placed on a reference are counted, as
+    when iterating over an indexed BAM with fetch() '''
+
+    def __init__(self, paired=None):
+
+        self.paired = paired
+        self.counts = collections.defaultdict(int)
+        self.nreads = 0
+        self.nlonger = 0
+
+    def add(self, read):
+
+        if read.reference_id < 0 or read.is_read2 or read.is_unmapped \
+           or read.mate_is_unmapped:
+            return
+
+        self.nreads += 1
+        length = read.inferred_length - sum([l for o, l in read.cigar
+                                             if o == "S"])
+        if read.inferred_length > length:
+            self.nlonger += 1
+
+        if self.paired is not None and length >= self.paired:
+            splice_1 = max(0, read.alen - length)
+            self.counts[abs(read.tlen) - splice_1] += 1
+        else:
+            self.counts[length] += 1
+
+    def write(self, outfile):
+
+        outfile.write("Length\tCount\n")
+        for key in sorted(self.counts.keys()):
+            outfile.write("%i\t%i\n" % (key, self.counts[key]))
+
+
+class UMIHistogram:
+    ''' Histogram of UMIs, taken from the end of the read name, as
+    umi_hist.py. Only reads placed on a reference are counted '''
+
+    def __init__(self):
+
+        self.counts = collections.defaultdict(int)
+
+    def add(self, read):
+
+        if read.reference_id < 0:
+            return
+
+        self.counts[read.query_name.split("_")[-1]] += 1
+
+    def write(self, outfile):
+
+        outfile.write("UMI\tCount\n")
+        for umi, count in self.counts.iteritems():
+            outfile.write("%s\t%i\n" % (umi, count))
+
+
+class SplicedCount:
+    ''' Number of alignments with an N in their CIGAR string '''
+
+    def __init__(self):
+
+        self.nspliced = 0
+
+    def add(self, read):
+
+        cigar = read.cigartuples
+        if cigar is not None and any(operation == 3
+                                     for operation, length in cigar):
+            self.nspliced += 1
+
+    def write(self, outfile):
+
+        outfile.write("%i\n" % self.nspliced)
+
+
+class FlagStats:
+    ''' Flag statistics, in the format of bam2stats.py. All alignments
+    are counted, and reads are counted from their primary alignments '''
+
+    def __init__(self):
+
+        self.flags = collections.defaultdict(int)
+        self.nalignments = 0
+        self.reads_mapped = 0
+        self.reads_unmapped = 0
+
+    def add(self, read):
+
+        self.nalignments += 1
+
+        flag = read.flag
+        for category, bit in BAM_FLAG_CATEGORIES:
+            if flag & bit:
+                self.flags[category] += 1
+
+        # each read has one primary alignment, mapped or not
+        if not flag & 0x900:
+            if flag & 0x4:
+                self.reads_unmapped += 1
+            else:
+                self.reads_mapped += 1
+
+    def write(self, outfile):
+        ''' Write flag statistics as category, counts, percent and the
+        category the percentage is of '''
+
+        rows = [("alignments_total", self.nalignments, "alignments_total"),
+                ("alignments_mapped",
+                 self.nalignments - self.flags["alignments_unmapped"],
+                 "alignments_total")]
+        rows.extend((category, self.flags[category], "alignments_total")
+                    for category, bit in BAM_FLAG_CATEGORIES)
+
+        reads_total = self.reads_mapped + self.reads_unmapped
+        rows.extend([("reads_total", reads_total, "reads_total"),
+                     ("reads_mapped", self.reads_mapped, "reads_total"),
+                     ("reads_unmapped", self.reads_unmapped, "reads_total")])
+
+        totals = {"alignments_total": self.nalignments,
+                  "reads_total": reads_total}
+
+        outfile.write("category\tcounts\tpercent\tof\n")
+        for category, count, of in rows:
+            if totals[of] > 0:
+                percent = 100.0 * count / totals[of]
+            else:
+                percent = 0.0
+            outfile.write("%s\t%i\t%5.2f\t%s\n"
+                          % (category, count, percent, of))
+
+
+def _summedDistances(positions, profile2):
+    ''' For each of positions, the sum of its distances to every
+    location in profile2, weighted by the counts of profile2. profile2
+    is sorted once, and sums found from prefix sums of its counts and
+    count weighted locations, in O(n log n) rather than forming every
+    pair. Returns the sums and the total count of profile2 '''
+
+    order = np.argsort(profile2.index.values, kind="mergesort")
+    locations2 = profile2.index.values[order].astype("float64")
+    counts2 = profile2.values[order].astype("float64")
+
+    cum_counts = np.concatenate([[0], np.cumsum(counts2)])
+    cum_weighted = np.concatenate([[0], np.cumsum(counts2 * locations2)])
+
+    positions = np.asarray(positions, dtype="float64")
+    below = np.searchsorted(locations2, positions, side="right")
+    counts_below = cum_counts[below]
+    weighted_below = cum_weighted[below]
+
+    distances = (positions * counts_below - weighted_below +
+                 (cum_weighted[-1] - weighted_below) -
+                 positions * (cum_counts[-1] - counts_below))
+
+    return distances, cum_counts[-1]
+
+
+def _nearestDistances(positions, locations2):
+    ''' Distance from each of positions to the nearest of the sorted
+    array locations2, found by binary search '''
+
+    positions = np.asarray(positions, dtype="float64")
+    locations2 = locations2.astype("float64")
+
+    after = np.searchsorted(locations2, positions)
+    before = np.maximum(after - 1, 0)
+    after = np.minimum(after, len(locations2) - 1)
+
+    return np.minimum(np.abs(positions - locations2[before]),
+                      np.abs(locations2[after] - positions))
+
+
 def calcAverageDistance(profile1, profile2):
     ''' This function calculates the average distance of all
-    pairwise distances in two profiles'''
+    pairwise distances in two profiles, weighted by the product of
+    their counts. Profiles need not be sorted. '''
 
-    def _cartesian(x, y):
-        return np.transpose([np.tile(x, len(y)), np.repeat(y, len(x))])
+    if len(profile2) == 0:
+        return np.nan
 
-    positions = _cartesian(profile1.index.values, profile2.index.values)
-    counts = _cartesian(profile1.values, profile2.values)
-    counts = np.prod(counts, axis=1)
-    distances = np.abs(positions[:, 0] - positions[:, 1])
-    mean_distance = (distances.astype("float64") * counts).sum() / np.sum(counts)
+    distances, total2 = _summedDistances(profile1.index.values, profile2)
+    counts1 = profile1.values.astype("float64")
 
-    return mean_distance
+    return (counts1 * distances).sum() / (counts1.sum() * total2)
 
 
 def findMinDistance(profile1, profile2):
     '''Finds mean distance between each read in profile1
-    and a read in profile2'''
+    and a read in profile2. Profiles need not be sorted.'''
+
+    if len(profile2) == 0:
+        return np.nan
+
+    locations2 = np.sort(profile2.index.values)
+
+    return _nearestDistances(profile1.index.values, locations2).mean()
+
+
+def _randomIntegers(rng, low, high, size):
+    ''' Random integers in [low, high) from rng, which can be a
+    np.random.Generator, a np.random.RandomState or the np.random
+    module '''
+
+    if hasattr(rng, "integers"):
+        return rng.integers(low, high, size)
+
+    return rng.randint(low, high, size)
+
+
+def _randomFloats(rng, size):
+    ''' Random floats in [0, 1) from rng, as for _randomIntegers '''
 
-    locations1 = profile1.index.values
+    if hasattr(rng, "random_sample"):
+        return rng.random_sample(size)
 
-    locations2 = profile2.index.values # .astype("int16")
+    return rng.random(size)
 
-    mat1 = np.repeat(locations1, locations2.size).reshape(
-        (locations1.size, locations2.size))
-    mat2 = np.tile(locations2, locations1.size).reshape(
-        (locations1.size, locations2.size))
 
-    distances = np.abs(mat1-mat2).min(axis=1)
+# largest number of values in the matrices drawn or built for a batch of
+# permutations at once
+PERMUTATION_BATCH_SIZE = 2 ** 22
 
-    return distances.mean()
 
-def randomiseSites(profile, start, end, keep_dist=True):
+def _rowBatches(n_rows, row_size):
+    ''' (first, last) row ranges covering n_rows rows of row_size
+    values each, with no more than PERMUTATION_BATCH_SIZE values, or a
+    single row, in a batch '''
+
+    batch = max(1, PERMUTATION_BATCH_SIZE // max(1, row_size))
+    for first in range(0, n_rows, batch):
+        yield first, min(n_rows, first + batch)
+
+
+def randomPositions(start, end, n_perm, n_sites, replace=False, rng=None):
+    ''' Draw n_sites random positions in [start, end) for each of n_perm
+    permutations at once, returning an (n_perm, n_sites) integer matrix.
+    Rows are in the order drawn. Without replace, the positions in each
+    row are distinct.
+
+    rng is a np.random.Generator or np.random.RandomState, so that nulls
+    can be reproduced from a seed. By default the global numpy random
+    state is used. '''
+
+    if rng is None:
+        rng = np.random
+
+    length = end - start
+
+    if replace:
+        return _randomIntegers(rng, start, end, (n_perm, n_sites))
+
+    if n_sites > length:
+        raise ValueError("Cannot place %i sites in %i bases without "
+                         "replacement" % (n_sites, length))
+
+    if n_sites * n_sites > length:
+        # collisions are likely, so give every base of the region a
+        # random key and take the bases with the n_sites smallest, in
+        # order of key. Keys are drawn for a batch of rows at a time
+        positions = np.empty((n_perm, n_sites), dtype="int64")
+        for first, last in _rowBatches(n_perm, length):
+            keys = _randomFloats(rng, (last - first, length))
+            smallest = np.argpartition(keys, n_sites - 1,
+                                       axis=1)[:, :n_sites]
+            rows = np.arange(last - first)[:, np.newaxis]
+            order = keys[rows, smallest].argsort(axis=1)
+            positions[first:last] = smallest[rows, order] + start
+
+        return positions
+
+    # collisions are rare, so redraw only the permutations that have one
+    positions = _randomIntegers(rng, start, end, (n_perm, n_sites))
+    while True:
+        ordered = np.sort(positions, axis=1)
+        collided = (np.diff(ordered, axis=1) == 0).any(axis=1)
+        if not collided.any():
+            return positions
+
+        positions[collided] = _randomIntegers(
+            rng, start, end, (int(collided.sum()), n_sites))
+
+
+def permuteProfile(profile, start, end, n_perm, keep_dist=True, rng=None):
+    ''' Batched version of randomiseSites: randomise the sites of
+    profile within [start, end) n_perm times. Returns (positions, counts),
+    two (n_perm, n_sites) matrices with each row sorted on position.
+
+    If keep_dist is True, reads on the same base are kept together, so
+    rows have the counts of profile at distinct positions. Otherwise each
+    read is placed independently, and rows have a count of 1 for every
+    read, so the same position can appear more than once. '''
+
+    if keep_dist:
+        positions = randomPositions(start, end, n_perm, profile.size,
+                                    rng=rng)
+        order = positions.argsort(axis=1)
+        rows = np.arange(n_perm)[:, np.newaxis]
+        return positions[rows, order], profile.values[order]
+
+    n_reads = int(profile.sum())
+    positions = randomPositions(start, end, n_perm, n_reads, replace=True,
+                                rng=rng)
+    positions.sort(axis=1)
+
+    return positions, np.ones((n_perm, n_reads), dtype="int64")
+
+
+def randomiseSites(profile, start, end, keep_dist=True, rng=None):
     '''Randomise clipped sites within an interval (between start and end)
     if keep_dist is true, then reads on the same base are kept togehter'''
 
+    positions, counts = permuteProfile(profile, start, end, 1,
+                                       keep_dist=keep_dist, rng=rng)
+
     if keep_dist:
+        return pd.Series(counts[0], index=positions[0])
 
-        profile = profile.copy()
-        profile.index = np.random.choice(
-            np.arange(start, end), profile.size, replace=False)
-        profile = profile.sort_index()
-        return profile
+    randomised = pd.Series(positions[0]).value_counts().sort_index()
+    return randomised
+
+class ProfileBuffer:
+    ''' Reusable arrays for dense profiles and their prefix sums. They
+    grow as needed but are not reallocated for each profile, so repeated
+    spreads and correlations, such as over the permutations of a null
+    distribution, do not allocate a gene length array every time '''
+
+    def __init__(self, size=0):
+
+        self.dense_array = np.zeros(size)
+        self.cumulative_array = np.zeros(size + 1)
+
+    def _reserve(self, length):
+
+        if len(self.dense_array) < length:
+            size = max(length, 2 * len(self.dense_array))
+            self.dense_array = np.zeros(size)
+            self.cumulative_array = np.zeros(size + 1)
+
+    def dense(self, positions, counts, start, end):
+        ''' Counts at every base in [start, end), as a view on the
+        buffer. Positions outside the range are ignored, positions
+        must be unique '''
+
+        length = end - start
+        self._reserve(length)
+
+        dense = self.dense_array[:length]
+        dense[:] = 0
+
+        positions = np.asarray(positions)
+        inside = (positions >= start) & (positions < end)
+        dense[positions[inside].astype("int64") - start] = \
+            np.asarray(counts)[inside]
+
+        return dense
+
+    def windowSums(self, values, bases):
+        ''' Sum of values over a window of bases either side of each
+        entry, for the entries with a complete window (all but the first and
+        last bases entries). A box filter on a prefix sum '''
+
+        width = 2 * bases + 1
+        if len(values) < width:
+            return np.zeros(0)
+
+        self._reserve(len(values))
+        cumulative = self.cumulative_array[:len(values) + 1]
+        cumulative[0] = 0
+        np.cumsum(values, out=cumulative[1:])
+
+        return cumulative[width:] - cumulative[:-width]
+
+
+_profile_buffers = (ProfileBuffer(), ProfileBuffer())
+
+
+def spread(profile, bases, reindex=True, buffer=None):
+    ''' Sum of profile over a window of bases either side of each base.
+    With reindex, the window sum is calculated for every base from bases
+    before the first site to bases after the last. Otherwise profile is
+    assumed to already have an entry for every base, and only bases with
+    a complete window are returned. buffer is a ProfileBuffer to use '''
+
+    if buffer is None:
+        buffer = _profile_buffers[0]
 
-    else:
-        randomised = np.random.choice(
-            np.arange(start, end), profile.sum(), replace=True)
-        randomised = pd.Series(randomised).value_counts().sort_index()
-        return randomised
-
-def spread(profile, bases, reindex=True):
-   
-    start = int(profile.index[0] - 2*bases)
-    end = int(profile.index[-1] + 2*bases+1)
-    
     if reindex:
-        profile = profile.reindex(range(start, end))
-        profile = profile.fillna(0)
+        start = int(profile.index[0] - 2*bases)
+        end = int(profile.index[-1] + 2*bases+1)
+        values = buffer.dense(profile.index.values, profile.values,
+                              start, end)
+        index = np.arange(start + bases, end - bases)
+    else:
+        values = profile.values.astype("float64")
+        index = profile.index.values[bases:len(profile) - bases]
+
+    return pd.Series(buffer.windowSums(values, bases), index=index)
+
+
+def _ranksWithZeros(values):
+    ''' Rank values, giving ties their average rank, as for pandas
+    rank. Values must not be negative. Spread profiles are mostly zeros,
+    which all share the lowest rank, so only the non-zero values are
+    sorted '''
+
+    ranks = np.empty(len(values))
+    nonzero = np.flatnonzero(values)
+    n_zeros = len(values) - len(nonzero)
+    ranks[:] = (n_zeros + 1) / 2.0
+
+    if len(nonzero) == 0:
+        return ranks
+
+    order = np.argsort(values[nonzero], kind="mergesort")
+    ordered = values[nonzero][order]
+
+    starts = np.flatnonzero(np.concatenate(
+        [[True], ordered[1:] != ordered[:-1]]))
+    run_lengths = np.diff(np.append(starts, len(ordered)))
+    mean_ranks = n_zeros + starts + (run_lengths + 1) / 2.0
+
+    ranks[nonzero[order]] = np.repeat(mean_ranks, run_lengths)
+
+    return ranks
+
+
+def _spearman(values1, values2):
+    ''' Spearman correlation of two arrays, ignoring pairs where
+    either is NaN, as pandas Series.corr does '''
+
+    present = ~(np.isnan(values1) | np.isnan(values2))
+    values1 = values1[present]
+    values2 = values2[present]
+
+    if len(values1) < 2:
+        return np.nan
+
+    ranks1 = _ranksWithZeros(values1)
+    ranks2 = _ranksWithZeros(values2)
+
+    ranks1 -= ranks1.mean()
+    ranks2 -= ranks2.mean()
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return ((ranks1 * ranks2).sum() /
+                np.sqrt((ranks1 ** 2).sum() * (ranks2 ** 2).sum()))
 
-    return pd.rolling_sum(profile, window=2*bases+1, center=True).dropna()
 
 def corr_profile(profile1, profile2, nspread, profile2_ready=False):
-    
-    profile1 = profile1.reindex(
-                    range(int(profile1.index.values.min())-1,
-                          int(profile1.index.values.max())+1)).fillna(0)
-    profile1 = spread(profile1,nspread, False)
-        
-    if not profile2_ready:
-       profile2 = profile2.reindex(
-                       range(int(profile2.index.values.min()),
-                             int(profile2.index.values.max()))).fillna(0)
-       profile2 = spread(profile2, nspread, False)
-        
-    return profile1.corr(profile2, method="spearman")
+    ''' Spearman correlation between the spread profiles of profile1
+    and profile2, over the bases where both are defined. If
+    profile2_ready, profile2 is already spread. Profiles are spread in
+    reusable dense buffers (see ProfileBuffer) '''
+
+    buffer1, buffer2 = _profile_buffers
+
+    start1 = int(profile1.index.values.min()) - 1
+    end1 = int(profile1.index.values.max()) + 1
+    spread1 = buffer1.windowSums(
+        buffer1.dense(profile1.index.values, profile1.values, start1, end1),
+        nspread)
+    start1 += nspread
+
+    if profile2_ready:
+        # pick out the bases of profile2 within the range of spread1
+        locations2 = profile2.index.values
+        inside = (locations2 >= start1) & \
+            (locations2 < start1 + len(spread1))
+        offsets = locations2[inside].astype("int64") - start1
+        return _spearman(spread1[offsets],
+                         profile2.values[inside].astype("float64"))
+
+    # as before, the last site of profile2 is not included
+    start2 = int(profile2.index.values.min())
+    end2 = int(profile2.index.values.max())
+    spread2 = buffer2.windowSums(
+        buffer2.dense(profile2.index.values, profile2.values, start2, end2),
+        nspread)
+    start2 += nspread
+
+    first = max(start1, start2)
+    last = min(start1 + len(spread1), start2 + len(spread2))
+
+    if last <= first:
+        return np.nan
+
+    return _spearman(spread1[first - start1:last - start1],
+                     spread2[first - start2:last - start2])
+
+
+def meanDistanceNull(positions, counts, profile2):
+    ''' calcAverageDistance for each row of a matrix of permuted
+    positions and counts (see permuteProfile) against profile2 '''
+
+    distances, total2 = _summedDistances(positions, profile2)
+    counts = counts.astype("float64")
+
+    return (counts * distances).sum(axis=1) / (counts.sum(axis=1) * total2)
+
+
+def minDistanceNull(positions, profile2):
+    ''' findMinDistance for each row of a matrix of permuted positions
+    (see permuteProfile) against profile2. Rows must be sorted. Each
+    distinct position is counted once, as in findMinDistance '''
+
+    distances = _nearestDistances(positions,
+                                  np.sort(profile2.index.values))
+
+    distinct = np.ones(positions.shape, dtype=bool)
+    distinct[:, 1:] = positions[:, 1:] != positions[:, :-1]
+
+    return (distances * distinct).sum(axis=1) / distinct.sum(axis=1)
+
+
+def _denseRows(positions, counts, start, end):
+    ''' Sum counts into an (n_rows, end - start) matrix of counts at
+    each base '''
+
+    n_rows = positions.shape[0]
+    length = end - start
+    cells = (np.arange(n_rows)[:, np.newaxis] * length +
+             (positions - start)).ravel()
+
+    return np.bincount(cells, weights=counts.ravel(),
+                       minlength=n_rows * length).reshape(n_rows, length)
+
+
+def _spreadRows(dense, bases):
+    ''' Sum of each row over a window of bases either side of every
+    base, treating bases outside the row as zero '''
+
+    width = 2 * bases + 1
+    padded = np.pad(dense, ((0, 0), (bases, bases)), "constant")
+    cumulative = np.zeros((dense.shape[0], padded.shape[1] + 1))
+    np.cumsum(padded, axis=1, out=cumulative[:, 1:])
+
+    return cumulative[:, width:] - cumulative[:, :-width]
+
+
+def _rankRows(values):
+    ''' Rank the values in each row of a matrix, giving tied values
+    their average rank '''
+
+    n_rows, n_cols = values.shape
+    order = values.argsort(axis=1, kind="mergesort")
+    rows = np.arange(n_rows)[:, np.newaxis]
+    ordered = values[rows, order]
+
+    # runs of tied values within each row
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    starts = np.flatnonzero(starts.ravel())
+
+    ranks = np.tile(np.arange(1, n_cols + 1, dtype="float64"), n_rows)
+    run_lengths = np.diff(np.append(starts, ranks.size))
+    mean_ranks = np.add.reduceat(ranks, starts) / run_lengths
+
+    result = np.empty(values.shape)
+    result[rows, order] = np.repeat(mean_ranks, run_lengths).reshape(
+        values.shape)
+
+    return result
+
+
+def _spearmanRows(values1, values2, valid):
+    ''' _spearman between each row of two matrices, over the entries
+    where valid is True. Other entries are ranked last, as one tie, so
+    that valid entries get the ranks they have among themselves '''
+
+    n_valid = valid.sum(axis=1)
+    centre = ((n_valid + 1) / 2.0)[:, np.newaxis]
+
+    ranks1 = np.where(valid, _rankRows(np.where(valid, values1, np.inf))
+                      - centre, 0)
+    ranks2 = np.where(valid, _rankRows(np.where(valid, values2, np.inf))
+                      - centre, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = ((ranks1 * ranks2).sum(axis=1) /
+                  np.sqrt((ranks1 ** 2).sum(axis=1) *
+                          (ranks2 ** 2).sum(axis=1)))
+
+    result[n_valid < 2] = np.nan
+    return result
+
+
+def spreadCorrNull(positions, counts, profile2, nspread,
+                   profile2_ready=False):
+    ''' corr_profile for each row of a matrix of permuted positions and
+    counts (see permuteProfile) against profile2. Rows must be sorted.
+    Each row is compared with profile2 over the bases corr_profile would
+    use. Rows are spread a batch at a time, to bound memory '''
+
+    region_start = int(positions.min()) - 1
+    region_end = int(positions.max()) + 1
+
+    # the bases at which corr_profile spreads each row
+    row_first = positions[:, 0] - 1 + nspread
+    row_last = positions[:, -1] + 1 - nspread
+
+    if profile2_ready:
+        locations2 = profile2.index.values
+        inside = (locations2 >= region_start) & (locations2 < region_end)
+        bases = locations2[inside].astype("int64")
+        spread2 = profile2.values[inside].astype("float64")
+        defined2 = ~np.isnan(spread2)
+    else:
+        order = np.argsort(profile2.index.values, kind="mergesort")
+        locations2 = profile2.index.values[order].astype("int64")
+        cumulative = np.concatenate(
+            [[0], np.cumsum(profile2.values[order].astype("float64"))])
+
+        bases = np.arange(region_start, region_end)
+        spread2 = (cumulative[np.searchsorted(locations2, bases + nspread,
+                                              side="right")] -
+                   cumulative[np.searchsorted(locations2, bases - nspread)])
+        defined2 = ((bases >= locations2[0] + nspread) &
+                    (bases < locations2[-1] - nspread))
+
+    result = np.empty(len(positions))
+
+    for first, last in _rowBatches(len(positions),
+                                   region_end - region_start):
+        spread1 = _spreadRows(_denseRows(positions[first:last],
+                                         counts[first:last],
+                                         region_start, region_end),
+                              nspread)[:, bases - region_start]
+
+        valid = (defined2 &
+                 (bases >= row_first[first:last, np.newaxis]) &
+                 (bases < row_last[first:last, np.newaxis]))
+
+        result[first:last] = _spearmanRows(
+            spread1, np.broadcast_to(spread2, spread1.shape), valid)
+
+    return result
+
 
 def rand_apply(profile, exon, n, func, keep_dist=False, *args, **kwargs):
+    ''' Apply func to n randomisations of profile within exon. A
+    seeded np.random.Generator or RandomState can be given as the rng
+    keyword argument.
+
+    Where func is calcAverageDistance, findMinDistance or
+    corr_profile, all n randomisations are drawn at once (see
+    permuteProfile) and the statistic calculated for all of them with
+    numpy. '''
+
+    rng = kwargs.pop("rng", None)
+
+    if func in (calcAverageDistance, findMinDistance, corr_profile):
+        positions, counts = permuteProfile(profile, exon.start, exon.end, n,
+                                           keep_dist=keep_dist, rng=rng)
+        if func is calcAverageDistance:
+            return pd.Series(meanDistanceNull(positions, counts, *args))
+        elif func is findMinDistance:
+            return pd.Series(minDistanceNull(positions, *args))
+        else:
+            return pd.Series(spreadCorrNull(positions, counts, *args,
+                                            **kwargs))
+
     dummy = pd.Series(range(n))
     def _inner_func(x):
         rand = randomiseSites(profile, exon.start, exon.end,
-                                    keep_dist=keep_dist)
+                              keep_dist=keep_dist, rng=rng)
         return func(rand, *args, **kwargs)
     return dummy.apply(_inner_func)
-
-
-
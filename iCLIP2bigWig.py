@@ -17,7 +17,8 @@ at any given position on each strand.
 Output files are named according to the provided template
 with _plus and _minus suffixes.
 
-Requires the ucsc wigToBigWig program to work properly.
+bigWig files are written directly from the crosslink counts, one
+contig at a time, without an intermediate wig file.
 
 Options
 -------
@@ -26,16 +27,43 @@ Will read bamfile off of the stdin or from -I, but
 BAM file must be indexed and so cannot be manipulated on 
 stdin.
 
-If wig files are required as output, for example if 
-wigToBigWig is not installed, --wig will output wig files
+If wig files are required as output, --wig will output wig files
 rather than bigWig files.
 
+--concurrent-strands will write the plus and minus strand files at the
+same time, in two threads.
+
+--threads will count contigs in a pool of processes, each with its own
+handle on the BAM file. Contigs are still written in reference order.
+
+--decompression-threads is the number of threads each process uses to
+decompress each BAM file.
+
+If a crosslink index (see build_crosslink_index.py) exists for the
+input BAM file, counts are read from it rather than from the BAM file.
+
+Several BAM files, or crosslink indexes, can be given after the output
+template, in which case their counts are summed, contig by contig, to
+give a single pair of tracks, for example for all the replicates of a
+condition. The tracks cover every contig in any of the inputs, in the
+order of the first input, followed by contigs only found in later ones.
+The inputs must agree on the length of each contig.
+
+--normalise=cpm scales counts to crosslinks per million crosslinks in
+the input(s), to make tracks comparable accross samples. The total is
+taken from the BAM index or crosslink index before counting, so
+normalisation is not possible for a BAM file on stdin.
+--normalise=both writes both the raw tracks and normalised tracks, the
+latter with _cpm_plus and _cpm_minus suffixes.
+
 
 Usage
 -----
 
 
-python umi_stats.py -I [BAMFILE] [OUT_TEMPLATE]
+python iCLIP2bigWig.py -I [BAMFILE] [OUT_TEMPLATE]
+
+python iCLIP2bigWig.py [OUT_TEMPLATE] [BAMFILE|XLINKS] [BAMFILE|XLINKS] ...
 
 
 
@@ -45,43 +73,158 @@ Command line options
 '''
 
 import sys
-import os
-import shutil
+import collections
 import CGAT.Experiment as E
-import pysam
-import subprocess
-import tempfile
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import iCLIP
 
 
-def outputToBW(infile, outfile_prefix, chrom_sizes):
+def outputToBigWig(depths, chrom, writer, negate=False, scale=None):
+    '''depths is an iCLIP.StrandProfile of crosslink counts for a
+    chromosome, chrom is a chromosome and writer an iCLIP.BigWigWriter.
+    Adds the depths to the bigWig, as negative numbers if negate is
+    True, and multiplied by scale if it is given '''
 
-    E.debug("Attempting to output %s to bigWig" % outfile_prefix)
-    command = ["wigToBigWig",
-               infile,
-               chrom_sizes,
-               outfile_prefix + ".bw"]
-    try:
-        subprocess.check_call(command)
-    except Exception as e:
-        E.error("Error on conversion: %s" % e)
-        E.info("Outputting to wig")
-        shutil.move(infile, outfile_prefix + ".wig")
-    else:
-        E.debug("Conversion successful")
-        os.unlink(infile)
-    
-def outputToWig(depths,chrom, wigfile):
-    '''depths is a pandas series keyed on chromosome position,
-    chrom is a chromosome, wigfile is a file to output to.
-    This function converts a series of depths into wig formated
-    text and writes it to the specified file '''
+    counts = depths.counts.astype("int64")
+    if negate:
+        counts = -counts
+
+    if scale is not None:
+        counts = counts * scale
+
+    writer.addContig(chrom, depths.positions, counts)
+
+
+def outputToWig(depths, chrom, wigfile, negate=False, scale=None):
+    '''depths is an iCLIP.StrandProfile of crosslink counts for a
+    chromosome, chrom is a chromosome, wigfile is a file to output to.
+    This function converts the depths into variableStep wig formated
+    text and writes it to the specified file. If negate is True,
+    depths are written as negative numbers. If scale is given depths
+    are multiplied by it '''
 
     wigfile.write("variableStep\tchrom=%s\n" % chrom)
-    for row in depths.iteritems():
-        row = list(row)
-        row = "\t".join(map(str,row)) + "\n"
-        wigfile.write(row)
+
+    if len(depths) == 0:
+        return
+
+    # wig coordinates are one based
+    counts = depths.counts.astype("int64")
+    if negate:
+        counts = -counts
+
+    if scale is None:
+        fmt = "%i"
+    else:
+        counts = counts * scale
+        fmt = ["%i", "%.6g"]
+
+    np.savetxt(wigfile,
+               np.column_stack((depths.positions + 1, counts)),
+               fmt=fmt, delimiter="\t")
+
+
+def openInput(filename, threads=1):
+    ''' Open an input, either a BAM file or a crosslink index. Returns
+    the BAM file (None for an index), the crosslink index (None if a BAM
+    file has no index) and a list of (contig, length) tuples. BAM files
+    are decompressed with threads threads '''
+
+    if filename.endswith(iCLIP.XLINK_INDEX_SUFFIX):
+        crosslinks = iCLIP.readCrosslinkIndex(filename)
+        return None, crosslinks, [(str(contig), length) for contig, length
+                                  in crosslinks.lengths.items()]
+
+    bam = iCLIP.openBam(filename, threads)
+    crosslinks = iCLIP.findCrosslinkIndex(filename)
+    return bam, crosslinks, zip(bam.references, bam.lengths)
+
+
+def unionContigs(inputs):
+    ''' (contig, length) tuples for every contig in a list of opened
+    inputs, in the order of the first input, followed by contigs found
+    only in later inputs. Raises ValueError if two inputs give a contig
+    different lengths '''
+
+    lengths = collections.OrderedDict()
+    for bam, crosslinks, contigs in inputs:
+        for contig, length in contigs:
+            if lengths.setdefault(contig, length) != length:
+                raise ValueError("Contig %s has length %s in one input and "
+                                 "%s in another" % (contig, lengths[contig],
+                                                    length))
+
+    return list(lengths.items())
+
+
+def totalCrosslinks(inputs):
+    ''' Total number of crosslinks in a list of opened inputs. Each
+    read gives one crosslink, so for BAM files this is the number of
+    mapped reads in the BAM index '''
+
+    total = 0
+    for bam, crosslinks, contigs in inputs:
+        if crosslinks is None:
+            total += bam.mapped
+        else:
+            total += sum(crosslinks[(contig, strand)].sum()
+                         for contig in crosslinks.contigs
+                         for strand in ("+", "-"))
+
+    return total
+
+
+def inputProfiles(inputs, chrom, chrom_length, dtype):
+    ''' Crosslink profiles for chrom summed over the opened inputs.
+    Returns profiles for each strand and a counter of site types '''
+
+    pos_total = neg_total = None
+    counter = E.Counter()
+
+    for bam, crosslinks, contigs in inputs:
+
+        if crosslinks is None and chrom not in bam.references:
+            continue
+
+        pos_depth, neg_depth, input_counter = iCLIP.contigProfiles(
+            bam, chrom, chrom_length, crosslinks, dtype)
+
+        for key, value in input_counter.iteritems():
+            counter[key] += value
+
+        if pos_total is None:
+            pos_total, neg_total = pos_depth, neg_depth
+        else:
+            pos_total = pos_total + pos_depth
+            neg_total = neg_total + neg_depth
+
+    if pos_total is None:
+        pos_total = neg_total = iCLIP.StrandProfile([], [], chrom_length,
+                                                    dtype)
+
+    return pos_total, neg_total, counter
+
+
+# Per process state for worker processes. Each worker holds its own handles
+# on the BAM files and crosslink indexes.
+_worker = {}
+
+
+def _initWorker(filenames, dtype, decompression_threads):
+
+    _worker["inputs"] = [openInput(filename, decompression_threads)
+                         for filename in filenames]
+    _worker["dtype"] = dtype
+
+
+def _countContig(contig):
+
+    chrom, chrom_length = contig
+    return (chrom,) + inputProfiles(_worker["inputs"], chrom, chrom_length,
+                                    _worker["dtype"])
+
 
 def main(argv=None):
     """script main.
@@ -102,71 +245,146 @@ def main(argv=None):
     parser.add_option("--dtype", dest = "dtype", type="string",
                       default="uint32",
                       help="dtype for storing depths")
+    parser.add_option("--concurrent-strands", dest="concurrent_strands",
+                      action="store_true", default=False,
+                      help="Write the plus and minus strand files at the "
+                           "same time")
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of processes to count contigs in. "
+                           "Requires a BAM file rather than stdin "
+                           "[%default]")
+    parser.add_option("--decompression-threads",
+                      dest="decompression_threads", type="int", default=1,
+                      help="Number of threads to decompress each BAM file "
+                           "with, in each process [%default]")
+    parser.add_option("--normalise", dest="normalise", type="choice",
+                      choices=["none", "cpm", "both"], default="none",
+                      help="Write raw counts, counts per million "
+                           "crosslinks or both [%default]")
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
-    if options.stdin == sys.stdin:
-        in_bam = pysam.Samfile("-", "rb")
+    if len(args) > 1:
+        filenames = args[1:]
+    elif options.stdin == sys.stdin:
+        filenames = None
     else:
-        fn = options.stdin.name
+        filenames = [options.stdin.name]
         options.stdin.close()
-        in_bam = pysam.Samfile(fn, "rb")
 
-    plus_wig = tempfile.NamedTemporaryFile(delete=False)
-    minus_wig = tempfile.NamedTemporaryFile(delete=False)
+    if filenames is None and options.normalise != "none":
+        raise ValueError("--normalise=%s needs the total number of "
+                         "crosslinks, which is not known for a BAM file on "
+                         "stdin. Give the BAM file with -I or as an "
+                         "argument" % options.normalise)
 
-    contig_sizes = []
+    if filenames is None:
+        in_bam = iCLIP.openBam("-", options.decompression_threads)
+        inputs = [(in_bam, None, zip(in_bam.references, in_bam.lengths))]
+    else:
+        inputs = [openInput(filename, options.decompression_threads)
+                  for filename in filenames]
+
+    contigs = unionContigs(inputs)
+
+    if options.threads > 1 and filenames is None:
+        E.warning("Cannot share a BAM file on stdin between processes, "
+                  "using one process")
+        options.threads = 1
+
+    # each output is a plus and minus strand file, and the scale factor
+    # to apply to the counts
+    scales = []
+    if options.normalise in ("none", "both"):
+        scales.append(("", None))
+    if options.normalise in ("cpm", "both"):
+        total = totalCrosslinks(inputs)
+        E.info("%i crosslinks in total" % total)
+        if total == 0:
+            # there are no counts to scale
+            E.warning("No crosslinks in the input, normalised tracks "
+                      "will be empty")
+            total = 1
+        suffix = "_cpm" if options.normalise == "both" else ""
+        scales.append((suffix, 1.0e6 / total))
+
+    outputs = []
+    for suffix, scale in scales:
+        outname_plus = args[0] + suffix + "_plus"
+        outname_minus = args[0] + suffix + "_minus"
+
+        if options.output_wig:
+            E.debug("Outputting to wig")
+            outputs.append((open(outname_plus + ".wig", "w"),
+                            open(outname_minus + ".wig", "w"),
+                            scale))
+        else:
+            outputs.append((iCLIP.BigWigWriter(outname_plus + ".bw", contigs),
+                            iCLIP.BigWigWriter(outname_minus + ".bw",
+                                               contigs),
+                            scale))
 
-    for chrom, chrom_length in zip(in_bam.references, in_bam.lengths):
+    if options.output_wig:
+        output = outputToWig
+    else:
+        output = outputToBigWig
+
+    if options.concurrent_strands:
+        pool = ThreadPool(2 * len(outputs))
+
+    if options.threads > 1:
+        # contigs are counted in parallel, but imap returns them in
+        # reference order, which is the order they must be written in
+        E.info("Counting contigs using %i processes" % options.threads)
+        workers = multiprocessing.Pool(options.threads,
+                                       initializer=_initWorker,
+                                       initargs=(filenames, options.dtype,
+                                                 options.decompression_threads))
+        profiles = workers.imap(_countContig, contigs)
+    else:
+        workers = None
+        profiles = ((chrom,) + inputProfiles(inputs, chrom, chrom_length,
+                                             options.dtype)
+                    for chrom, chrom_length in contigs)
 
-        # get depths over chromosome
-        pos_depth, neg_depth, counter = iCLIP.countChr(in_bam.fetch(chrom),
-                                                       chrom_length,
-                                                       options.dtype)
-        pos_depth_sorted = pos_depth.sort_index()
-        del pos_depth
-        neg_depth_sorted = neg_depth.sort_index()
-        del neg_depth
-        neg_depth_sorted = -1*neg_depth_sorted
+    for chrom, pos_depth, neg_depth, counter in profiles:
 
         E.debug("Counted %i truncated on positive strand, %i on negative"
                 % (counter.truncated_pos, counter.truncated_neg))
         E.debug("and %i deletion reads on positive strand, %i on negative"
                 % (counter.deletion_pos, counter.deletion_neg))
 
-        # output to temporary wig file
-        outputToWig(pos_depth_sorted, chrom, plus_wig)
-        outputToWig(neg_depth_sorted, chrom, minus_wig)
-    
-        contig_sizes.append([chrom, chrom_length])
+        if options.concurrent_strands:
+            # compression releases the GIL, so the strands are
+            # written in parallel
+            jobs = []
+            for plus_out, minus_out, scale in outputs:
+                jobs.append(pool.apply_async(
+                    output, (pos_depth, chrom, plus_out, False, scale)))
+                jobs.append(pool.apply_async(
+                    output, (neg_depth, chrom, minus_out, True, scale)))
+            for job in jobs:
+                job.get()
+        else:
+            for plus_out, minus_out, scale in outputs:
+                output(pos_depth, chrom, plus_out, scale=scale)
+                output(neg_depth, chrom, minus_out, negate=True, scale=scale)
 
-        del pos_depth_sorted
-        del neg_depth_sorted
-    
-    plus_wig_name = plus_wig.name
-    minus_wig_name = minus_wig.name
-    plus_wig.close()
-    minus_wig.close()
-
-    outname_plus = args[0] + "_plus"
-    outname_minus = args[0] + "_minus"
+        del pos_depth
+        del neg_depth
 
-    if options.output_wig:
-        E.debug("Outputting to wig")
-        shutil.move(plus_wig_name, outname_plus + ".wig")
-        shutil.move(minus_wig_name, outname_minus + ".wig")
-    else:
-        chrom_sizes_file = tempfile.NamedTemporaryFile(delete=False)
-        contig_sizes = ["\t".join(map(str,row)) for row in contig_sizes]
-        contig_sizes = "\n".join(contig_sizes) + "\n"
-        chrom_sizes_file.write(contig_sizes)
-        chrom_sizes_filename = chrom_sizes_file.name
-        chrom_sizes_file.close()
+    if options.concurrent_strands:
+        pool.close()
+        pool.join()
 
-        outputToBW(plus_wig_name, outname_plus, chrom_sizes_filename)
-        outputToBW(minus_wig_name, outname_minus, chrom_sizes_filename)
+    if workers is not None:
+        workers.close()
+        workers.join()
 
+    for plus_out, minus_out, scale in outputs:
+        plus_out.close()
+        minus_out.close()
 
     # write footer and output benchmark information.
     E.Stop()
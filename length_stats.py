@@ -12,6 +12,9 @@ Purpose
 
 Take a bam file and calculate alignment length histogram.
 
+To collect this along with the other QC statistics on a BAM file in
+one pass, use bam_qc.py.
+
 Options
 -------
 
@@ -19,6 +22,10 @@ Options
      The read length. Any aligned length longer than this is
      truncated to this length. 
 
+--threads
+     Number of threads to decompress the BAM file with. The file is
+     read from start to end, so need not be indexed.
+
 
 Usage
 -----
@@ -39,7 +46,7 @@ import re
 import optparse
 import collections
 import CGAT.Experiment as E
-import pysam
+import iCLIP
 
 def main(argv=None):
     """script main.
@@ -59,48 +66,28 @@ def main(argv=None):
     parser.add_option("-p", "--paired", dest="paired", type = "int",
                      help="Data is paired. Use fragment length where aligned"
                           "length is greater than or equal to this length", default=None)
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of threads to decompress the BAM file "
+                           "with [%default]")
+
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
-    out_hist = collections.defaultdict(int)
-    
     if options.stdin == sys.stdin:
-        in_bam = pysam.Samfile("-", "rb")
+        in_bam = iCLIP.openBam("-", options.threads)
     else:
         fn = options.stdin.name
         options.stdin.close()
-        in_bam = pysam.Samfile(fn, "rb")
-
-    nreads=0
-    nlonger=0
-    for read in in_bam.fetch():
-
-        if read.is_read2 or read.is_unmapped or read.mate_is_unmapped:
-            continue
-
-        nreads+=1
-        length = read.inferred_length - sum([l for o,l in read.cigar if o=="S"])
-        if read.inferred_length > length:
-            nlonger+=1
-
-        if not (options.paired is None) and length >= options.paired:
-
-            splice_1 = max(0, read.alen-length)
-            
-            out_hist[abs(read.tlen) - splice_1] += 1
-        else:
-            out_hist[length] += 1
-
-    header = ["Length", "Count"]
+        in_bam = iCLIP.openBam(fn, options.threads)
 
-    keys = sorted(out_hist.keys())
+    lengths = iCLIP.LengthHistogram(paired=options.paired)
+    for read in in_bam.fetch(until_eof=True):
+        lengths.add(read)
 
-    outlines = ["\t".join(map(str, (key,out_hist[key]))) for key in keys]
-    outlines = "\t".join(header) + "\n" + "\n".join(outlines) + "\n"
-    options.stdout.write(outlines)
+    lengths.write(options.stdout)
 
     # write footer and output benchmark information.
-    E.info("%i reads processed. %i reads have inferred reads length longer than aligned length" % (nreads, nlonger))
+    E.info("%i reads processed. %i reads have inferred reads length longer than aligned length" % (lengths.nreads, lengths.nlonger))
     E.Stop()
 
 if __name__ == "__main__":
@@ -637,7 +637,24 @@ def dedup_alignments(infile, outfile):
 
 
 ###################################################################
-@transform([dedup_alignments,indexMergedBAMs], 
+@transform(dedup_alignments, suffix(".bam"), ".bam.xlinks")
+def buildCrosslinkIndex(infile, outfile):
+    ''' Parse the reads in each deduplicated BAM into crosslinked bases
+    once, and save the counts to an index next to the BAM that is used
+    in place of the BAM by the downstream scripts '''
+
+    job_threads = PARAMS["bam_threads"]
+    statement = '''python %(project_src)s/build_crosslink_index.py
+                           %(infile)s
+                           %(outfile)s
+                           --threads=%(bam_threads)s
+                           -L %(outfile)s.log '''
+
+    P.run()
+
+
+###################################################################
+@transform(indexMergedBAMs,
            regex("(?:merged_)?(.+).bam(?:.bai)?"),
            r"\1.frag_length.tsv")
 def getFragLengths(infile, outfile):
@@ -645,9 +662,11 @@ def getFragLengths(infile, outfile):
 
     intrack = re.match("(.+).bam(?:.bai)?", infile).groups()[0]
 
+    job_threads = PARAMS["bam_threads"]
     statement = ''' python %(project_src)s/length_stats.py
                            -I %(intrack)s.bam
                            -S %(outfile)s
+                           --threads=%(bam_threads)s
                            -L %(outfile)s.log
                '''
     if PARAMS["reads_paired"] == 1:
@@ -657,7 +676,38 @@ def getFragLengths(infile, outfile):
 
 
 ###################################################################
-@collate(getFragLengths,
+@subdivide(dedup_alignments,
+           regex("(.+).bam"),
+           [r"\1.frag_length.tsv",
+            r"\1.bam_stats.tsv",
+            r"\1.nspliced.txt",
+            r"\1.umi_stats.tsv.gz"])
+def dedupedBamQC(infile, outfiles):
+    ''' Calculate the fragment length and UMI histograms, the number of
+    spliced reads and the flag statistics of the deduped bams in a single
+    pass over each. Each output is passed on separately, to be picked
+    out by its load task '''
+
+    lengths, bam_stats, nspliced, umi_stats = outfiles
+
+    job_threads = PARAMS["bam_threads"]
+    statement = ''' python %(project_src)s/bam_qc.py
+                           -I %(infile)s
+                           --threads=%(bam_threads)s
+                           --length-stats=%(lengths)s
+                           --bam-stats=%(bam_stats)s
+                           --nspliced=%(nspliced)s
+                           --umi-stats=%(umi_stats)s
+                           -L %(lengths)s.log
+               '''
+    if PARAMS["reads_paired"] == 1:
+        statement += "--paired=%s" % (
+            int(PARAMS["reads_length"]) - len(PARAMS["reads_bc_pattern"]))
+    P.run()
+
+
+###################################################################
+@collate([getFragLengths, dedupedBamQC],
          regex("(mapping|deduped).dir/.+\.frag_length.tsv"),
          r"\1.frag_lengths.load")
 def loadFragLengths(infiles, outfile):
@@ -668,20 +718,9 @@ def loadFragLengths(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments,
-           suffix(".bam"), ".bam_stats.tsv")
-def dedupedBamStats(infile, outfile):
-    ''' Calculate statistics on the dedeupped bams '''
-
-    statement = '''python %(scripts_dir)s/bam2stats.py
-                         --force-output
-                          < %(infile)s > %(outfile)s '''
-
-    P.run()
-
-
-###################################################################
-@merge(dedupedBamStats, "deduped_bam_stats.load")
+@collate(dedupedBamQC,
+         regex(".+\.bam_stats.tsv"),
+         "deduped_bam_stats.load")
 def loadDedupedBamStats(infiles, outfile):
 
     P.concatenateAndLoad(infiles, outfile,
@@ -689,21 +728,9 @@ def loadDedupedBamStats(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments,
-           suffix(".bam"),
-           ".nspliced.txt")
-def getNspliced(infile, outfile):
-    ''' Calculate the number of reads spliced by grepping the
-    cigar string for Ns'''
-
-    statement = ''' samtools view %(infile)s
-                  | awk '$6 ~ /N/'
-                  | wc -l > %(outfile)s '''
-    P.run()
-
-
-###################################################################
-@merge(getNspliced, "deduped_nspliced.load")
+@collate(dedupedBamQC,
+         regex(".+\.nspliced.txt"),
+         "deduped_nspliced.load")
 def loadNspliced(infiles, outfile):
     P.concatenateAndLoad(infiles, outfile,
                          regex_filename=".+/(.+).nspliced.txt",
@@ -713,20 +740,9 @@ def loadNspliced(infiles, outfile):
 
 
 ###################################################################
-@transform(dedup_alignments, suffix(".bam"), ".umi_stats.tsv.gz")
-def deduped_umi_stats(infile, outfile):
-    ''' calculate histograms of umi frequencies '''
-
-    statement = '''python %(project_src)s/umi_hist.py
-                           -I %(infile)s
-                           -L %(outfile)s.log
-                  | gzip > %(outfile)s '''
-
-    P.run()
-
-
-###################################################################
-@merge(deduped_umi_stats, "dedup_umi_stats.load")
+@collate(dedupedBamQC,
+         regex(".+\.umi_stats.tsv.gz"),
+         "dedup_umi_stats.load")
 def loadDedupedUMIStats(infiles, outfile):
 
     P.concatenateAndLoad(infiles, outfile,
@@ -852,6 +868,27 @@ def flattenGeneSet(infile, outfile):
 
 
 ###################################################################
+@follows(mapping_qc)
+@transform([buildReferenceGeneSet,
+            flattenGeneSet,
+            "mapping.dir/geneset.dir/refcoding.gtf.gz"],
+           suffix(".gtf.gz"),
+           ".gtf.gz.gstore")
+def buildGenesetStore(infile, outfile):
+    ''' Compile each geneset into a binary store next to the GTF, so
+    that genesets are parsed once rather than by every script for
+    every sample '''
+
+    statement = '''python %(project_src)s/build_geneset_store.py
+                           %(infile)s
+                           %(outfile)s
+                           -L %(outfile)s.log '''
+
+    P.run()
+
+
+###################################################################
+@follows(buildGenesetStore)
 @transform(dedup_alignments, suffix(".bam"),
            add_inputs(flattenGeneSet),
            ".splicing_index")
@@ -888,7 +925,7 @@ def MappingStats():
 ###################################################################
 # Quality control and reproducibility
 ###################################################################
-@follows(mkdir("reproducibility.dir"))
+@follows(mkdir("reproducibility.dir"), buildCrosslinkIndex)
 @collate(dedup_alignments, regex(".+/(.+\-.+)\-.+.bam"),
          r"reproducibility.dir/\1-agg.reproducibility.tsv.gz")
 def calculateReproducibility(infiles, outfile):
@@ -897,16 +934,18 @@ def calculateReproducibility(infiles, outfile):
 
     job_options = "-l mem_free=1G"
     infiles = " ".join(infiles)
+    job_threads = PARAMS["reproducibility_threads"]
 
     statement = '''python %(project_src)s/calculateiCLIPReproducibility.py
                    %(infiles)s
                    -L %(outfile)s.log
+                   --threads=%(reproducibility_threads)s
                  | gzip > %(outfile)s '''
     P.run()
 
 
 ###################################################################
-@follows(mkdir("reproducibility.dir"))
+@follows(mkdir("reproducibility.dir"), buildCrosslinkIndex)
 @merge(dedup_alignments,
        r"reproducibility.dir/agg-agg-agg.reproducibility.tsv.gz")
 def reproducibilityAll(infiles, outfile):
@@ -914,16 +953,18 @@ def reproducibilityAll(infiles, outfile):
 
     job_options = "-l mem_free=10G"
     infiles = " ".join(infiles)
+    job_threads = PARAMS["reproducibility_threads"]
 
     statement = '''python %(project_src)s/calculateiCLIPReproducibility.py
                    %(infiles)s
                    -L %(outfile)s.log
+                   --threads=%(reproducibility_threads)s
                  | gzip > %(outfile)s '''
     P.run()
 
 
 ###################################################################
-@follows(mkdir("reproducibility.dir"))
+@follows(mkdir("reproducibility.dir"), buildCrosslinkIndex)
 @transform(dedup_alignments,
            regex(".+/(.+).bam"),
            add_inputs("deduped.dir/%s*.bam" % PARAMS["experiment_input"]),
@@ -939,10 +980,12 @@ def reproducibilityVsControl(infiles, outfile):
         job_options = "-l mem_free=1G"
 
         infiles = " ".join(infiles)
+        job_threads = PARAMS["reproducibility_threads"]
 
         statement = '''python %(project_src)s/calculateiCLIPReproducibility.py
                    %(infiles)s
                    -L %(outfile)s.log
+                   --threads=%(reproducibility_threads)s
                    -t %(track)s
                  | gzip > %(outfile)s '''
         P.run()
@@ -979,22 +1022,24 @@ def loadReproducibilityVsControl(infiles, outfile):
 
 
 ###################################################################
-@permutations(dedup_alignments, formatter(".+/(?P<TRACK>.+).bam"),
-              2,
-              "reproducibility.dir/{TRACK[0][0]}_vs_{TRACK[1][0]}.tsv.gz")
+@follows(mkdir("reproducibility.dir"), buildCrosslinkIndex)
+@merge(dedup_alignments,
+       "reproducibility.dir/reproducibility_distance.tsv.gz")
 def computeDistances(infiles, outfile):
     ''' Compute the reproduciblity between each indevidual pair of samples
-    this can then be readily converted to a distance measure'''
+    this can then be readily converted to a distance measure. Each
+    sample is read once, and all pairs calculated in a single job'''
 
-    track = infiles[0]
     infiles = " ".join(infiles)
 
-    job_options="-l mem_free=2G"
+    job_options="-l mem_free=4G"
+    job_threads = PARAMS["reproducibility_threads"]
 
     statement = '''python %(project_src)s/calculateiCLIPReproducibility.py
                    %(infiles)s
                    -L %(outfile)s.log
-                   -t %(track)s
+                   --threads=%(reproducibility_threads)s
+                   --pairwise
                    -m 1
                  | gzip > %(outfile)s '''
 
@@ -1002,14 +1047,12 @@ def computeDistances(infiles, outfile):
 
 
 ###################################################################
-@merge(computeDistances,
-       "reproducibility.dir/reproducibility_distance.load")
-def loadDistances(infiles, outfile):
+@transform(computeDistances,
+           suffix(".tsv.gz"),
+           ".load")
+def loadDistances(infile, outfile):
 
-    P.concatenateAndLoad(infiles, outfile,
-                         regex_filename=".+/(.+)_vs_(.+).tsv.gz",
-                         cat="File1,File2",
-                         options="-i Track, -i File2")
+    P.load(infile, outfile, "-i Track -i File2")
 
 
 ###################################################################
@@ -1104,7 +1147,7 @@ def loadGeneProfiles(infiles, outfile):
                           options = "-i factor -i condition -i rep")
 
 ###################################################################
-@follows(mapping_qc)
+@follows(mapping_qc, buildGenesetStore)
 @transform("mapping.dir/geneset.dir/refcoding.gtf.gz",
            suffix(".gtf.gz"),
            ".exons.gtf.gz")
@@ -1131,7 +1174,7 @@ def transcripts2Exons(infile, outfile):
 
 
 ###################################################################
-@follows(mapping_qc)
+@follows(mapping_qc, buildGenesetStore)
 @transform("mapping.dir/geneset.dir/refcoding.gtf.gz",
            suffix(".gtf.gz"),
            ".introns.gtf.gz")
@@ -1237,12 +1280,15 @@ def profiles():
 ###################################################################
 # Calling significant clusters
 ###################################################################
-@follows(mkdir("clusters.dir"), mapping_qc)
+@follows(mkdir("clusters.dir"), mapping_qc, buildCrosslinkIndex,
+         buildGenesetStore)
 @subdivide(dedup_alignments,
        regex(".+/(.+).bam"),
        add_inputs(buildReferenceGeneSet),
        [r"clusters.dir/\1.bg.gz",
-        r"clusters.dir/\1.bed.gz"])
+        r"clusters.dir/\1.bed.gz",
+        r"clusters.dir/\1.significance_plus.bw",
+        r"clusters.dir/\1.significance_minus.bw"])
 def callSignificantClusters(infiles, outfiles):
     '''Call bases as significant based on mapping depth in window
     around base'''
@@ -1482,47 +1528,56 @@ def motifs():
 ###################################################################
 # Data Export
 ###################################################################
-@collate(dedup_alignments,
-         regex("(.+\-.+)\-(.+).bam"),
-         r"\1.union.bam")
-def makeUnionBams(infiles, outfile):
-    '''Merge replicates together'''
-
-    outfile = os.path.abspath(outfile)
-
-    if len(infiles) == 1:
-        statement = '''ln -sf %(infiles)s %(outfile)s;
-                       checkout;
- 
-                       ln -sf %(infiles)s.bai %(outfile)s.bai;'''
-    else:
-
-        statement = ''' samtools merge %(outfile)s %(infiles)s;
-                        checkpoint;
+# iCLIP2bigWig.py writes raw tracks, or with normalise=both, raw and
+# cpm tracks
+BIGWIG_SUFFIXES = ["_plus.bw", "_minus.bw"]
+if PARAMS["bigwig_normalise"] == "both":
+    BIGWIG_SUFFIXES += ["_cpm_plus.bw", "_cpm_minus.bw"]
 
-                        samtools index %(outfile)s'''
 
-    infiles = " ".join(infiles)
-
-    P.run()
-
-@follows(mkdir("bigWig"))
-@subdivide([dedup_alignments,
-            makeUnionBams], 
+@follows(mkdir("bigWig"), buildCrosslinkIndex)
+@subdivide(dedup_alignments,
            regex(".+/(.+).bam"),
-          [r"bigWig/\1_plus.bw",
-           r"bigWig/\1_minus.bw"])
+           [r"bigWig/\1" + suffix for suffix in BIGWIG_SUFFIXES])
 def generateBigWigs(infile, outfiles):
     '''Generate plus and minus strand bigWigs from BAM files '''
 
     out_pattern = P.snip(outfiles[0], "_plus.bw")
+    job_threads = PARAMS["bigwig_threads"]
     statement = '''python %(project_src)s/iCLIP2bigWig.py
                           -I %(infile)s
+                          --concurrent-strands
+                          --threads=%(bigwig_threads)s
+                          --normalise=%(bigwig_normalise)s
                           -L %(out_pattern)s.log
                           %(out_pattern)s '''
 
     P.run()
 
+
+###################################################################
+@follows(mkdir("bigWig"), buildCrosslinkIndex)
+@collate(dedup_alignments,
+         regex(".+/(.+\-.+)\-(.+).bam"),
+         [r"bigWig/\1.union" + suffix for suffix in BIGWIG_SUFFIXES])
+def generateUnionBigWigs(infiles, outfiles):
+    '''Generate plus and minus strand bigWigs summing the replicates
+    of each condition. Counts are summed contig by contig from the BAM
+    files, or their crosslink indexes, so no merged BAM is written '''
+
+    out_pattern = P.snip(outfiles[0], "_plus.bw")
+    infiles = " ".join(infiles)
+    job_threads = PARAMS["bigwig_threads"]
+    statement = '''python %(project_src)s/iCLIP2bigWig.py
+                          --concurrent-strands
+                          --threads=%(bigwig_threads)s
+                          --normalise=%(bigwig_normalise)s
+                          -L %(out_pattern)s.log
+                          %(out_pattern)s
+                          %(infiles)s '''
+
+    P.run()
+
 ###################################################################
 @follows(mkdir("export/hg19"))
 @transform(generateBigWigs,
@@ -1539,7 +1594,21 @@ def linkBigWig(infile, outfile):
 
 
 ###################################################################
-@merge(linkBigWig, "export/hg19/tagwig_trackDb.txt")
+@follows(mkdir("export/hg19"))
+@subdivide(generateUnionBigWigs,
+           regex("bigWig/(.+)_plus.bw"),
+           [r"export/hg19/\1" + suffix for suffix in BIGWIG_SUFFIXES])
+def linkUnionBigWigs(infiles, outfiles):
+    '''Link the bigwig files of each condition to export directory.
+    Each condition's files come as one list, so are linked here rather
+    than by linkBigWig '''
+
+    for infile, outfile in zip(infiles, outfiles):
+        linkBigWig(infile, outfile)
+
+
+###################################################################
+@merge([linkBigWig, linkUnionBigWigs], "export/hg19/tagwig_trackDb.txt")
 def generateBigWigUCSCFile(infiles, outfile):
     '''Generate track configuration for exporting wig files '''
 
@@ -1566,8 +1635,9 @@ def generateBigWigUCSCFile(infiles, outfile):
        maxHeightPixels 16:16:32
        alwaysZero on'''
 
-    stanzas = {}
-    for infile in infiles:
+    # stanzas are written in the order of their tracks
+    stanzas = collections.OrderedDict()
+    for infile in sorted(infiles):
         track, strand = re.match(
             ".+/(.+-.+)_(plus|minus).bw", infile).groups()
 
@@ -1604,6 +1674,84 @@ def generateBigWigUCSCFile(infiles, outfile):
         outf.write(output)
 
 
+###################################################################
+@follows(mkdir("export/hg19"))
+@transform(callSignificantClusters,
+           regex("clusters.dir/(.+)_(plus|minus).bw"),
+           r"export/hg19/\1_\2.bw")
+def linkSignificanceBigWig(infile, outfile):
+    '''Link -log10(p) bigwig files to export directory'''
+
+    try:
+        os.symlink(os.path.abspath(infile), os.path.abspath(outfile))
+    except OSError:
+        os.unlink(outfile)
+        os.symlink(os.path.abspath(infile), os.path.abspath(outfile))
+
+
+###################################################################
+@merge(linkSignificanceBigWig, "export/hg19/significance_trackDb.txt")
+def generateSignificanceUCSCFile(infiles, outfile):
+    '''Generate track configuration for exporting -log10(p) bigWig
+    files '''
+
+    track_template = '''
+          track sigwig_%(track)s_%(strand)s
+          parent sigwig_%(track)s
+          bigDataUrl %(track_data_URL)s
+          shortLabel %(short_label)s
+          longLabel %(long_label)s
+          color %(color)s
+          type bigWig'''
+
+    overlap_template = '''
+       track sigwig_%(track)s
+       parent clipsigwig
+       shortLabel %(short_label)s
+       longLabel %(long_label)s
+       autoScale on
+       visibility full
+       container multiWig
+       type bigWig
+       aggregate solidOverlay
+       maxHeightPixels 16:16:32
+       alwaysZero on'''
+
+    # stanzas are written in the order of their tracks
+    stanzas = collections.OrderedDict()
+    for infile in sorted(infiles):
+        track, strand = re.match(
+            ".+/(.+-.+).significance_(plus|minus).bw", infile).groups()
+
+        if strand == "minus":
+            color = "255,0,0"
+        else:
+            color = "0,0,255"
+
+        track_data_URL = os.path.basename(infile)
+        short_label = track + " -log10(p)"
+        long_label = "Significance of iCLIP crosslinks from track %s" \
+                     % track
+
+        if track not in stanzas:
+            stanzas[track] = overlap_template % locals()
+
+        stanzas[track] += "\n" + track_template % locals()
+
+    composite_stanza = '''
+    track clipsigwig
+    shortLabel iCLIP significance
+    longLabel -log10(p) of iCLIP crosslinked bases
+    superTrack on
+    alwaysZero on
+    maxHeightPixels 16:16:32'''
+
+    output = "\n".join([composite_stanza] + list(stanzas.values()))
+
+    with IOTools.openFile(outfile, "w") as outf:
+        outf.write(output)
+
+
 ###################################################################
 @follows(mkdir("export/hg19"))
 @transform([callSignificantClusters, callReproducibleClusters],
@@ -1624,7 +1772,8 @@ def generateClustersUCSC(infiles, outfile):
 
 
 ###################################################################
-@merge([generateClustersUCSC, generateBigWigUCSCFile],
+@merge([generateClustersUCSC, generateBigWigUCSCFile,
+        generateSignificanceUCSCFile],
        "export/hg19/trackDb.txt")
 def mergeTrackDbs(infiles, outfile):
 
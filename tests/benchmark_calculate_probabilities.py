@@ -0,0 +1,81 @@
+''' Micro-benchmark of find_significant_bases.calculateProbabilities
+against the window-by-window loop it replaced, over transcripts with
+from 1e3 to 1e6 crosslinked sites.
+
+Usage::
+
+    python tests/benchmark_calculate_probabilities.py
+
+The loop is slow, so is only timed up to --max-loop-sites sites. '''
+
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import find_significant_bases
+from test_find_significant_bases import loopProbabilities, \
+    syntheticTranscript
+
+
+def timeCall(func, repeat):
+    ''' Best of repeat timings of func() in seconds '''
+
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(argv=None):
+
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("-w", "--window-size", dest="window_size", type="int",
+                      default=15,
+                      help="Window size [%default]")
+    parser.add_option("-d", "--density", dest="density", type="float",
+                      default=0.1,
+                      help="Fraction of transcript bases crosslinked "
+                           "[%default]")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+                      default=3,
+                      help="Take the best of this many timings [%default]")
+    parser.add_option("--max-loop-sites", dest="max_loop_sites", type="int",
+                      default=10000,
+                      help="Largest number of sites to time the loop on "
+                           "[%default]")
+
+    options, args = parser.parse_args(argv)
+
+    rng = np.random.RandomState(1)
+
+    sys.stdout.write("sites\tlength\tvectorised_s\tloop_s\tspeedup\n")
+
+    for n_sites in [1000, 10000, 100000, 1000000]:
+
+        length = int(n_sites / options.density)
+        counts = syntheticTranscript(rng, n_sites, length)
+
+        # a fresh cache for each size, so that tables are not shared
+        # between sizes
+        tails = find_significant_bases.BinomialTailCache()
+        vectorised = timeCall(
+            lambda: find_significant_bases.calculateProbabilities(
+                counts, options.window_size, length, tails=tails),
+            options.repeat)
+
+        if n_sites <= options.max_loop_sites:
+            loop = timeCall(
+                lambda: loopProbabilities(counts, options.window_size,
+                                          length),
+                options.repeat)
+            sys.stdout.write("%i\t%i\t%.4f\t%.4f\t%.1f\n" % (
+                n_sites, length, vectorised, loop, loop / vectorised))
+        else:
+            sys.stdout.write("%i\t%i\t%.4f\tNA\tNA\n" % (
+                n_sites, length, vectorised))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+''' A small pure-Python bigWig reader, used to check the files written by
+iCLIP.BigWigWriter independently of the writer and of the UCSC tools.
+
+Follows the bigWig format of Kent et al., Bioinformatics 2010: the
+chromosome B+ tree and the R tree are traversed from their roots rather
+than the data being read sequentially, so that the indexes are checked
+as well as the data. '''
+
+import struct
+import zlib
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+
+HEADER = struct.Struct("<IHHQQQHHQQIQ")
+ZOOM_HEADER = struct.Struct("<IIQQ")
+SUMMARY = struct.Struct("<Qdddd")
+BPT_HEADER = struct.Struct("<IIIIQQ")
+CIRTREE_HEADER = struct.Struct("<IIQIIIIQII")
+NODE_HEADER = struct.Struct("<BBH")
+LEAF_ITEM = struct.Struct("<IIIIQQ")
+INDEX_ITEM = struct.Struct("<IIIIQ")
+SECTION_HEADER = struct.Struct("<IIIIIBBH")
+ZOOM_RECORD = struct.Struct("<IIIIffff")
+
+
+class BigWigReader:
+    ''' Reads a whole bigWig file into memory. Only suitable for small
+    files. '''
+
+    def __init__(self, filename):
+
+        with open(filename, "rb") as inf:
+            self.data = inf.read()
+
+        (magic, self.version, self.zoom_levels, chrom_tree_offset,
+         self.data_offset, self.index_offset, field_count,
+         defined_field_count, auto_sql_offset, summary_offset,
+         self.uncompress_buffer_size, reserved) = \
+            HEADER.unpack_from(self.data, 0)
+
+        if magic != BIGWIG_MAGIC:
+            raise ValueError("%s is not a bigWig file" % filename)
+
+        self.zooms = [ZOOM_HEADER.unpack_from(self.data,
+                                              HEADER.size + i * ZOOM_HEADER.size)
+                      for i in range(self.zoom_levels)]
+
+        self.summary = SUMMARY.unpack_from(self.data, summary_offset)
+        self.chroms = self._readChromTree(chrom_tree_offset)
+        self.chrom_names = dict((chrom_id, name) for name, (chrom_id, size)
+                                in self.chroms.items())
+
+    def _readChromTree(self, offset):
+        ''' Returns a dict of name: (chrom_id, size) '''
+
+        magic, block_size, key_size, value_size, item_count, reserved = \
+            BPT_HEADER.unpack_from(self.data, offset)
+        if magic != BPT_MAGIC:
+            raise ValueError("Bad chromosome tree magic")
+
+        chroms = {}
+
+        def _node(offset):
+            is_leaf, reserved, count = NODE_HEADER.unpack_from(self.data,
+                                                               offset)
+            offset += NODE_HEADER.size
+            for i in range(count):
+                key = self.data[offset:offset + key_size].rstrip(b"\0")
+                offset += key_size
+                if is_leaf:
+                    chrom_id, size = struct.unpack_from("<II", self.data,
+                                                        offset)
+                    chroms[key.decode("ascii")] = (chrom_id, size)
+                else:
+                    child, = struct.unpack_from("<Q", self.data, offset)
+                    _node(child)
+                offset += value_size
+
+        _node(offset + BPT_HEADER.size)
+
+        if len(chroms) != item_count:
+            raise ValueError("Chromosome tree has %i items, header says %i"
+                             % (len(chroms), item_count))
+
+        return chroms
+
+    def blocks(self, index_offset, chrom_id=None):
+        ''' (chrom_id, start, end, offset, size) of the leaves of the R
+        tree at index_offset, traversed from the root, overlapping
+        chrom_id, or all leaves if chrom_id is None '''
+
+        header = CIRTREE_HEADER.unpack_from(self.data, index_offset)
+        if header[0] != CIRTREE_MAGIC:
+            raise ValueError("Bad R tree magic")
+
+        found = []
+
+        def _overlaps(start_chrom, end_chrom):
+            return chrom_id is None or start_chrom <= chrom_id <= end_chrom
+
+        def _node(offset):
+            is_leaf, reserved, count = NODE_HEADER.unpack_from(self.data,
+                                                               offset)
+            offset += NODE_HEADER.size
+            for i in range(count):
+                if is_leaf:
+                    (start_chrom, start, end_chrom, end, block_offset,
+                     size) = LEAF_ITEM.unpack_from(self.data, offset)
+                    offset += LEAF_ITEM.size
+                    if _overlaps(start_chrom, end_chrom):
+                        if start_chrom != end_chrom:
+                            raise ValueError("Block spans contigs")
+                        found.append((start_chrom, start, end, block_offset,
+                                      size))
+                else:
+                    (start_chrom, start, end_chrom, end, child) = \
+                        INDEX_ITEM.unpack_from(self.data, offset)
+                    offset += INDEX_ITEM.size
+                    if _overlaps(start_chrom, end_chrom):
+                        _node(child)
+
+        _node(index_offset + CIRTREE_HEADER.size)
+
+        if chrom_id is None and len(found) != header[2]:
+            raise ValueError("R tree has %i leaves, header says %i"
+                             % (len(found), header[2]))
+
+        return found
+
+    def _block(self, offset, size):
+
+        block = self.data[offset:offset + size]
+        if self.uncompress_buffer_size > 0:
+            block = zlib.decompress(block)
+        return block
+
+    def intervals(self, chrom):
+        ''' List of (start, end, value) on chrom, from every section type '''
+
+        chrom_id, chrom_size = self.chroms[chrom]
+        result = []
+
+        for block_chrom, block_start, block_end, offset, size in \
+                self.blocks(self.index_offset, chrom_id):
+
+            block = self._block(offset, size)
+            position = 0
+            while position < len(block):
+                (section_chrom, start, end, step, span, section_type,
+                 reserved, count) = SECTION_HEADER.unpack_from(block,
+                                                               position)
+                position += SECTION_HEADER.size
+
+                for i in range(count):
+                    if section_type == 1:
+                        item = struct.unpack_from("<IIf", block, position)
+                        position += 12
+                    elif section_type == 2:
+                        item_start, value = struct.unpack_from("<If", block,
+                                                               position)
+                        item = (item_start, item_start + span, value)
+                        position += 8
+                    elif section_type == 3:
+                        value, = struct.unpack_from("<f", block, position)
+                        item = (start + i * step, start + i * step + span,
+                                value)
+                        position += 4
+                    else:
+                        raise ValueError("Unknown section type %i"
+                                         % section_type)
+
+                    if not (block_start <= item[0] and
+                            item[1] <= block_end):
+                        raise ValueError("Item outside of its block bounds")
+
+                    result.append(item)
+
+        return sorted(result)
+
+    def zoomRecords(self, level):
+        ''' List of (chrom_id, start, end, valid, min, max, sum,
+        sum_squares) for zoom level level '''
+
+        reduction, reserved, data_offset, index_offset = self.zooms[level]
+
+        records = []
+        for chrom_id, start, end, offset, size in self.blocks(index_offset):
+            block = self._block(offset, size)
+            for position in range(0, len(block), ZOOM_RECORD.size):
+                records.append(ZOOM_RECORD.unpack_from(block, position))
+
+        return sorted(records)
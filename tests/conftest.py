@@ -0,0 +1,7 @@
+''' The scripts and modules under test live in the top level of the
+repository rather than in a package, so put it on the path '''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,171 @@
+''' Tests for iCLIP.BigWigWriter. Files are read back with the
+pure-Python reader in bigwig_reader.py and compared with the data
+written and with data/reference.bw, a bigWig of the same data written
+by libBigWig (via pyBigWig) with:
+
+    bw = pyBigWig.open("reference.bw", "w")
+    bw.addHeader(CHROM_SIZES)
+    for chrom, positions, values in referenceData():
+        bw.addEntries(chrom, positions, values=values, span=1)
+    bw.close()
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+import iCLIP
+from bigwig_reader import BigWigReader
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "data", "reference.bw")
+
+CHROM_SIZES = [("chr1", 2000), ("chr2", 50000), ("chrM", 100)]
+
+
+def referenceData():
+    ''' (chrom, positions, values) of the reference bigWig '''
+
+    chr2 = list(range(0, 50000, 7))
+
+    return [("chr1", [0, 5, 6, 7, 100, 1999],
+             [1.0, 2.0, 3.0, -4.0, 0.5, 7.0]),
+            ("chr2", chr2, [float(i % 13 + 1) for i in range(len(chr2))]),
+            ("chrM", [99], [2.0])]
+
+
+def writeBigWig(filename, chrom_sizes, data, **kwargs):
+
+    writer = iCLIP.BigWigWriter(filename, chrom_sizes, **kwargs)
+    for chrom, positions, values in data:
+        writer.addContig(chrom, positions, values)
+    writer.close()
+
+    return writer
+
+
+def expectedIntervals(positions, values, size):
+
+    return [(p, p + 1, np.float32(v)) for p, v in zip(positions, values)
+            if 0 <= p < size]
+
+
+def checkIndex(reader):
+    ''' Every data block lies within its contig '''
+
+    sizes = dict(reader.chroms.values())
+    for chrom_id, start, end, offset, size in reader.blocks(
+            reader.index_offset):
+        assert 0 <= start < end <= sizes[chrom_id]
+
+
+@pytest.mark.parametrize("kwargs", [{},
+                                    {"compress": False},
+                                    {"items_per_slot": 8, "block_size": 4}])
+def test_matches_reference(tmpdir, kwargs):
+
+    outfile = str(tmpdir.join("test.bw"))
+    writeBigWig(outfile, CHROM_SIZES, referenceData(), **kwargs)
+
+    result = BigWigReader(outfile)
+    reference = BigWigReader(REFERENCE)
+
+    assert result.chroms == reference.chroms
+    for chrom, size in CHROM_SIZES:
+        assert result.intervals(chrom) == reference.intervals(chrom)
+
+    # bases, min, max, sum and sum of squares
+    np.testing.assert_allclose(result.summary, reference.summary)
+
+    checkIndex(result)
+
+
+def test_round_trip(tmpdir):
+    ''' Many contigs and small blocks, so that both trees have several
+    levels '''
+
+    rng = np.random.RandomState(1)
+    chrom_sizes = [("chr%i" % i, int(rng.randint(100, 20000)))
+                   for i in range(40)]
+
+    data = []
+    for chrom, size in chrom_sizes:
+        positions = np.sort(rng.choice(size, rng.randint(0, 100),
+                                       replace=False))
+        data.append((chrom, positions, rng.randint(-50, 50, len(positions))))
+
+    outfile = str(tmpdir.join("test.bw"))
+    writeBigWig(outfile, chrom_sizes, data, items_per_slot=4, block_size=3)
+
+    reader = BigWigReader(outfile)
+
+    for (chrom, positions, values), (name, size) in zip(data, chrom_sizes):
+        assert reader.chroms[chrom][1] == size
+        assert reader.intervals(chrom) == expectedIntervals(positions, values,
+                                                            size)
+
+    checkIndex(reader)
+
+
+def test_zoom_levels(tmpdir):
+
+    outfile = str(tmpdir.join("test.bw"))
+    writeBigWig(outfile, CHROM_SIZES, referenceData())
+
+    reader = BigWigReader(outfile)
+    assert reader.zoom_levels > 0
+
+    chrom_ids = dict((chrom, i) for i, (chrom, size)
+                     in enumerate(CHROM_SIZES))
+
+    for level, (reduction, reserved, data_offset, index_offset) in \
+            enumerate(reader.zooms):
+
+        expected = []
+        for chrom, positions, values in referenceData():
+            positions = np.asarray(positions)
+            values = np.asarray(values)
+            size = dict(CHROM_SIZES)[chrom]
+            for zoom_bin in np.unique(positions // reduction):
+                in_bin = values[positions // reduction == zoom_bin]
+                expected.append((chrom_ids[chrom], zoom_bin * reduction,
+                                 min((zoom_bin + 1) * reduction, size),
+                                 len(in_bin), in_bin.min(), in_bin.max(),
+                                 in_bin.sum(), (in_bin ** 2).sum()))
+
+        records = reader.zoomRecords(level)
+        assert [record[:4] for record in records] == \
+            [record[:4] for record in sorted(expected)]
+        np.testing.assert_allclose([record[4:] for record in records],
+                                   [record[4:] for record in sorted(expected)],
+                                   rtol=1e-6)
+
+
+def test_positions_outside_contig_dropped(tmpdir):
+    ''' A crosslink at -1, or at or beyond the end of the contig, cannot
+    be stored and must not be cast into the unsigned start field '''
+
+    outfile = str(tmpdir.join("test.bw"))
+    positions = [-1, 0, 5, 99, 100, 150]
+    values = [1, 2, 3, 4, 5, 6]
+
+    writer = writeBigWig(outfile, [("chrM", 100), ("chr1", 1000)],
+                         [("chrM", positions, values),
+                          ("chr1", [-5, 10], [1, 1])])
+
+    assert writer.dropped == 4
+
+    reader = BigWigReader(outfile)
+    assert reader.intervals("chrM") == expectedIntervals(positions, values,
+                                                         100)
+    assert reader.intervals("chr1") == [(10, 11, 1.0)]
+
+    # 4 bases kept
+    assert reader.summary[0] == 4
+    checkIndex(reader)
+
+    for level in range(reader.zoom_levels):
+        for record in reader.zoomRecords(level):
+            size = 100 if record[0] == 0 else 1000
+            assert 0 <= record[1] < record[2] <= size
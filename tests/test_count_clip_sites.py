@@ -0,0 +1,58 @@
+''' Tests for the single feature level counts of count_clip_sites.py '''
+
+import CGAT.GTF as GTF
+
+import iCLIP
+import count_clip_sites
+
+# t1 has two exons and a CDS, t2 only a CDS
+GTF_LINES = [
+    'chr1\ttest\texon\t101\t200\t.\t+\t.\tgene_id "g1"; '
+    'transcript_id "t1"; exon_id "e1";\n',
+    'chr1\ttest\tCDS\t151\t200\t.\t+\t0\tgene_id "g1"; '
+    'transcript_id "t1"; protein_id "p1";\n',
+    'chr1\ttest\texon\t301\t400\t.\t+\t.\tgene_id "g1"; '
+    'transcript_id "t1"; exon_id "e2";\n',
+    'chr1\ttest\tCDS\t151\t200\t.\t+\t0\tgene_id "g1"; '
+    'transcript_id "t2"; protein_id "p2";\n']
+
+
+def readGTF(tmpdir):
+
+    gtffile = tmpdir.join("test.gtf")
+    gtffile.write("".join(GTF_LINES))
+
+    return list(GTF.iterator(open(str(gtffile))))
+
+
+def crosslinks():
+
+    result = iCLIP.CrosslinkCounts()
+    result.addContig("chr1",
+                     iCLIP.StrandProfile([120, 160, 250, 320], [1, 2, 4, 8],
+                                         1000),
+                     iCLIP.StrandProfile([130], [16], 1000),
+                     1000)
+    return result
+
+
+def test_exons_with_cds_rows(tmpdir):
+    ''' Rows that are not exons have nothing to count '''
+
+    features = [[entry] for entry in readGTF(tmpdir)]
+
+    assert count_clip_sites.countFeatures(crosslinks(), features, "exon") == [
+        ["g1", "t1", "e1", "3", "NA"],
+        ["g1", "t1", "NA", "0", "NA"],
+        ["g1", "t1", "e2", "8", "NA"],
+        ["g1", "t2", "NA", "0", "NA"]]
+
+
+def test_transcripts_without_exons(tmpdir):
+
+    features = GTF.transcript_iterator(iter(readGTF(tmpdir)))
+
+    assert count_clip_sites.countFeatures(crosslinks(), features,
+                                          "transcript") == [
+        ["g1", "t1", "NA", "11", "4"],
+        ["g1", "t2", "NA", "0", "0"]]
@@ -0,0 +1,165 @@
+''' Regression tests for find_significant_bases.py '''
+
+import numpy as np
+import pandas as pd
+from scipy.stats import binom
+from statsmodels.stats.multitest import multipletests
+import CGAT.Intervals as Intervals
+
+import find_significant_bases
+
+
+def loopProbabilities(counts, window_size, length, start=0):
+    ''' calculateProbabilities as it was before window heights were
+    found from cumulative sums: each window summed by label slicing '''
+
+    counts = counts[(counts.index.values >= start) &
+                    (counts.index.values < (start + length))]
+    total_counts = counts.sum()
+
+    single_base_ps = 1 - binom.cdf(counts-2, total_counts, 1.0/length)
+
+    heights = np.zeros(len(counts))
+
+    window_start = np.maximum(0, counts.index.values-window_size)
+    window_end = np.minimum(start+length, counts.index.values + window_size)
+
+    ps = (window_end - window_start + 0.0) / length
+    ps = ps.astype("float64")
+
+    for i, base in enumerate(counts.index.values):
+        window = counts[window_start[i]:window_end[i]]
+        heights[i] = window.sum()
+
+    heights = heights - counts.values
+    window_ps = pd.Series(1 - binom.cdf(heights - 1, total_counts, ps),
+                          index=counts.index)
+
+    return window_ps*single_base_ps
+
+
+def syntheticTranscript(rng, n_sites, length, offset=0, max_count=20):
+    ''' Crosslink counts at n_sites random bases of a transcript, indexed
+    on float positions as the counts from iCLIP.countChr '''
+
+    positions = np.sort(rng.choice(length, n_sites, replace=False)) + offset
+    counts = rng.randint(1, max_count, n_sites)
+
+    return pd.Series(counts, index=positions.astype("float64"))
+
+
+def combineWindows(pvalues, window_size):
+    ''' get_windows as it was before the single sweep: windows merged
+    with Intervals.combine and each minimum found by label slicing a
+    Series of p-values indexed on float position '''
+
+    windows = [(pos-window_size, pos+window_size+1)
+               for pos in pvalues.index.values]
+
+    merged_windows = Intervals.combine(windows)
+    windows_min_p = [pvalues.loc[float(start):float(end-1)].min()
+                     for start, end in merged_windows]
+    return list(zip(merged_windows, windows_min_p))
+
+
+def test_window_probabilities_match_loop():
+
+    rng = np.random.RandomState(1234)
+
+    for n_sites, length, window_size in [(1, 50, 15),
+                                         (10, 50, 15),
+                                         (50, 60, 15),
+                                         (200, 5000, 15),
+                                         (500, 2000, 1),
+                                         (300, 1000, 100)]:
+
+        counts = syntheticTranscript(rng, n_sites, length)
+
+        expected = loopProbabilities(counts, window_size, length)
+        result = find_significant_bases.calculateProbabilities(
+            counts, window_size, length)
+
+        assert (result.index.values == expected.index.values).all()
+        np.testing.assert_allclose(result.values, expected.values,
+                                   rtol=1e-7, atol=1e-12)
+
+
+def test_window_probabilities_match_loop_on_subset():
+    ''' Only the sites in [start, start + length) are used '''
+
+    rng = np.random.RandomState(4321)
+
+    counts = syntheticTranscript(rng, 400, 3000, offset=1000)
+    start, length = 1500, 1000
+
+    expected = loopProbabilities(counts, 15, length, start)
+    result = find_significant_bases.calculateProbabilities(
+        counts, 15, length, start)
+
+    assert len(result) == ((counts.index.values >= start) &
+                           (counts.index.values < start + length)).sum()
+    assert (result.index.values == expected.index.values).all()
+    np.testing.assert_allclose(result.values, expected.values,
+                               rtol=1e-7, atol=1e-12)
+
+
+def test_windows_match_combine():
+    ''' Sparse and dense sites, so that windows are separate, touching
+    and overlapping '''
+
+    rng = np.random.RandomState(5678)
+
+    for n_sites, length, window_size in [(1, 50, 15),
+                                         (30, 100000, 15),
+                                         (300, 3000, 5),
+                                         (500, 1000, 0),
+                                         (200, 400, 1),
+                                         (100, 5000, 100)]:
+
+        positions = np.sort(rng.choice(length, n_sites, replace=False))
+        pvalues = rng.uniform(0, 0.05, n_sites)
+
+        expected = combineWindows(
+            pd.Series(pvalues, index=positions.astype("float64")),
+            window_size)
+        result = list(find_significant_bases.get_windows(
+            positions, pvalues, window_size))
+
+        assert [window for window, p in result] == \
+            [window for window, p in expected]
+        assert [p for window, p in result] == [p for window, p in expected]
+
+    assert list(find_significant_bases.get_windows(
+        np.array([], dtype="int64"), np.array([]), 15)) == []
+
+
+def test_external_fdr_matches_multipletests(tmpdir):
+    ''' Sorted in one run or many, with ties and NaNs '''
+
+    rng = np.random.RandomState(99)
+
+    pvalues = np.concatenate([rng.uniform(0, 1, 2000),
+                              rng.uniform(0, 0.001, 300),
+                              np.round(rng.uniform(0, 1, 500), 2),
+                              [0.0, 0.0, 1.0, 1.0]])
+    pvalues[rng.choice(len(pvalues), 100, replace=False)] = np.nan
+    rng.shuffle(pvalues)
+
+    tested = ~np.isnan(pvalues)
+    expected = np.full(len(pvalues), np.nan)
+    expected[tested] = multipletests(pvalues[tested], method="fdr_bh")[1]
+
+    pfile = str(tmpdir.join("pvalues"))
+    qfile = str(tmpdir.join("qvalues"))
+    pvalues.tofile(pfile)
+
+    for run_size in [1, 7, 100, 1000, len(pvalues)]:
+
+        ntests = find_significant_bases.externalFDR(pfile, qfile,
+                                                    str(tmpdir), run_size)
+
+        assert ntests == tested.sum()
+        np.testing.assert_allclose(np.fromfile(qfile, dtype="float64"),
+                                   expected, rtol=1e-12)
+        assert sorted(tmpdir.listdir()) == sorted([tmpdir.join("pvalues"),
+                                                   tmpdir.join("qvalues")])
@@ -0,0 +1,86 @@
+''' Tests for the batched permutation nulls of iCLIP.rand_apply '''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import iCLIP
+
+
+class Exon:
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+def shuffledPositions(start, end, n_perm, n_sites, seed):
+    ''' randomPositions as it was before keys were drawn in batches:
+    every base of every permutation keyed at once and argsorted '''
+
+    keys = np.random.RandomState(seed).random_sample((n_perm, end - start))
+    return keys.argsort(axis=1)[:, :n_sites] + start
+
+
+@pytest.mark.parametrize("batch_size", [1, 100, 1000, 2 ** 22])
+def test_random_positions_batches(monkeypatch, batch_size):
+    ''' Keys drawn a batch of rows at a time, and the smallest found by
+    partition, give the positions of one argsort over every row '''
+
+    monkeypatch.setattr(iCLIP, "PERMUTATION_BATCH_SIZE", batch_size)
+
+    for start, end, n_perm, n_sites in [(1000, 1100, 50, 30),
+                                        (0, 40, 7, 40),
+                                        (5, 6, 3, 1)]:
+
+        result = iCLIP.randomPositions(start, end, n_perm, n_sites,
+                                       rng=np.random.RandomState(42))
+
+        assert (result == shuffledPositions(start, end, n_perm, n_sites,
+                                            42)).all()
+
+
+def rowProfile(positions, counts):
+    ''' A row of permuteProfile as the Series randomiseSites returns '''
+
+    return pd.Series(counts, index=positions).groupby(level=0).sum()
+
+
+@pytest.mark.parametrize("keep_dist", [True, False])
+@pytest.mark.parametrize("profile2_ready", [True, False])
+def test_spread_corr_null_matches_corr_profile(monkeypatch, keep_dist,
+                                               profile2_ready):
+
+    monkeypatch.setattr(iCLIP, "PERMUTATION_BATCH_SIZE", 500)
+
+    rng = np.random.RandomState(7)
+    exon = Exon(1000, 1300)
+
+    positions1 = np.sort(rng.choice(np.arange(exon.start, exon.end), 25,
+                                    replace=False))
+    profile1 = pd.Series(rng.randint(1, 5, 25), index=positions1)
+
+    # profile2 extends beyond the exon at both ends, so each row is
+    # compared over its own range of bases
+    positions2 = np.sort(rng.choice(np.arange(exon.start - 50, exon.end + 50),
+                                    80, replace=False))
+    profile2 = pd.Series(rng.randint(1, 5, 80), index=positions2)
+
+    nspread = 5
+    if profile2_ready:
+        profile2 = iCLIP.spread(profile2, nspread)
+        profile2[profile2.index.values[::10]] = np.nan
+
+    positions, counts = iCLIP.permuteProfile(
+        profile1, exon.start, exon.end, 30, keep_dist=keep_dist,
+        rng=np.random.RandomState(3))
+
+    expected = [iCLIP.corr_profile(rowProfile(row_positions, row_counts),
+                                   profile2, nspread, profile2_ready)
+                for row_positions, row_counts in zip(positions, counts)]
+
+    result = iCLIP.rand_apply(profile1, exon, 30, iCLIP.corr_profile,
+                              keep_dist, profile2, nspread, profile2_ready,
+                              rng=np.random.RandomState(3))
+
+    np.testing.assert_allclose(result.values, expected, rtol=1e-12)
@@ -0,0 +1,43 @@
+''' Tests for iCLIP.StrandProfile '''
+
+import numpy as np
+import pytest
+
+import iCLIP
+
+# short enough for the profile to be dense unless sparse is forced
+POSITIONS = [0, 5, 6, 12, 19]
+COUNTS = [1, 2, 4, 8, 16]
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_sum(sparse):
+
+    profile = iCLIP.StrandProfile(POSITIONS, COUNTS, 20, sparse=sparse)
+    assert (profile.dense is None) == sparse
+
+    positions = np.array(POSITIONS)
+    counts = np.array(COUNTS)
+
+    for start, end in [(None, None), (0, 20), (5, 7), (7, 12), (12, 13),
+                       (10, None), (19, None), (20, None),
+                       (None, 6), (None, 0), (None, 1000)]:
+
+        first = 0 if start is None else start
+        last = 20 if end is None else end
+        expected = counts[(positions >= first) & (positions < last)].sum()
+
+        assert profile.sum(start, end) == expected
+        assert profile.sum(start=start, end=end) == expected
+
+
+def test_sum_without_length():
+
+    profile = iCLIP.StrandProfile(POSITIONS, COUNTS)
+
+    assert profile.sum(start=6) == 28
+    assert profile.sum(end=6) == 3
+
+    empty = iCLIP.StrandProfile([], [])
+    assert empty.sum(start=10) == 0
+    assert empty.sum(end=10) == 0
@@ -13,12 +13,16 @@ Purpose
 Takes a BAM file produced from mapping a FASTQ created by
 extract_umi.py and produces a histogram of their usage.
 
+To collect this along with the other QC statistics on a BAM file in
+one pass, use bam_qc.py.
+
 Options
 -------
 
-Will read bamfile off of the stdin or from -I, but 
-BAM file must be indexed and so cannot be manipulated on 
-stdin.
+Will read bamfile off of the stdin or from -I. The BAM file is read
+from start to end, so need not be indexed.
+
+--threads is the number of threads to decompress the BAM file with.
 
 
 Usage
@@ -36,9 +40,8 @@ Command line options
 
 
 import sys
-import collections
 import CGAT.Experiment as E
-import pysam
+import iCLIP
 
 
 def main(argv=None):
@@ -54,26 +57,25 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of threads to decompress the BAM file "
+                           "with [%default]")
+
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
 
-    out_hist = collections.defaultdict(int)
-
     if options.stdin == sys.stdin:
-        in_bam = pysam.Samfile("-", "rb")
+        in_bam = iCLIP.openBam("-", options.threads)
     else:
         fn = options.stdin.name
         options.stdin.close()
-        in_bam = pysam.Samfile(fn, "rb")
+        in_bam = iCLIP.openBam(fn, options.threads)
 
-    for read in in_bam.fetch():
-        barcode = read.qname.split("_")[-1]
-        out_hist[barcode] += 1
+    umis = iCLIP.UMIHistogram()
+    for read in in_bam.fetch(until_eof=True):
+        umis.add(read)
 
-    header = "\t".join(["UMI", "Count"])
-    outlines = ["\t".join(map(str, x)) for x in out_hist.iteritems()]
-    outlines = header + "\n" + "\n".join(outlines) + "\n"
-    options.stdout.write(outlines)
+    umis.write(options.stdout)
 
     # write footer and output benchmark information.
     E.Stop()